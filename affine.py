@@ -0,0 +1,247 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import math
+
+import numpy as np
+
+
+class AffineTransform(object):
+    """
+    2D affine transform stored as 6 doubles, with the same lettering as the
+    world file:
+
+        x = a * u + b * v + c
+        y = d * u + e * v + f
+
+    For the pixel to map transform of a layer, (u, v) are pixel coordinates
+    with the origin on the upper left corner of the upper left pixel (same
+    convention as the GDAL geotransform).
+    """
+
+    __slots__ = ("a", "b", "c", "d", "e", "f")
+
+    def __init__(self, a=1.0, b=0.0, c=0.0, d=0.0, e=1.0, f=0.0):
+        self.a = a
+        self.b = b
+        self.c = c
+        self.d = d
+        self.e = e
+        self.f = f
+
+    @classmethod
+    def identity(cls):
+        return cls()
+
+    @classmethod
+    def translation(cls, dx, dy):
+        return cls(1.0, 0.0, dx, 0.0, 1.0, dy)
+
+    @classmethod
+    def rotationAround(cls, rotation, x, y):
+        # rotation in degrees, CW (same as the layer and Qt)
+        rotationRad = -rotation * math.pi / 180
+        cosRot = math.cos(rotationRad)
+        sinRot = math.sin(rotationRad)
+        return cls(
+            cosRot,
+            -sinRot,
+            x - cosRot * x + sinRot * y,
+            sinRot,
+            cosRot,
+            y - sinRot * x - cosRot * y,
+        )
+
+    @classmethod
+    def fromParameters(cls, centerX, centerY, rotation, xScale, yScale, width, height):
+        """
+        Pixel to map transform for an image of size width x height with the
+        transform parameters of the layer (center in map units, rotation in
+        degrees CW, scales in map units per pixel)
+        """
+        rotationRad = rotation * math.pi / 180
+        cosRot = math.cos(rotationRad)
+        sinRot = math.sin(rotationRad)
+
+        a = xScale * cosRot
+        # sin instead of -sin because angle in CW
+        b = -yScale * sinRot
+        d = -xScale * sinRot
+        e = -yScale * cosRot
+        c = centerX - (a * width / 2.0 + b * height / 2.0)
+        f = centerY - (d * width / 2.0 + e * height / 2.0)
+        return cls(a, b, c, d, e, f)
+
+    @classmethod
+    def fromGdal(cls, geotransform):
+        gt = geotransform
+        return cls(gt[1], gt[2], gt[0], gt[4], gt[5], gt[3])
+
+    @classmethod
+    def fit(cls, sourcePoints, destinationPoints):
+        """
+        Least squares fit of the transform mapping sourcePoints to
+        destinationPoints (array-likes of shape (N, 2), N >= 3). Returns the
+        transform and the residual distance of each point
+        """
+        source = np.asarray(sourcePoints, dtype=np.float64)
+        destination = np.asarray(destinationPoints, dtype=np.float64)
+        # centered for numerical stability
+        sourceMean = source.mean(axis=0)
+        destinationMean = destination.mean(axis=0)
+        design = np.column_stack([source - sourceMean, np.ones(len(source))])
+        coefficients, _, _, _ = np.linalg.lstsq(
+            design, destination - destinationMean, rcond=None
+        )
+        (a, d), (b, e), (c, f) = coefficients
+        centered = cls(a, b, c, d, e, f)
+        transform = (
+            cls.translation(*-sourceMean)
+            .compose(centered)
+            .compose(cls.translation(*destinationMean))
+        )
+        residuals = np.hypot(*(transform.mapArray(source) - destination).T)
+        return transform, residuals
+
+    @classmethod
+    def fitSimilarity(cls, sourcePoints, destinationPoints):
+        """
+        Least squares fit of the similarity (rotation, uniform scale and
+        translation, no reflection) mapping sourcePoints to destinationPoints
+        (N >= 2). Returns the transform and the residual distance of each
+        point
+        """
+        source = np.asarray(sourcePoints, dtype=np.float64)
+        destination = np.asarray(destinationPoints, dtype=np.float64)
+        sourceMean = source.mean(axis=0)
+        destinationMean = destination.mean(axis=0)
+        (us, vs), (xs, ys) = (source - sourceMean).T, (destination - destinationMean).T
+        # closed form: x + iy = (p + iq) (u + iv)
+        norm = np.sum(us * us + vs * vs)
+        if norm == 0:
+            raise ValueError("The source points are all the same")
+        p = np.sum(us * xs + vs * ys) / norm
+        q = np.sum(us * ys - vs * xs) / norm
+        transform = cls(
+            p,
+            -q,
+            destinationMean[0] - p * sourceMean[0] + q * sourceMean[1],
+            q,
+            p,
+            destinationMean[1] - q * sourceMean[0] - p * sourceMean[1],
+        )
+        residuals = np.hypot(*(transform.mapArray(source) - destination).T)
+        return transform, residuals
+
+    def toGdal(self):
+        return (self.c, self.a, self.b, self.f, self.d, self.e)
+
+    def toWorldFile(self):
+        """
+        Parameters in world file order (a, d, b, e, c, f). The origin of a
+        world file is on the center of the upper left pixel instead of its
+        corner.
+        """
+        t = self.compose(AffineTransform.translation(0.5, 0.5), first=True)
+        return (t.a, t.d, t.b, t.e, t.c, t.f)
+
+    def parameters(self, width, height):
+        """
+        Inverse of fromParameters: (centerX, centerY, rotation, xScale,
+        yScale). Any shearing is dropped.
+        """
+        centerX, centerY = self.map(width / 2.0, height / 2.0)
+        rotation = 180 / math.pi * -math.atan2(self.d, self.a)
+        # keep yScale positive
+        xScale = math.hypot(self.a, self.d)
+        yScale = math.hypot(self.b, self.e)
+        return (float(centerX), float(centerY), rotation, xScale, yScale)
+
+    def compose(self, other, first=False):
+        """
+        Transform that applies this transform then other. If first is True,
+        other is applied before this transform.
+        """
+        if first:
+            outer, inner = self, other
+        else:
+            outer, inner = other, self
+        return AffineTransform(
+            outer.a * inner.a + outer.b * inner.d,
+            outer.a * inner.b + outer.b * inner.e,
+            outer.a * inner.c + outer.b * inner.f + outer.c,
+            outer.d * inner.a + outer.e * inner.d,
+            outer.d * inner.b + outer.e * inner.e,
+            outer.d * inner.c + outer.e * inner.f + outer.f,
+        )
+
+    def determinant(self):
+        return self.a * self.e - self.b * self.d
+
+    def inverted(self):
+        det = self.determinant()
+        if det == 0:
+            raise ZeroDivisionError("Affine transform is not invertible")
+        a = self.e / det
+        b = -self.b / det
+        d = -self.d / det
+        e = self.a / det
+        return AffineTransform(
+            a, b, -(a * self.c + b * self.f), d, e, -(d * self.c + e * self.f)
+        )
+
+    def map(self, u, v):
+        return (
+            self.a * u + self.b * v + self.c,
+            self.d * u + self.e * v + self.f,
+        )
+
+    def mapArrays(self, us, vs):
+        """
+        Vectorized version of map: us and vs are array-likes of the same
+        shape. Returns a tuple of 2 float64 arrays
+        """
+        us = np.asarray(us, dtype=np.float64)
+        vs = np.asarray(vs, dtype=np.float64)
+        return (
+            self.a * us + self.b * vs + self.c,
+            self.d * us + self.e * vs + self.f,
+        )
+
+    def mapArray(self, points):
+        """
+        points is an array-like of shape (N, 2). Returns an (N, 2) array
+        """
+        points = np.asarray(points, dtype=np.float64)
+        matrix = np.array([[self.a, self.d], [self.b, self.e]])
+        return points @ matrix + (self.c, self.f)
+
+    def corners(self, width, height):
+        """
+        Map coordinates of the corners of a width x height image as an (4, 2)
+        array: topLeft, topRight, bottomRight, bottomLeft
+        """
+        return self.mapArray([(0, 0), (width, 0), (width, height), (0, height)])
+
+    def bounds(self, width, height):
+        """
+        Bounding box (xMin, yMin, xMax, yMax) of a width x height image
+        """
+        corners = self.corners(width, height)
+        xMin, yMin = corners.min(axis=0)
+        xMax, yMax = corners.max(axis=0)
+        return (xMin, yMin, xMax, yMax)
+
+    def coefficients(self):
+        return (self.a, self.b, self.c, self.d, self.e, self.f)
+
+    def __repr__(self):
+        return "AffineTransform(%r, %r, %r, %r, %r, %r)" % self.coefficients()
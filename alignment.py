@@ -0,0 +1,237 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Estimation of the similarity (translation, rotation, scale) between 2 images
+of the same size by FFT phase correlation (log-polar for the rotation and the
+scale), coarse to fine on a pyramid. Only NumPy is needed.
+
+Coordinates are (x, y) = (column, row) with the origin on the upper left
+corner of the image.
+"""
+
+import math
+
+import numpy as np
+
+from .affine import AffineTransform
+from .pyramid import pyramidLevels
+
+# the coarsest level of the pyramid has at least this size
+MIN_LEVEL_SIZE = 64
+
+
+def toGray(rgba):
+    """
+    Luminance (float32) of RGBA pixels (h, w, 4), transparent pixels are 0
+    """
+    rgba = np.asarray(rgba, dtype=np.float32)
+    gray = 0.299 * rgba[..., 0] + 0.587 * rgba[..., 1] + 0.114 * rgba[..., 2]
+    return gray * (rgba[..., 3] / 255.0)
+
+
+def _hann(shape):
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(np.float32)
+
+
+def _bilinear(image, xs, ys):
+    """
+    Values of the image at continuous coordinates (pixel centers at integer
+    coordinates), 0 outside
+    """
+    height, width = image.shape
+    x0 = np.floor(xs).astype(np.int64)
+    y0 = np.floor(ys).astype(np.int64)
+    tx = (xs - x0).astype(np.float32)
+    ty = (ys - y0).astype(np.float32)
+    result = np.zeros(np.shape(xs), dtype=np.float32)
+    for dy, wy in ((0, 1 - ty), (1, ty)):
+        for dx, wx in ((0, 1 - tx), (1, tx)):
+            x = x0 + dx
+            y = y0 + dy
+            valid = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+            values = image[np.clip(y, 0, height - 1), np.clip(x, 0, width - 1)]
+            result += np.where(valid, values * wx * wy, 0)
+    return result
+
+
+def warpImage(image, transform):
+    """
+    Image resampled so that output(transform(p)) = image(p): transform
+    (AffineTransform) maps the coordinates of the image to the coordinates
+    of the output, of the same size
+    """
+    height, width = image.shape
+    xs, ys = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+    us, vs = transform.inverted().mapArrays(xs, ys)
+    return _bilinear(image, us - 0.5, vs - 0.5)
+
+
+def phaseCorrelation(reference, moving):
+    """
+    (dx, dy, response): moving(p) ~ reference(p - (dx, dy)) with a subpixel
+    peak. response (peak of the normalized correlation) measures the
+    confidence of the match
+    """
+    product = np.fft.fft2(moving) * np.conj(np.fft.fft2(reference))
+    product /= np.maximum(np.abs(product), 1e-12)
+    correlation = np.real(np.fft.ifft2(product))
+    height, width = correlation.shape
+    row, col = np.unravel_index(np.argmax(correlation), correlation.shape)
+    response = float(correlation[row, col])
+
+    def subpixel(minus, center, plus):
+        denominator = minus - 2 * center + plus
+        if denominator >= 0:
+            return 0.0
+        return 0.5 * (minus - plus) / denominator
+
+    dy = row + subpixel(
+        correlation[(row - 1) % height, col],
+        correlation[row, col],
+        correlation[(row + 1) % height, col],
+    )
+    dx = col + subpixel(
+        correlation[row, (col - 1) % width],
+        correlation[row, col],
+        correlation[row, (col + 1) % width],
+    )
+    # shifts beyond half the size are negative shifts
+    if dy > height / 2:
+        dy -= height
+    if dx > width / 2:
+        dx -= width
+    return dx, dy, response
+
+
+def _logPolarSpectrum(image, angleCount, radiusCount):
+    """
+    High-pass filtered magnitude of the spectrum of the image in log-polar
+    coordinates (rows: angles in [0, pi), columns: log of the radius), and
+    the log base of the radius
+    """
+    height, width = image.shape
+    magnitude = np.abs(np.fft.fftshift(np.fft.fft2(image * _hann(image.shape))))
+    # high-pass emphasis (Reddy and Chatterji)
+    fy = np.fft.fftshift(np.fft.fftfreq(height))[:, np.newaxis]
+    fx = np.fft.fftshift(np.fft.fftfreq(width))[np.newaxis, :]
+    x = np.cos(np.pi * fy) * np.cos(np.pi * fx)
+    magnitude *= (1 - x) * (2 - x)
+
+    maxRadius = min(height, width) / 2.0
+    logBase = math.log(maxRadius) / radiusCount
+    radii = np.exp(np.arange(radiusCount) * logBase)
+    angles = np.arange(angleCount) * np.pi / angleCount
+    # y axis down: the angle of the spectrum is measured clockwise
+    xs = width / 2.0 + radii[np.newaxis, :] * np.cos(angles)[:, np.newaxis]
+    ys = height / 2.0 + radii[np.newaxis, :] * np.sin(angles)[:, np.newaxis]
+    return _bilinear(magnitude.astype(np.float32), xs, ys), logBase
+
+
+def similarityAround(rotation, scale, x, y):
+    """
+    AffineTransform rotating (degrees, clockwise with the y axis down) and
+    scaling around (x, y)
+    """
+    angle = math.radians(rotation)
+    a = scale * math.cos(angle)
+    d = scale * math.sin(angle)
+    return AffineTransform(a, -d, x - a * x + d * y, d, a, y - d * x - a * y)
+
+
+def estimateSimilarity(reference, moving, allowFlip=True):
+    """
+    (transform, response): transform maps the coordinates of moving to
+    those of reference (reference(transform(p)) ~ moving(p)). Rotation and
+    scale from the log-polar spectra, then translation. If allowFlip, the
+    180 degrees ambiguity of the spectra is resolved by the best translation
+    response, else the smallest rotation is kept
+    """
+    height, width = reference.shape
+    angleCount = max(height, width)
+    radiusCount = max(height, width)
+    referencePolar, logBase = _logPolarSpectrum(reference, angleCount, radiusCount)
+    movingPolar, _ = _logPolarSpectrum(moving, angleCount, radiusCount)
+    dRadius, dAngle, _ = phaseCorrelation(movingPolar, referencePolar)
+    rotation = dAngle * 180.0 / angleCount
+    scale = math.exp(-dRadius * logBase)
+
+    candidates = [rotation]
+    if allowFlip:
+        candidates.append(rotation + 180.0)
+    best = None
+    window = _hann(reference.shape)
+    for candidate in candidates:
+        rotationScale = similarityAround(candidate, scale, width / 2.0, height / 2.0)
+        warped = warpImage(moving, rotationScale)
+        dx, dy, response = phaseCorrelation(warped * window, reference * window)
+        transform = rotationScale.compose(AffineTransform.translation(dx, dy))
+        if best is None or response > best[1]:
+            best = (transform, response)
+    return best
+
+
+def _scaled(transform, factor):
+    """
+    transform expressed in coordinates scaled by factor
+    """
+    scale = AffineTransform(factor, 0.0, 0.0, 0.0, factor, 0.0)
+    return scale.inverted().compose(transform).compose(scale)
+
+
+def align(reference, moving, minLevelSize=MIN_LEVEL_SIZE):
+    """
+    Coarse to fine estimation of the similarity between 2 gray images of the
+    same size: full estimation on the coarsest level of the pyramid, then
+    refined on each finer level. Returns (transform, response) as
+    estimateSimilarity
+    """
+    referenceLevels = pyramidLevels(reference, minLevelSize)
+    movingLevels = pyramidLevels(moving, minLevelSize)
+    transform = AffineTransform.identity()
+    response = 0.0
+    for level in range(len(referenceLevels) - 1, -1, -1):
+        factor = 2**level
+        # current estimate in the coordinates of the level
+        current = _scaled(transform, 1.0 / factor)
+        warped = warpImage(movingLevels[level], current)
+        isCoarsest = level == len(referenceLevels) - 1
+        residual, response = estimateSimilarity(
+            referenceLevels[level], warped, allowFlip=isCoarsest
+        )
+        transform = _scaled(current.compose(residual), factor)
+    return transform, response
+
+
+def edgeMagnitude(gray):
+    """
+    Gradient magnitude of a gray image, less sensitive than the gray levels
+    to the differences of radiometry between 2 sources
+    """
+    dy, dx = np.gradient(np.asarray(gray, dtype=np.float32))
+    return np.hypot(dx, dy)
+
+
+def normalizedCrossCorrelation(a, b, mask=None):
+    """
+    Normalized cross-correlation of 2 arrays of the same shape (on the True
+    pixels of mask if not None), in [-1, 1]. None if undefined (not enough
+    pixels or a constant array)
+    """
+    if mask is not None:
+        a = a[mask]
+        b = b[mask]
+    if a.size < 16:
+        return None
+    a = a - a.mean()
+    b = b - b.mean()
+    denominator = math.sqrt(float(np.sum(a * a)) * float(np.sum(b * b)))
+    if denominator == 0:
+        return None
+    return float(np.sum(a * b)) / denominator
@@ -0,0 +1,100 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Per-pixel transparency of an image, computed once in its alpha channel: a
+nodata value, a color key (for example the white of the paper of a scan,
+with a tolerance) or the GDAL mask band of the file.
+"""
+
+import json
+
+import numpy as np
+
+MASK_NODATA = "nodata"
+MASK_COLOR_KEY = "colorKey"
+MASK_GDAL = "gdal"
+MASK_METHODS = (MASK_NODATA, MASK_COLOR_KEY, MASK_GDAL)
+
+# rows processed at once (bounds the temporary arrays)
+CHUNK_ROWS = 512
+
+
+class AlphaMask(object):
+    """
+    Pixels of an image made transparent. Immutable
+    """
+
+    def __init__(self, method, nodata=0, color=(255, 255, 255), tolerance=0):
+        if method not in MASK_METHODS:
+            raise ValueError("Unknown mask method: %s" % method)
+        self.method = method
+        self.nodata = int(nodata)
+        self.color = tuple(int(value) for value in color)
+        self.tolerance = int(tolerance)
+
+    def __eq__(self, other):
+        return isinstance(other, AlphaMask) and self.toJson() == other.toJson()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def transparentPixels(self, rgb, gdalMask=None):
+        """
+        Boolean array (h, w): True for the pixels of rgb (h, w, 3) made
+        transparent. gdalMask is the GDAL mask band of the same pixels (0
+        for the invalid pixels), needed by MASK_GDAL
+        """
+        if self.method == MASK_GDAL:
+            if gdalMask is None:
+                return np.zeros(rgb.shape[:2], dtype=bool)
+            return gdalMask == 0
+        if self.method == MASK_NODATA:
+            return np.all(rgb == self.nodata, axis=-1)
+        distances = np.abs(rgb.astype(np.int16) - np.array(self.color, np.int16))
+        return np.all(distances <= self.tolerance, axis=-1)
+
+    def applyTo(self, pixels, gdalMask=None, channels=(0, 1, 2), alphaChannel=3):
+        """
+        Sets to 0 the alpha of the transparent pixels of pixels (h, w, 4), in
+        place, by chunks of rows. channels: index of R, G, B in the last
+        dimension
+        """
+        channels = list(channels)
+        for start in range(0, pixels.shape[0], CHUNK_ROWS):
+            rows = slice(start, start + CHUNK_ROWS)
+            chunkMask = None if gdalMask is None else gdalMask[rows]
+            transparent = self.transparentPixels(pixels[rows][..., channels], chunkMask)
+            pixels[rows, :, alphaChannel][transparent] = 0
+        return pixels
+
+    def toJson(self):
+        return json.dumps(
+            {
+                "method": self.method,
+                "nodata": self.nodata,
+                "color": list(self.color),
+                "tolerance": self.tolerance,
+            }
+        )
+
+    @classmethod
+    def fromJson(cls, text):
+        """
+        AlphaMask stored with toJson, None if text is empty
+        """
+        if not text:
+            return None
+        values = json.loads(text)
+        return cls(
+            values["method"],
+            values.get("nodata", 0),
+            values.get("color", (255, 255, 255)),
+            values.get("tolerance", 0),
+        )
@@ -0,0 +1,394 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Export of all the layers of the plugin in a QGIS project, without QGIS (only
+GDAL and NumPy are needed). From the directory containing the plugin:
+
+    python -m FreehandRasterGeoreferencer.batchexport project.qgz outputDir
+"""
+
+import argparse
+from concurrent.futures import as_completed, ProcessPoolExecutor
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+
+from osgeo import osr
+
+from . import rasterexport
+from .affine import AffineTransform
+from .alphamask import AlphaMask
+from .collar import ringFromJson, ringToJson
+from .warp import imageTransform, Warp
+
+# same as FreehandRasterGeoreferencerLayer.LAYER_TYPE (not imported: the
+# layer module needs QGIS)
+LAYER_TYPE = "FreehandRasterGeoreferencerLayer"
+
+# formats of the batch export: the image formats, COG and VRT
+FORMATS = ("tif", "png", "jpg", "bmp", "cog", "vrt")
+
+
+class BatchJob(object):
+    """
+    Georeferencing of a layer, as stored in the custom properties of the
+    layer
+    """
+
+    def __init__(
+        self,
+        name,
+        filepath,
+        xCenter,
+        yCenter,
+        rotation,
+        xScale,
+        yScale,
+        crsWkt,
+        warpJson="",
+        clipJson="",
+        alphaMaskJson="",
+    ):
+        self.name = name
+        self.filepath = filepath
+        self.xCenter = xCenter
+        self.yCenter = yCenter
+        self.rotation = rotation
+        self.xScale = xScale
+        self.yScale = yScale
+        self.crsWkt = crsWkt
+        # warp.Warp as JSON, empty if not warped
+        self.warpJson = warpJson
+        # clip polygon of the image as JSON (see collar.py), empty if none
+        self.clipJson = clipJson
+        # alphamask.AlphaMask as JSON, empty if none
+        self.alphaMaskJson = alphaMaskJson
+
+    @classmethod
+    def fromLayer(cls, layer):
+        return cls(
+            layer.name(),
+            layer.getAbsoluteFilepath(),
+            layer.center.x(),
+            layer.center.y(),
+            layer.rotation,
+            layer.xScale,
+            layer.yScale,
+            layer.crs().toWkt(),
+            layer.warp.toJson() if layer.warp is not None else "",
+            ringToJson(layer.clipRing) if layer.clipRing is not None else "",
+            layer.alphaMask.toJson() if layer.alphaMask is not None else "",
+        )
+
+    def transform(self, width, height):
+        """
+        Pixel to map mapping (AffineTransform or warp.WarpedTransform)
+        """
+        transform = AffineTransform.fromParameters(
+            self.xCenter,
+            self.yCenter,
+            self.rotation,
+            self.xScale,
+            self.yScale,
+            width,
+            height,
+        )
+        return imageTransform(transform, Warp.fromJson(self.warpJson))
+
+    def clipRing(self):
+        return ringFromJson(self.clipJson)
+
+    def sourceRaster(self):
+        """
+        Pixels of the image read from the file, with the alpha mask of the
+        layer if any
+        """
+        source = rasterexport.GdalSourceRaster(self.filepath)
+        alphaMask = AlphaMask.fromJson(self.alphaMaskJson)
+        if alphaMask is not None:
+            source = rasterexport.MaskedSourceRaster(source, alphaMask)
+        return source
+
+
+class BatchOptions(object):
+    """
+    Options shared by all the layers of a batch export
+    """
+
+    def __init__(
+        self,
+        outputDir,
+        rasterFormat="tif",
+        resampling=rasterexport.RESAMPLING_NEAREST,
+        compression="DEFLATE",
+        suffix="_georeferenced",
+        threadCount=1,
+        region=None,
+    ):
+        self.outputDir = outputDir
+        self.rasterFormat = rasterFormat
+        self.resampling = resampling
+        self.compression = compression
+        self.suffix = suffix
+        # threads used by each export
+        self.threadCount = threadCount
+        # rasterexport.ExportRegion: pixel size and clip
+        self.region = region
+
+
+class BatchResult(object):
+    def __init__(self, name, path, duration, error=None):
+        self.name = name
+        self.path = path
+        self.duration = duration
+        self.error = error
+
+
+def readProject(projectPath):
+    """
+    BatchJob for each layer of the plugin in a .qgs or .qgz project
+    """
+    if projectPath.lower().endswith(".qgz"):
+        with zipfile.ZipFile(projectPath) as archive:
+            names = [n for n in archive.namelist() if n.lower().endswith(".qgs")]
+            if not names:
+                raise IOError("No .qgs file in %s" % projectPath)
+            root = ET.fromstring(archive.read(names[0]))
+    else:
+        root = ET.parse(projectPath).getroot()
+
+    # relative paths of the images are relative to the project folder
+    projectFolder = os.path.dirname(os.path.abspath(projectPath))
+    jobs = []
+    for element in root.iter("maplayer"):
+        if element.get("type") != "plugin" or element.get("name") != LAYER_TYPE:
+            continue
+        properties = customProperties(element)
+        filepath = properties.get("filepath", "")
+        if not os.path.isabs(filepath):
+            filepath = os.path.join(projectFolder, filepath)
+        jobs.append(
+            BatchJob(
+                element.findtext("layername") or properties.get("title", ""),
+                os.path.normpath(filepath),
+                float(properties.get("xCenter", 0.0)),
+                float(properties.get("yCenter", 0.0)),
+                float(properties.get("rotation", 0.0)),
+                float(properties.get("xScale", 1.0)),
+                float(properties.get("yScale", 1.0)),
+                element.findtext("srs/spatialrefsys/wkt") or "",
+                properties.get("warp") or "",
+                properties.get("clipRing") or "",
+                properties.get("alphaMask") or "",
+            )
+        )
+    return jobs
+
+
+def customProperties(element):
+    properties = {}
+    customPropertiesElement = element.find("customproperties")
+    if customPropertiesElement is None:
+        return properties
+    # before QGIS 3.20
+    for prop in customPropertiesElement.iter("property"):
+        value = prop.get("value")
+        if value is None:
+            value = prop.findtext("value")
+        properties[prop.get("key")] = value
+    # QGIS 3.20 and later: QVariantMap
+    for option in customPropertiesElement.iter("Option"):
+        if option.get("name"):
+            properties[option.get("name")] = option.get("value")
+    return properties
+
+
+def outputPaths(jobs, options):
+    """
+    Path of the export of each job, unique in the output directory
+    """
+    extension = "tif" if options.rasterFormat == "cog" else options.rasterFormat
+    paths = []
+    used = set()
+    for job in jobs:
+        baseName, _ = os.path.splitext(os.path.basename(job.filepath))
+        name = baseName + options.suffix
+        index = 2
+        while name.lower() in used:
+            name = "%s%s_%d" % (baseName, options.suffix, index)
+            index += 1
+        used.add(name.lower())
+        paths.append(os.path.join(options.outputDir, "%s.%s" % (name, extension)))
+    return paths
+
+
+def exportJob(job, path, options, feedback=None):
+    """
+    Exports the raster of a job to path. Returns a BatchResult (errors are
+    not raised)
+    """
+    start = time.monotonic()
+    try:
+        if options.rasterFormat == "vrt":
+            if job.warpJson:
+                raise ValueError("A warped layer cannot be exported as a VRT")
+            if job.clipJson:
+                raise ValueError("A clipped layer cannot be exported as a VRT")
+            source = rasterexport.GdalSourceRaster(job.filepath)
+            transform = job.transform(source.width, source.height)
+            rasterexport.exportVrt(job.filepath, path, transform, job.crsWkt)
+            return BatchResult(job.name, path, time.monotonic() - start)
+
+        source = job.sourceRaster()
+        if not rasterexport.GdalSourceRaster.isSupported(
+            job.filepath, source.width, source.height
+        ):
+            raise ValueError(
+                "Unsupported raster (only 1 or 3 Byte bands): export it from QGIS"
+            )
+        transform = job.transform(source.width, source.height)
+        grid = rasterexport.outputGrid(
+            transform, source.width, source.height, options.region, job.clipRing()
+        )
+        if options.rasterFormat == "cog":
+            rasterexport.exportCog(
+                source,
+                transform,
+                grid,
+                path,
+                job.crsWkt,
+                options.resampling,
+                options.compression,
+                options.threadCount,
+                feedback=feedback,
+            )
+        else:
+            rasterexport.exportGeorefRaster(
+                source,
+                transform,
+                grid,
+                path,
+                options.rasterFormat,
+                job.crsWkt,
+                options.resampling,
+                options.threadCount,
+                feedback=feedback,
+            )
+            rasterexport.writeWorldFile(
+                path,
+                options.rasterFormat,
+                AffineTransform.fromGdal(grid.geotransform).toWorldFile(),
+            )
+            rasterexport.writeAuxFile(path, job.crsWkt, isGeographic(job.crsWkt))
+        return BatchResult(job.name, path, time.monotonic() - start)
+    except rasterexport.ExportCanceled:
+        raise
+    except Exception as ex:
+        return BatchResult(job.name, path, time.monotonic() - start, repr(ex))
+
+
+def isGeographic(crsWkt):
+    srs = osr.SpatialReference()
+    if not crsWkt or srs.ImportFromWkt(crsWkt) != 0:
+        return False
+    return bool(srs.IsGeographic())
+
+
+def exportJobs(jobs, options, workerCount=None):
+    """
+    Exports the jobs in parallel in a process pool. Yields a BatchResult for
+    each job, in the order of completion
+    """
+    os.makedirs(options.outputDir, exist_ok=True)
+    paths = outputPaths(jobs, options)
+    with ProcessPoolExecutor(max_workers=workerCount) as executor:
+        futures = [
+            executor.submit(exportJob, job, path, options)
+            for job, path in zip(jobs, paths)
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def summary(results, duration):
+    failures = [result for result in results if result.error is not None]
+    lines = [
+        "Exported %d of %d layers in %.1f s"
+        % (len(results) - len(failures), len(results), duration)
+    ]
+    if results:
+        slowest = max(results, key=lambda result: result.duration)
+        lines.append(
+            "Mean time per layer: %.2f s (slowest: %s, %.2f s)"
+            % (
+                sum(result.duration for result in results) / len(results),
+                slowest.name,
+                slowest.duration,
+            )
+        )
+    if failures:
+        lines.append("Failures:")
+        lines.extend("  %s: %s" % (result.name, result.error) for result in failures)
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export all the Freehand raster georeferencer layers of a "
+        "QGIS project"
+    )
+    parser.add_argument("project", help=".qgs or .qgz project file")
+    parser.add_argument("outputDir", help="directory of the exported rasters")
+    parser.add_argument("--format", choices=FORMATS, default="tif")
+    parser.add_argument(
+        "--resampling",
+        choices=rasterexport.RESAMPLING_METHODS,
+        default=rasterexport.RESAMPLING_NEAREST,
+    )
+    parser.add_argument(
+        "--compression",
+        choices=rasterexport.COG_COMPRESSIONS,
+        default="DEFLATE",
+        help="compression of the COG",
+    )
+    parser.add_argument(
+        "--pixel-size",
+        type=float,
+        default=None,
+        help="pixel size of the output in units of the CRS of the layers "
+        "(default: original resolution)",
+    )
+    parser.add_argument("--suffix", default="_georeferenced")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    args = parser.parse_args(argv)
+
+    jobs = readProject(args.project)
+    options = BatchOptions(
+        args.outputDir,
+        args.format,
+        args.resampling,
+        args.compression,
+        args.suffix,
+        region=rasterexport.ExportRegion(pixelSize=args.pixel_size),
+    )
+    start = time.monotonic()
+    results = []
+    for result in exportJobs(jobs, options, args.workers):
+        status = "OK" if result.error is None else "FAILED"
+        print("%s %s (%.2f s)" % (status, result.name, result.duration))
+        results.append(result)
+    print(summary(results, time.monotonic() - start))
+    return 1 if any(result.error is not None for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
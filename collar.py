@@ -0,0 +1,116 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Clip polygon of an image, in pixel coordinates: the part of a scanned sheet
+inside its collar (white margins or black scanner background), detected
+from the frame of the map or drawn by the user.
+"""
+
+import json
+
+import numpy as np
+
+from .alignment import similarityAround
+from .deskew import estimateSkew
+
+# pixels differing from the background by more than this are content
+TOLERANCE = 40
+# width of the border (fraction of the size) where the background is sampled
+BORDER_FRACTION = 0.02
+# rows / columns with at least this fraction of the densest one are frame
+LINE_FRACTION = 0.7
+# a frame within this fraction of the size from the border is not a collar
+MIN_COLLAR_FRACTION = 0.01
+
+
+def ringToJson(ring):
+    return json.dumps(np.asarray(ring, dtype=np.float64).tolist())
+
+
+def ringFromJson(text):
+    """
+    Ring stored with ringToJson, None if text is empty
+    """
+    if not text:
+        return None
+    ring = np.asarray(json.loads(text), dtype=np.float64).reshape(-1, 2)
+    if len(ring) < 3:
+        raise ValueError("A clip polygon needs at least 3 points")
+    return ring
+
+
+def densifyRing(ring, count):
+    """
+    Ring with count points per edge, to follow a non-affine mapping
+    """
+    ring = np.asarray(ring, dtype=np.float64)
+    t = np.linspace(0, 1, count, endpoint=False)[:, np.newaxis, np.newaxis]
+    points = ring + t * (np.roll(ring, -1, axis=0) - ring)
+    # edge by edge
+    return points.transpose(1, 0, 2).reshape(-1, 2)
+
+
+def _background(gray):
+    height, width = gray.shape
+    border = max(1, int(round(BORDER_FRACTION * min(height, width))))
+    samples = np.concatenate(
+        [
+            gray[:border].ravel(),
+            gray[-border:].ravel(),
+            gray[:, :border].ravel(),
+            gray[:, -border:].ravel(),
+        ]
+    )
+    return float(np.median(samples))
+
+
+def _frameLimits(profile):
+    """
+    (first, last) index of the rows or columns of the frame in a profile
+    """
+    lines = np.nonzero(profile >= LINE_FRACTION * profile.max())[0]
+    return lines[0], lines[-1] + 1
+
+
+def detectCollar(gray):
+    """
+    Ring (4, 2) of the map inside the collar of a scanned sheet, in the
+    coordinates of the gray image (a thumbnail), None if no collar is found.
+    The content (pixels differing from the background of the border) is
+    straightened by its skew, the frame is then given by the outermost
+    rows and columns dense in content: the neat line of a map on white paper
+    or the edges of the sheet on a black background
+    """
+    height, width = gray.shape
+    content = np.abs(gray - _background(gray)) > TOLERANCE
+    ys, xs = np.nonzero(content)
+    if len(xs) == 0:
+        return None
+    skew = estimateSkew(gray) or 0.0
+    straighten = similarityAround(-skew, 1.0, width / 2.0, height / 2.0)
+    us, vs = straighten.mapArrays(xs + 0.5, ys + 0.5)
+    rows = np.floor(vs).astype(np.int64)
+    cols = np.floor(us).astype(np.int64)
+    top, bottom = _frameLimits(np.bincount(rows - rows.min())) + rows.min()
+    left, right = _frameLimits(np.bincount(cols - cols.min())) + cols.min()
+
+    margin = MIN_COLLAR_FRACTION * min(width, height)
+    corners = np.array(
+        [(left, top), (right, top), (right, bottom), (left, bottom)], dtype=np.float64
+    )
+    ring = straighten.inverted().mapArray(corners)
+    if (
+        ring[:, 0].min() <= margin
+        and ring[:, 1].min() <= margin
+        and ring[:, 0].max() >= width - margin
+        and ring[:, 1].max() >= height - margin
+    ):
+        return None
+    return ring
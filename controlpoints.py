@@ -0,0 +1,109 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import math
+
+import numpy as np
+
+from .affine import AffineTransform
+from .warp import imageTransform, minimumPointCount, Warp
+
+
+class ControlPointFit(object):
+    """
+    Transform parameters of the layer solved from control points, with the
+    residual of each point (map units) for these parameters
+    """
+
+    def __init__(self, parameters, warp, transform, residuals):
+        # (centerX, centerY, rotation, xScale, yScale)
+        self.parameters = parameters
+        # warp.Warp fitted on the residuals of the parameters, or None
+        self.warp = warp
+        # pixel to map mapping (with the warp)
+        self.transform = transform
+        self.residuals = residuals
+        self.rmse = float(np.sqrt(np.mean(residuals * residuals)))
+
+
+class ControlPoints(object):
+    """
+    Pairs of a point of the image (pixel coordinates) and its position on the
+    map. The transform is solved by least squares on all the pairs: a
+    translation for 1 pair, a similarity for 2 pairs (or if not affine), an
+    affine transform from 3 pairs
+    """
+
+    def __init__(self):
+        self.pixelPoints = np.empty((0, 2))
+        self.mapPoints = np.empty((0, 2))
+
+    def __len__(self):
+        return len(self.pixelPoints)
+
+    def add(self, pixelPoint, mapPoint):
+        """
+        Returns the index of the new pair
+        """
+        self.pixelPoints = np.vstack([self.pixelPoints, pixelPoint])
+        self.mapPoints = np.vstack([self.mapPoints, mapPoint])
+        return len(self.pixelPoints) - 1
+
+    def setMapPoint(self, index, mapPoint):
+        self.mapPoints[index] = mapPoint
+
+    def remove(self, index):
+        self.pixelPoints = np.delete(self.pixelPoints, index, axis=0)
+        self.mapPoints = np.delete(self.mapPoints, index, axis=0)
+
+    def clear(self):
+        self.pixelPoints = np.empty((0, 2))
+        self.mapPoints = np.empty((0, 2))
+
+    def solve(self, transform, width, height, isAffine=False, warpMethod=None):
+        """
+        ControlPointFit from the current pixel to map transform of a width x
+        height image, None without points. The fitted correction is composed
+        with the current transform and expressed with the transform
+        parameters of the layer (an affine shear cannot be represented: it is
+        dropped). With a warpMethod (see warp.WARP_METHODS), a warp is then
+        fitted on what the parameters do not explain
+        """
+        count = len(self.pixelPoints)
+        if count == 0:
+            return None
+        if warpMethod is not None and count < minimumPointCount(warpMethod):
+            return None
+        current = transform.mapArray(self.pixelPoints)
+        try:
+            if count == 1:
+                dx, dy = self.mapPoints[0] - current[0]
+                correction = AffineTransform.translation(dx, dy)
+            elif count == 2 or not isAffine:
+                correction, _ = AffineTransform.fitSimilarity(current, self.mapPoints)
+            else:
+                correction, _ = AffineTransform.fit(current, self.mapPoints)
+            parameters = transform.compose(correction).parameters(width, height)
+        except (ValueError, np.linalg.LinAlgError):
+            return None
+        if not all(math.isfinite(value) for value in parameters):
+            return None
+        if parameters[3] == 0 or parameters[4] == 0:
+            return None
+        fitted = AffineTransform.fromParameters(*parameters, width, height)
+        warp = None
+        if warpMethod is not None:
+            # in pixels: where the points should be for the parameters
+            warpedPoints = fitted.inverted().mapArray(self.mapPoints)
+            warp = Warp(warpMethod, width, height, self.pixelPoints, warpedPoints)
+            fitted = imageTransform(fitted, warp)
+        residuals = np.hypot(*(fitted.mapArray(self.pixelPoints) - self.mapPoints).T)
+        return ControlPointFit(parameters, warp, fitted, residuals)
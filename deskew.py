@@ -0,0 +1,83 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Estimation of the skew of a scanned image: the dominant orientation of its
+lines (grid, frame, text) by projection profiles of the strongest edges.
+Only NumPy is needed.
+
+Angles are in degrees, clockwise with the y axis down (as the rotation of
+the layer).
+"""
+
+import numpy as np
+
+from .alignment import edgeMagnitude
+
+# searched skews in [-MAX_ANGLE, MAX_ANGLE]
+MAX_ANGLE = 5.0
+COARSE_STEP = 0.25
+FINE_STEP = 0.02
+# fraction of the pixels kept as edges
+EDGE_FRACTION = 0.1
+# edges are subsampled above this count
+MAX_POINTS = 20000
+MIN_POINTS = 100
+
+
+def edgePoints(gray):
+    """
+    (xs, ys): coordinates of the strongest edges of a gray image
+    """
+    edges = edgeMagnitude(gray)
+    threshold = np.quantile(edges, 1 - EDGE_FRACTION)
+    ys, xs = np.nonzero((edges > threshold) & (edges > 0))
+    stride = max(1, len(xs) // MAX_POINTS)
+    return xs[::stride].astype(np.float64), ys[::stride].astype(np.float64)
+
+
+def profileScores(xs, ys, angles):
+    """
+    Sharpness (sum of the squared bins) of the projection profiles of the
+    points along lines at each angle, horizontal and vertical profiles
+    summed: the lines of an image give sharp peaks once aligned
+    """
+    radians = np.radians(np.asarray(angles, dtype=np.float64))[:, np.newaxis]
+    cos, sin = np.cos(radians), np.sin(radians)
+    scores = np.zeros(len(angles))
+    # distance to the lines of direction angle, and to their normals
+    for projected in (ys * cos - xs * sin, xs * cos + ys * sin):
+        bins = np.rint(projected - projected.min(axis=1, keepdims=True)).astype(
+            np.int64
+        )
+        binCount = int(bins.max()) + 1
+        # 1 bincount for all the angles: offset the bins of each angle
+        offsets = np.arange(len(angles))[:, np.newaxis] * binCount
+        counts = np.bincount(
+            (bins + offsets).ravel(), minlength=len(angles) * binCount
+        ).reshape(len(angles), binCount)
+        scores += np.sum(counts.astype(np.float64) ** 2, axis=1)
+    return scores
+
+
+def estimateSkew(gray, maxAngle=MAX_ANGLE):
+    """
+    Angle of the dominant lines of a gray image in [-maxAngle, maxAngle]
+    (the image is straightened by a rotation of the opposite angle), coarse
+    then fine search. None if the image has too few edges
+    """
+    xs, ys = edgePoints(gray)
+    if len(xs) < MIN_POINTS:
+        return None
+    angles = np.arange(-maxAngle, maxAngle + COARSE_STEP / 2, COARSE_STEP)
+    best = angles[np.argmax(profileScores(xs, ys, angles))]
+    angles = np.arange(
+        best - COARSE_STEP, best + COARSE_STEP + FINE_STEP / 2, FINE_STEP
+    )
+    return float(angles[np.argmax(profileScores(xs, ys, angles))])
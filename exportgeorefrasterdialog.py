@@ -13,6 +13,7 @@ import os.path
 
 from PyQt5.QtWidgets import QDialog, QFileDialog, QMessageBox
 
+from . import rasterexport
 from .ui_exportgeorefrasterdialog import Ui_ExportGeorefRasterDialog
 
 
@@ -20,15 +21,26 @@ class ExportGeorefRasterDialog(QDialog, Ui_ExportGeorefRasterDialog):
     def __init__(self):
         QDialog.__init__(self)
         self.setupUi(self)
+        # warped or clipped layer: no VRT and no rotation in the world file
+        self.isResampledOnly = False
 
         self.pushButtonBrowse.clicked.connect(self.showBrowserDialog)
         self.checkBoxOnlyWorldFile.stateChanged.connect(self.setupOnlyWorldFile)
+        self.checkBoxRotationMode.stateChanged.connect(self.setupResampling)
+        self.checkBoxCog.stateChanged.connect(self.setupCog)
 
     def clear(self, layer):
+        self.isResampledOnly = layer.warp is not None or layer.clipRing is not None
         self.lineEditImagePath.setText("")
         self.checkBoxRotationMode.setChecked(False)
         self.checkBoxRotationMode.setEnabled(True)
         self.checkBoxOnlyWorldFile.setChecked(False)
+        self.checkBoxCog.setChecked(False)
+        self.checkBoxClipToCanvas.setChecked(False)
+        # in the units of the CRS of the layer
+        self.doubleSpinBoxPixelSize.setValue(0)
+        # keep the resampling method and compression chosen previously
+        self.setupCog()
 
         defaultPath, _ = os.path.splitext(layer.filepath)
         self.defaultPath = defaultPath + "_georeferenced.png"
@@ -47,18 +59,46 @@ class ExportGeorefRasterDialog(QDialog, Ui_ExportGeorefRasterDialog):
             )
             self.checkBoxRotationMode.setEnabled(True)
 
+    def setupCog(self):
+        # a COG is always resampled and georeferenced internally, the warp
+        # and the clip are applied by the resampling only
+        isResampled = self.checkBoxCog.isChecked() or self.isResampledOnly
+        if isResampled:
+            self.checkBoxOnlyWorldFile.setChecked(False)
+            self.checkBoxRotationMode.setChecked(False)
+        self.checkBoxOnlyWorldFile.setEnabled(not isResampled)
+        self.checkBoxRotationMode.setEnabled(not isResampled)
+        isCog = self.checkBoxCog.isChecked()
+        self.comboBoxCompression.setEnabled(isCog)
+        self.setupResampling()
+
+    def setupResampling(self):
+        # the image is not resampled if the rotation is in the world file
+        isResampled = not self.checkBoxRotationMode.isChecked()
+        self.comboBoxResampling.setEnabled(isResampled)
+        self.doubleSpinBoxPixelSize.setEnabled(isResampled)
+        self.checkBoxClipToCanvas.setEnabled(isResampled)
+
     def showBrowserDialog(self):
         if self.lineEditImagePath.text():
             filepathDialog = self.lineEditImagePath.text()
         else:
             filepathDialog = self.defaultPath
 
-        if not self.checkBoxOnlyWorldFile.isChecked():
+        if self.checkBoxCog.isChecked():
+            filepathDialog = os.path.splitext(filepathDialog)[0] + ".tif"
             filepath, _ = QFileDialog.getSaveFileName(
                 None,
                 "Export georeferenced raster",
                 filepathDialog,
-                "Images (*.png *.bmp *.jpg *.tif *.tiff)",
+                "GeoTIFF (*.tif *.tiff)",
+            )
+        elif not self.checkBoxOnlyWorldFile.isChecked():
+            filepath, _ = QFileDialog.getSaveFileName(
+                None,
+                "Export georeferenced raster",
+                filepathDialog,
+                "Images (*.png *.bmp *.jpg *.tif *.tiff);;GDAL VRT (*.vrt)",
             )
         else:
             filepath, _ = QFileDialog.getOpenFileName(
@@ -90,6 +130,17 @@ class ExportGeorefRasterDialog(QDialog, Ui_ExportGeorefRasterDialog):
 
         self.isPutRotationInWorldFile = self.checkBoxRotationMode.isChecked()
         self.isExportOnlyWorldFile = self.checkBoxOnlyWorldFile.isChecked()
+        # same order as the items of the combo box
+        self.resampling = rasterexport.RESAMPLING_METHODS[
+            self.comboBoxResampling.currentIndex()
+        ]
+        # 0 for the original resolution
+        self.pixelSize = self.doubleSpinBoxPixelSize.value() or None
+        self.isClipToCanvas = self.checkBoxClipToCanvas.isChecked()
+        self.isCog = self.checkBoxCog.isChecked()
+        self.compression = rasterexport.COG_COMPRESSIONS[
+            self.comboBoxCompression.currentIndex()
+        ]
 
         self.imagePath = self.lineEditImagePath.text()
         if not self.imagePath:
@@ -99,11 +150,29 @@ class ExportGeorefRasterDialog(QDialog, Ui_ExportGeorefRasterDialog):
         if result:
             _, extension = os.path.splitext(self.imagePath)
             extension = extension.lower()
-            if extension not in [".jpg", ".bmp", ".png", ".tif", ".tiff"]:
+            if extension not in [".jpg", ".bmp", ".png", ".tif", ".tiff", ".vrt"]:
                 result = False
                 if len(details) > 0:
                     details += "\n"
                 details += "The file must be an image"
+            elif self.isExportOnlyWorldFile and extension == ".vrt":
+                result = False
+                if len(details) > 0:
+                    details += "\n"
+                details += "A VRT already contains the georeferencing"
+            elif self.isResampledOnly and extension == ".vrt":
+                result = False
+                if len(details) > 0:
+                    details += "\n"
+                details += (
+                    "A warped or clipped layer can only be exported as a "
+                    "resampled raster"
+                )
+            elif self.isCog and extension not in [".tif", ".tiff"]:
+                result = False
+                if len(details) > 0:
+                    details += "\n"
+                details += "A Cloud-Optimized GeoTIFF must have a .tif extension"
 
         if not result:
             message = "There were errors in the form"
@@ -0,0 +1,196 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Footprints of all the plugin layers in a single vector layer, labeled with
+their titles and displayed at small scales only: an overview of hundreds of
+scans costs one vector layer instead of one raster per scan. Kept up to date
+layer by layer from transformParametersChanged.
+"""
+
+from functools import partial
+
+import numpy as np
+from PyQt5.QtCore import QVariant
+from qgis.core import (
+    QgsFeature,
+    QgsField,
+    QgsFillSymbol,
+    QgsGeometry,
+    QgsMessageLog,
+    QgsPalLayerSettings,
+    QgsPointXY,
+    QgsProject,
+    QgsVectorLayer,
+    QgsVectorLayerSimpleLabeling,
+)
+
+from .reprojection import CoordinateTransformCache, isPluginLayer, transformPoints
+
+# the footprints are displayed at scales smaller than 1:FOOTPRINTS_SCALE
+FOOTPRINTS_SCALE = 100000
+
+
+class FootprintsLayer(object):
+    """
+    Memory vector layer with one polygon (and the title) per plugin layer
+    of the project, in the CRS of the map when created. forgotten is called
+    when the layer is no longer maintained (hidden, removed by the user or
+    project closed)
+    """
+
+    def __init__(self, iface, forgotten=None):
+        self.iface = iface
+        self.forgotten = forgotten
+        self.layer = None
+        self.layerId = None
+        # plugin layer id: (feature id, slot connected to the layer)
+        self.features = {}
+        self.transformCache = CoordinateTransformCache()
+
+    def isShown(self):
+        return self.layerId is not None
+
+    def show(self, pluginLayers):
+        """
+        Creates the footprints layer with the footprints of pluginLayers
+        and adds it to the project
+        """
+        if self.isShown():
+            return
+        crs = self.iface.mapCanvas().mapSettings().destinationCrs()
+        layer = QgsVectorLayer("Polygon", "Raster footprints", "memory")
+        layer.setCrs(crs)
+        layer.dataProvider().addAttributes(
+            [QgsField("title", QVariant.String), QgsField("layerId", QVariant.String)]
+        )
+        layer.updateFields()
+        layer.renderer().setSymbol(
+            QgsFillSymbol.createSimple(
+                {"color": "0,0,0,0", "outline_color": "0,0,0", "outline_width": "0.4"}
+            )
+        )
+        labelSettings = QgsPalLayerSettings()
+        labelSettings.fieldName = "title"
+        layer.setLabeling(QgsVectorLayerSimpleLabeling(labelSettings))
+        layer.setLabelsEnabled(True)
+        layer.setScaleBasedVisibility(True)
+        layer.setMaximumScale(FOOTPRINTS_SCALE)
+        self.layer = layer
+        self.layerId = layer.id()
+        self.transformCache.clear()
+
+        for pluginLayer in pluginLayers:
+            self.addLayer(pluginLayer)
+        QgsProject.instance().addMapLayer(layer)
+        project = QgsProject.instance()
+        project.layersAdded.connect(self.layersAdded)
+        project.layerRemoved.connect(self.layerRemoved)
+        project.cleared.connect(self.forget)
+
+    def hide(self):
+        """
+        Removes the footprints layer from the project
+        """
+        if not self.isShown():
+            return
+        layerId = self.layerId
+        self.forget()
+        QgsProject.instance().removeMapLayer(layerId)
+
+    def forget(self):
+        """
+        Stops maintaining the footprints layer (removed or project cleared)
+        """
+        if not self.isShown():
+            return
+        project = QgsProject.instance()
+        project.layersAdded.disconnect(self.layersAdded)
+        project.layerRemoved.disconnect(self.layerRemoved)
+        project.cleared.disconnect(self.forget)
+        for layerId, (_, slot) in list(self.features.items()):
+            pluginLayer = project.mapLayer(layerId)
+            if pluginLayer is not None:
+                try:
+                    pluginLayer.transformParametersChanged.disconnect(slot)
+                except TypeError:
+                    pass
+        self.features = {}
+        self.layer = None
+        self.layerId = None
+        if self.forgotten is not None:
+            self.forgotten()
+
+    def layersAdded(self, layers):
+        for layer in layers:
+            if isPluginLayer(layer):
+                self.addLayer(layer)
+
+    def layerRemoved(self, layerId):
+        if layerId == self.layerId:
+            # removed by the user: the layer object is already deleted
+            self.layer = None
+            self.forget()
+        elif layerId in self.features:
+            featureId, _ = self.features.pop(layerId)
+            self.layer.dataProvider().deleteFeatures([featureId])
+            self.layer.triggerRepaint()
+
+    def addLayer(self, pluginLayer):
+        if pluginLayer.id() in self.features:
+            return
+        feature = QgsFeature(self.layer.fields())
+        feature.setAttributes([pluginLayer.title, pluginLayer.id()])
+        feature.setGeometry(self.geometry(pluginLayer))
+        ok, added = self.layer.dataProvider().addFeatures([feature])
+        if not ok:
+            return
+        slot = partial(self.updateLayer, pluginLayer)
+        pluginLayer.transformParametersChanged.connect(slot)
+        self.features[pluginLayer.id()] = (added[0].id(), slot)
+        self.layer.updateExtents()
+        self.layer.triggerRepaint()
+
+    def updateLayer(self, pluginLayer, parameters=None):
+        """
+        Updates the footprint of a single plugin layer
+        """
+        if self.layer is None or pluginLayer.id() not in self.features:
+            return
+        featureId, _ = self.features[pluginLayer.id()]
+        self.layer.dataProvider().changeGeometryValues(
+            {featureId: self.geometry(pluginLayer)}
+        )
+        self.layer.updateExtents()
+        self.layer.triggerRepaint()
+
+    def geometry(self, pluginLayer):
+        """
+        Footprint of a plugin layer in the CRS of the footprints layer,
+        empty if the layer is not loaded
+        """
+        pluginLayer.initializeLayer()
+        if not pluginLayer.initialized:
+            return QgsGeometry()
+        points = pluginLayer.footprintPolygon()
+        xs, ys = points[:, 0], points[:, 1]
+        if pluginLayer.crs().isValid() and pluginLayer.crs() != self.layer.crs():
+            transform = self.transformCache.transform(
+                pluginLayer.crs(), self.layer.crs()
+            )
+            try:
+                xs, ys = transformPoints(transform, xs, ys)
+            except Exception as ex:
+                QgsMessageLog.logMessage(repr(ex))
+                return QgsGeometry()
+        if not (np.all(np.isfinite(xs)) and np.all(np.isfinite(ys))):
+            return QgsGeometry()
+        return QgsGeometry.fromPolygonXY(
+            [[QgsPointXY(float(x), float(y)) for x, y in zip(xs, ys)]]
+        )
@@ -13,24 +13,42 @@ import os.path
 
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QIcon
-from PyQt5.QtWidgets import QAction, QDialog, QDoubleSpinBox
-from qgis.core import QgsApplication, QgsMapLayer, QgsProject
+from PyQt5.QtWidgets import QAction, QDialog, QDoubleSpinBox, QFileDialog, QInputDialog
+from qgis.core import (
+    Qgis,
+    QgsApplication,
+    QgsCoordinateTransform,
+    QgsMapLayer,
+    QgsProject,
+)
 
 from . import resources_rc  # noqa
+from .batchexport import BatchOptions
 from .exportgeorefrasterdialog import ExportGeorefRasterDialog
-from .freehandrastergeoreferencer_commands import ExportGeorefRasterCommand
+from .footprints import FootprintsLayer
+from .freehandrastergeoreferencer_commands import (
+    AutoAlignCommand,
+    ClipCommand,
+    DeskewCommand,
+    ExportGeorefRasterCommand,
+)
 from .freehandrastergeoreferencer_layer import (
     FreehandRasterGeoreferencerLayer,
     FreehandRasterGeoreferencerLayerType,
 )
 from .freehandrastergeoreferencer_maptools import (
     AdjustRasterMapTool,
+    ClipRasterMapTool,
     GeorefRasterBy2PointsMapTool,
+    GeorefRasterByPointsMapTool,
     MoveRasterMapTool,
     RotateRasterMapTool,
     ScaleRasterMapTool,
 )
+from .freehandrastergeoreferencer_processing import FreehandRasterGeoreferencerProvider
 from .freehandrastergeoreferencerdialog import FreehandRasterGeoreferencerDialog
+from .rasterexport import ExportRegion
+from .reprojection import LayersReprojector
 
 
 class FreehandRasterGeoreferencer(object):
@@ -111,6 +129,28 @@ class FreehandRasterGeoreferencer(object):
         self.actionGeoref2PRaster.triggered.connect(self.georef2PRaster)
         self.actionGeoref2PRaster.setCheckable(True)
 
+        self.actionGeorefPointsRaster = QAction(
+            QgsApplication.getThemeIcon("/mActionCapturePoint.svg"),
+            "Georeference raster with control points",
+            self.iface.mainWindow(),
+        )
+        self.actionGeorefPointsRaster.setObjectName(
+            "FreehandRasterGeoreferencingLayerPlugin_GeorefPointsRaster"
+        )
+        self.actionGeorefPointsRaster.triggered.connect(self.georefPointsRaster)
+        self.actionGeorefPointsRaster.setCheckable(True)
+
+        self.actionClipRaster = QAction(
+            QgsApplication.getThemeIcon("/mActionCapturePolygon.svg"),
+            "Clip raster with a polygon",
+            self.iface.mainWindow(),
+        )
+        self.actionClipRaster.setObjectName(
+            "FreehandRasterGeoreferencingLayerPlugin_ClipRaster"
+        )
+        self.actionClipRaster.triggered.connect(self.clipRaster)
+        self.actionClipRaster.setCheckable(True)
+
         self.actionIncreaseTransparency = QAction(
             QIcon(
                 ":/plugins/freehandrastergeoreferencer/" "iconTransparencyIncrease.png"
@@ -145,12 +185,69 @@ class FreehandRasterGeoreferencer(object):
         )
         self.actionUndo.triggered.connect(self.undo)
 
+        self.actionRedo = QAction(
+            QgsApplication.getThemeIcon("/mActionRedo.svg"),
+            "Redo",
+            self.iface.mainWindow(),
+        )
+        self.actionRedo.triggered.connect(self.redo)
+
+        self.actionReprojectLayers = QAction(
+            "Reproject all layers to the map CRS", self.iface.mainWindow()
+        )
+        self.actionReprojectLayers.triggered.connect(self.reprojectLayers)
+
+        self.actionBatchExport = QAction(
+            "Export all layers of the project...", self.iface.mainWindow()
+        )
+        self.actionBatchExport.triggered.connect(self.batchExportLayers)
+
+        self.actionAutoAlign = QAction(
+            "Align raster on a reference layer...", self.iface.mainWindow()
+        )
+        self.actionAutoAlign.triggered.connect(self.autoAlignLayer)
+
+        self.actionDetectCollar = QAction(
+            "Clip raster to its map frame (remove the collar)", self.iface.mainWindow()
+        )
+        self.actionDetectCollar.triggered.connect(self.detectCollar)
+
+        self.actionRemoveClip = QAction(
+            "Remove the clip polygon of the raster", self.iface.mainWindow()
+        )
+        self.actionRemoveClip.triggered.connect(self.removeClip)
+
+        self.actionFootprints = QAction(
+            "Show the footprints of all layers at small scales",
+            self.iface.mainWindow(),
+        )
+        self.actionFootprints.setCheckable(True)
+        self.actionFootprints.toggled.connect(self.toggleFootprints)
+
         # Add toolbar button and menu item for AddLayer
         self.iface.layerToolBar().addAction(self.actionAddLayer)
         self.iface.insertAddLayerAction(self.actionAddLayer)
         self.iface.addPluginToRasterMenu(
             FreehandRasterGeoreferencer.PLUGIN_MENU, self.actionAddLayer
         )
+        self.iface.addPluginToRasterMenu(
+            FreehandRasterGeoreferencer.PLUGIN_MENU, self.actionReprojectLayers
+        )
+        self.iface.addPluginToRasterMenu(
+            FreehandRasterGeoreferencer.PLUGIN_MENU, self.actionBatchExport
+        )
+        self.iface.addPluginToRasterMenu(
+            FreehandRasterGeoreferencer.PLUGIN_MENU, self.actionAutoAlign
+        )
+        self.iface.addPluginToRasterMenu(
+            FreehandRasterGeoreferencer.PLUGIN_MENU, self.actionDetectCollar
+        )
+        self.iface.addPluginToRasterMenu(
+            FreehandRasterGeoreferencer.PLUGIN_MENU, self.actionRemoveClip
+        )
+        self.iface.addPluginToRasterMenu(
+            FreehandRasterGeoreferencer.PLUGIN_MENU, self.actionFootprints
+        )
 
         self.spinBoxRotate = QDoubleSpinBox(self.iface.mainWindow())
         self.spinBoxRotate.setDecimals(3)
@@ -174,17 +271,36 @@ class FreehandRasterGeoreferencer(object):
         self.toolbar.addAction(self.actionScaleRaster)
         self.toolbar.addAction(self.actionAdjustRaster)
         self.toolbar.addAction(self.actionGeoref2PRaster)
+        self.toolbar.addAction(self.actionGeorefPointsRaster)
+        self.toolbar.addAction(self.actionClipRaster)
         self.toolbar.addAction(self.actionDecreaseTransparency)
         self.toolbar.addAction(self.actionIncreaseTransparency)
         self.toolbar.addAction(self.actionExport)
         self.toolbar.addAction(self.actionUndo)
+        self.toolbar.addAction(self.actionRedo)
+
+        # layers are displayed reprojected on the fly if their CRS is not the
+        # CRS of the map but are edited in the CRS of the map: reprojected on
+        # the first edit (see FreehandRasterGeoreferencerLayer.alignToMapCrs)
+        self.layersReprojector = LayersReprojector(self.iface)
 
         # Register plugin layer type
         self.layerType = FreehandRasterGeoreferencerLayerType(self)
         QgsApplication.pluginLayerRegistry().addPluginLayerType(self.layerType)
 
+        # algorithms usable in models and in batch mode
+        self.processingProvider = FreehandRasterGeoreferencerProvider()
+        QgsApplication.processingRegistry().addProvider(self.processingProvider)
+
         self.dialogAddLayer = FreehandRasterGeoreferencerDialog()
         self.dialogExportGeorefRaster = ExportGeorefRasterDialog()
+        self.exportCommand = ExportGeorefRasterCommand(self.iface)
+        self.autoAlignCommand = AutoAlignCommand(self.iface)
+        self.deskewCommand = DeskewCommand(self.iface)
+        self.clipCommand = ClipCommand(self.iface)
+        self.footprints = FootprintsLayer(
+            self.iface, lambda: self.actionFootprints.setChecked(False)
+        )
 
         self.moveTool = MoveRasterMapTool(self.iface)
         self.moveTool.setAction(self.actionMoveRaster)
@@ -196,6 +312,10 @@ class FreehandRasterGeoreferencer(object):
         self.adjustTool.setAction(self.actionAdjustRaster)
         self.georef2PTool = GeorefRasterBy2PointsMapTool(self.iface)
         self.georef2PTool.setAction(self.actionGeoref2PRaster)
+        self.georefPointsTool = GeorefRasterByPointsMapTool(self.iface)
+        self.georefPointsTool.setAction(self.actionGeorefPointsRaster)
+        self.clipTool = ClipRasterMapTool(self.iface)
+        self.clipTool.setAction(self.actionClipRaster)
         self.currentTool = None
 
         # default state for toolbar
@@ -213,9 +333,32 @@ class FreehandRasterGeoreferencer(object):
         QgsApplication.pluginLayerRegistry().removePluginLayerType(
             FreehandRasterGeoreferencerLayer.LAYER_TYPE
         )
+        QgsApplication.processingRegistry().removeProvider(self.processingProvider)
 
         QgsProject.instance().layerRemoved.disconnect(self.layerRemoved)
+        self.iface.removePluginRasterMenu(
+            FreehandRasterGeoreferencer.PLUGIN_MENU, self.actionReprojectLayers
+        )
+        self.iface.removePluginRasterMenu(
+            FreehandRasterGeoreferencer.PLUGIN_MENU, self.actionBatchExport
+        )
+        self.iface.removePluginRasterMenu(
+            FreehandRasterGeoreferencer.PLUGIN_MENU, self.actionAutoAlign
+        )
+        self.iface.removePluginRasterMenu(
+            FreehandRasterGeoreferencer.PLUGIN_MENU, self.actionDetectCollar
+        )
+        self.iface.removePluginRasterMenu(
+            FreehandRasterGeoreferencer.PLUGIN_MENU, self.actionRemoveClip
+        )
+        self.iface.removePluginRasterMenu(
+            FreehandRasterGeoreferencer.PLUGIN_MENU, self.actionFootprints
+        )
+        # the footprints layer stays in the project but is no longer updated
+        self.footprints.forget()
         self.iface.currentLayerChanged.disconnect(self.currentLayerChanged)
+        self.exportCommand.cancelTasks()
+        self.deskewCommand.cancelTasks()
 
         del self.toolbar
 
@@ -239,21 +382,30 @@ class FreehandRasterGeoreferencer(object):
             self.actionScaleRaster.setEnabled(True)
             self.actionAdjustRaster.setEnabled(True)
             self.actionGeoref2PRaster.setEnabled(True)
+            self.actionGeorefPointsRaster.setEnabled(True)
+            self.actionClipRaster.setEnabled(True)
             self.actionDecreaseTransparency.setEnabled(True)
             self.actionIncreaseTransparency.setEnabled(True)
             self.actionExport.setEnabled(True)
+            self.actionAutoAlign.setEnabled(True)
+            self.actionDetectCollar.setEnabled(True)
+            self.actionRemoveClip.setEnabled(True)
             self.spinBoxRotate.setEnabled(True)
             self.spinBoxRotateValueSetValue(layer.rotation)
             try:
                 # self.layer is the previously selected layer
                 # in case it was a FRGR layer, disconnect the spinBox
-                self.layer.transformParametersChanged.disconnect()
+                self.layer.transformParametersChanged.disconnect(
+                    self.spinBoxRotateUpdate
+                )
+                self.layer.historyChanged.disconnect(self.updateUndoActions)
             except Exception:
                 pass
             layer.transformParametersChanged.connect(self.spinBoxRotateUpdate)
+            layer.historyChanged.connect(self.updateUndoActions)
             self.dialogAddLayer.toolButtonAdvanced.setEnabled(True)
-            self.actionUndo.setEnabled(True)
             self.layer = layer
+            self.updateUndoActions()
 
             if self.currentTool:
                 self.currentTool.reset()
@@ -264,18 +416,26 @@ class FreehandRasterGeoreferencer(object):
             self.actionScaleRaster.setEnabled(False)
             self.actionAdjustRaster.setEnabled(False)
             self.actionGeoref2PRaster.setEnabled(False)
+            self.actionGeorefPointsRaster.setEnabled(False)
+            self.actionClipRaster.setEnabled(False)
             self.actionDecreaseTransparency.setEnabled(False)
             self.actionIncreaseTransparency.setEnabled(False)
             self.actionExport.setEnabled(False)
+            self.actionAutoAlign.setEnabled(False)
+            self.actionDetectCollar.setEnabled(False)
+            self.actionRemoveClip.setEnabled(False)
             self.spinBoxRotate.setEnabled(False)
             self.spinBoxRotateValueSetValue(0)
             try:
-                self.layer.transformParametersChanged.disconnect()
+                self.layer.transformParametersChanged.disconnect(
+                    self.spinBoxRotateUpdate
+                )
+                self.layer.historyChanged.disconnect(self.updateUndoActions)
             except Exception:
                 pass
             self.dialogAddLayer.toolButtonAdvanced.setEnabled(False)
-            self.actionUndo.setEnabled(False)
             self.layer = None
+            self.updateUndoActions()
 
             if self.currentTool:
                 self.currentTool.reset()
@@ -315,6 +475,8 @@ class FreehandRasterGeoreferencer(object):
             QgsProject.instance().addMapLayer(layer)
             self.layers[layer.id()] = layer
             self.iface.setActiveLayer(layer)
+            if self.dialogAddLayer.checkBoxDeskew.isChecked() and layer.placedByDefault:
+                self.deskewCommand.deskew(layer)
 
     def _toggleTool(self, tool):
         if self.currentTool is tool:
@@ -348,6 +510,24 @@ class FreehandRasterGeoreferencer(object):
     def georef2PRaster(self):
         self._toggleTool(self.georef2PTool)
 
+    def georefPointsRaster(self):
+        self._toggleTool(self.georefPointsTool)
+
+    def clipRaster(self):
+        self._toggleTool(self.clipTool)
+
+    def detectCollar(self):
+        self.clipCommand.detectCollar(self.iface.activeLayer())
+
+    def removeClip(self):
+        self.clipCommand.removeClip(self.iface.activeLayer())
+
+    def toggleFootprints(self, checked):
+        if checked:
+            self.footprints.show(self.layersReprojector.pluginLayers())
+        else:
+            self.footprints.hide()
+
     def increaseTransparency(self):
         layer = self.iface.activeLayer()
         # clamp to 100
@@ -362,28 +542,127 @@ class FreehandRasterGeoreferencer(object):
 
     def exportGeorefRaster(self):
         layer = self.iface.activeLayer()
+        # export reads the transform parameters of the layer
+        layer.flushTransformParameters()
         self.dialogExportGeorefRaster.clear(layer)
         self.dialogExportGeorefRaster.show()
         result = self.dialogExportGeorefRaster.exec_()
         if result == 1:
-            exportCommand = ExportGeorefRasterCommand(self.iface)
-            exportCommand.exportGeorefRaster(
+            # runs in the background
+            self.exportCommand.exportGeorefRaster(
                 layer,
                 self.dialogExportGeorefRaster.imagePath,
                 self.dialogExportGeorefRaster.isPutRotationInWorldFile,
                 self.dialogExportGeorefRaster.isExportOnlyWorldFile,
+                self.dialogExportGeorefRaster.resampling,
+                self.dialogExportGeorefRaster.isCog,
+                self.dialogExportGeorefRaster.compression,
+                self.exportRegion(layer),
+            )
+
+    def exportRegion(self, layer):
+        # extent in the CRS of the layer
+        extent = None
+        if self.dialogExportGeorefRaster.isClipToCanvas:
+            mapSettings = self.iface.mapCanvas().mapSettings()
+            canvasExtent = mapSettings.visibleExtent()
+            if mapSettings.destinationCrs() != layer.crs():
+                transform = QgsCoordinateTransform(
+                    mapSettings.destinationCrs(), layer.crs(), QgsProject.instance()
+                )
+                canvasExtent = transform.transformBoundingBox(canvasExtent)
+            extent = (
+                canvasExtent.xMinimum(),
+                canvasExtent.yMinimum(),
+                canvasExtent.xMaximum(),
+                canvasExtent.yMaximum(),
             )
+        return ExportRegion(self.dialogExportGeorefRaster.pixelSize, extent)
+
+    def autoAlignLayer(self):
+        layer = self.iface.activeLayer()
+        root = QgsProject.instance().layerTreeRoot()
+        references = [
+            treeLayer.layer()
+            for treeLayer in root.findLayers()
+            if treeLayer.layer() is not None
+            and treeLayer.layer().type() != QgsMapLayer.PluginLayer
+        ]
+        if not references:
+            self.iface.messageBar().pushMessage(
+                "Raster Geoferencer", "No reference layer", Qgis.Info, 2
+            )
+            return
+        names = [reference.name() for reference in references]
+        name, ok = QInputDialog.getItem(
+            self.iface.mainWindow(),
+            "Align raster",
+            "Reference layer (e.g. an orthophoto)",
+            names,
+            0,
+            False,
+        )
+        if not ok:
+            return
+        self._resetCurrentTool(layer)
+        self.autoAlignCommand.autoAlign(layer, [references[names.index(name)]])
+
+    def reprojectLayers(self):
+        mapCrs = self.iface.mapCanvas().mapSettings().destinationCrs()
+        self.layersReprojector.reprojectLayers(
+            self.layersReprojector.pluginLayers(), mapCrs
+        )
+
+    def batchExportLayers(self):
+        layers = [
+            layer
+            for layer in self.layersReprojector.pluginLayers()
+            if layer.initialized
+        ]
+        if not layers:
+            self.iface.messageBar().pushMessage(
+                "Raster Geoferencer", "No layer to export", Qgis.Info, 2
+            )
+            return
+
+        outputDir = QFileDialog.getExistingDirectory(
+            self.iface.mainWindow(), "Export all layers to directory"
+        )
+        if not outputDir:
+            return
+        formats = [
+            ("GeoTIFF", "tif"),
+            ("Cloud-Optimized GeoTIFF", "cog"),
+            ("VRT (references the original rasters)", "vrt"),
+        ]
+        item, ok = QInputDialog.getItem(
+            self.iface.mainWindow(),
+            "Export all layers",
+            "Format",
+            [name for name, _ in formats],
+            0,
+            False,
+        )
+        if not ok:
+            return
+        rasterFormat = dict(formats)[item]
+
+        for layer in layers:
+            # export reads the transform parameters of the layer
+            layer.flushTransformParameters()
+        # each export uses all the cores
+        options = BatchOptions(outputDir, rasterFormat, threadCount=None)
+        self.exportCommand.batchExport(layers, options)
 
     def spinBoxRotateUpdate(self, newParameters):
         self.spinBoxRotateValueSetValue(self.layer.rotation)
 
     def spinBoxRotateValueChangeEvent(self, val):
         layer = self.layer
-        layer.history.append(
-            {"action": "rotation", "rotation": layer.rotation, "center": layer.center}
-        )
+        layer.alignToMapCrs()
+        # successive steps of the spinbox are undone together
+        layer.pushHistory("rotationSpinBox")
         layer.setRotation(val)
-        layer.repaint()
         layer.commitTransformParameters()
 
     def spinBoxRotateValueSetValue(self, val):
@@ -401,27 +680,21 @@ class FreehandRasterGeoreferencer(object):
 
     def undo(self):
         layer = self.iface.activeLayer()
+        self._resetCurrentTool(layer)
+        layer.undo()
+
+    def redo(self):
+        layer = self.iface.activeLayer()
+        self._resetCurrentTool(layer)
+        layer.redo()
+
+    def updateUndoActions(self):
+        # enabled only if there is something to undo / redo
+        layer = self.layer
+        self.actionUndo.setEnabled(layer is not None and layer.history.canUndo())
+        self.actionRedo.setEnabled(layer is not None and layer.history.canRedo())
+
+    def _resetCurrentTool(self, layer):
         if self.currentTool:
             self.currentTool.reset()  # for clear 2point rubberband
             self.currentTool.setLayer(layer)
-        if len(layer.history) > 0:
-            act = layer.history.pop()
-            if act["action"] == "move":
-                layer.setCenter(act["center"])
-            elif act["action"] == "scale":
-                layer.setScale(act["xScale"], act["yScale"])
-            elif act["action"] == "rotation":
-                layer.setRotation(act["rotation"])
-                layer.setCenter(act["center"])
-            elif act["action"] == "adjust":
-                layer.setCenter(act["center"])
-                layer.setScale(act["xScale"], act["yScale"])
-            elif act["action"] == "2pointsA":
-                layer.setCenter(act["center"])
-            elif act["action"] == "2pointsB":
-                layer.setRotation(act["rotation"])
-                layer.setCenter(act["center"])
-                layer.setScale(act["xScale"], act["yScale"])
-                layer.setScale(act["xScale"], act["yScale"])
-            layer.repaint()
-            layer.commitTransformParameters()
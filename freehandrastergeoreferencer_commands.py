@@ -11,164 +11,657 @@
 
 import math
 import os
+import time
 
-from PyQt5.QtCore import qDebug, QPointF, QRectF, QSize
-from PyQt5.QtGui import QColor, QImage, QImageWriter, QPainter
-from qgis.core import Qgis, QgsMessageLog
+import numpy as np
+from PyQt5.QtCore import QSize, Qt
+from PyQt5.QtGui import QColor, QImage, QImageWriter
+from PyQt5.QtWidgets import QApplication
+from qgis.core import (
+    Qgis,
+    QgsApplication,
+    QgsCoordinateReferenceSystem,
+    QgsMapRendererSequentialJob,
+    QgsMapSettings,
+    QgsMessageLog,
+    QgsPointXY,
+    QgsProject,
+    QgsRectangle,
+    QgsTask,
+)
 from qgis.gui import QgsMessageBar
 
-from . import utils
+from . import alignment, batchexport, collar, deskew, rasterexport, utils
+from .affine import AffineTransform
+from .qimagesource import imageSourceRaster
 
 
-class ExportGeorefRasterCommand(object):
-    def __init__(self, iface):
-        self.iface = iface
+def snapshotSourceRaster(snapshot):
+    """
+    Source of the pixels to export: read by windows from the file if
+    possible (with the alpha mask of the layer), otherwise the image loaded
+    in the layer (already masked)
+    """
+    filepath = snapshot.filepath
+    if rasterexport.GdalSourceRaster.isSupported(
+        filepath, snapshot.width, snapshot.height
+    ):
+        source = rasterexport.GdalSourceRaster(filepath)
+        if snapshot.alphaMask is not None:
+            source = rasterexport.MaskedSourceRaster(source, snapshot.alphaMask)
+        return source
+    return imageSourceRaster(snapshot.image)
 
-    def exportGeorefRaster(
-        self, layer, rasterPath, isPutRotationInWorldFile, isExportOnlyWorldFile
+
+class ExportSnapshot(object):
+    """
+    State of a layer used by the export, taken on the GUI thread so the
+    export can run in the background while the layer is edited
+    """
+
+    def __init__(self, layer):
+        self.filepath = layer.getAbsoluteFilepath()
+        # implicitly shared: no copy of the pixels
+        self.image = QImage(layer.image)
+        self.width = layer.image.width()
+        self.height = layer.image.height()
+        # AffineTransform, or warp.WarpedTransform if the layer is warped
+        self.transform = layer.imageTransform()
+        self.isWarped = layer.warp is not None
+        # clip polygon of the image (pixel coordinates), None if not clipped
+        self.clipRing = layer.clipRing
+        # alphamask.AlphaMask of the layer, None if none
+        self.alphaMask = layer.alphaMask
+        self.crs = QgsCoordinateReferenceSystem(layer.crs())
+
+
+class GeorefRasterExport(object):
+    """
+    Export of a layer snapshot with the options of the export dialog,
+    independent of the GUI
+    """
+
+    def __init__(
+        self,
+        snapshot,
+        rasterPath,
+        isPutRotationInWorldFile,
+        isExportOnlyWorldFile,
+        resampling=rasterexport.RESAMPLING_NEAREST,
+        isCog=False,
+        compression="DEFLATE",
+        region=None,
     ):
-        baseRasterFilePath, _ = os.path.splitext(rasterPath)
+        self.snapshot = snapshot
+        self.rasterPath = rasterPath
+        self.isPutRotationInWorldFile = isPutRotationInWorldFile
+        self.isExportOnlyWorldFile = isExportOnlyWorldFile
+        self.resampling = resampling
+        self.isCog = isCog
+        self.compression = compression
+        # rasterexport.ExportRegion (pixel size and clip) of resampled exports
+        self.region = region
+        self.feedback = None
+        self.worldFilePath = None
+
+    def run(self, feedback=None):
+        """
+        feedback: object with setProgress and isCanceled (QgsTask,
+        QgsFeedback). Raises rasterexport.ExportCanceled if canceled
+        """
+        self.feedback = feedback
+        snapshot = self.snapshot
+        rasterPath = self.rasterPath
         # suppose supported format already checked
         rasterFormat = utils.imageFormat(rasterPath)
+        if snapshot.isWarped and (
+            rasterFormat == "vrt"
+            or self.isPutRotationInWorldFile
+            or self.isExportOnlyWorldFile
+        ):
+            raise ValueError(
+                "A warped layer can only be exported as a resampled raster"
+            )
+        if snapshot.clipRing is not None and (
+            rasterFormat == "vrt"
+            or self.isPutRotationInWorldFile
+            or self.isExportOnlyWorldFile
+        ):
+            # the clip is applied by the resampling only
+            raise ValueError(
+                "A clipped layer can only be exported as a resampled raster"
+            )
 
-        try:
-            originalWidth = layer.image.width()
-            originalHeight = layer.image.height()
-            radRotation = layer.rotation * math.pi / 180
-
-            if isPutRotationInWorldFile or isExportOnlyWorldFile:
-                # keep the image as is and put all transformation params
-                # in world file
-                img = layer.image
-
-                a = layer.xScale * math.cos(radRotation)
-                # sin instead of -sin because angle in CW
-                b = -layer.yScale * math.sin(radRotation)
-                d = layer.xScale * -math.sin(radRotation)
-                e = -layer.yScale * math.cos(radRotation)
-                c = layer.center.x() - (
-                    a * (originalWidth - 1) / 2 + b * (originalHeight - 1) / 2
-                )
-                f = layer.center.y() - (
-                    d * (originalWidth - 1) / 2 + e * (originalHeight - 1) / 2
-                )
+        if rasterFormat == "vrt":
+            # no pixel written: references the original raster
+            rasterexport.exportVrt(
+                snapshot.filepath,
+                rasterPath,
+                snapshot.transform,
+                snapshot.crs.toWkt(),
+            )
+        elif self.isCog:
+            # georeferencing and CRS embedded in the GeoTIFF
+            grid = rasterexport.outputGrid(
+                snapshot.transform,
+                snapshot.width,
+                snapshot.height,
+                self.region,
+                snapshot.clipRing,
+            )
+            rasterexport.exportCog(
+                self.sourceRaster(),
+                snapshot.transform,
+                grid,
+                rasterPath,
+                snapshot.crs.toWkt(),
+                self.resampling,
+                self.compression,
+                feedback=self.feedback,
+            )
+        else:
+            self.exportRasterAndWorldFile(rasterPath, rasterFormat)
+
+    def exportRasterAndWorldFile(self, rasterPath, rasterFormat):
+        snapshot = self.snapshot
+        if self.isPutRotationInWorldFile or self.isExportOnlyWorldFile:
+            # keep the image as is and put all transformation params
+            # in world file
+            img = snapshot.image
+            a, d, b, e, c, f = snapshot.transform.toWorldFile()
+
+        else:
+            # transform the image with rotation and scaling between the
+            # axes: streamed block by block through GDAL
+            transform = snapshot.transform
+            grid = rasterexport.outputGrid(
+                transform,
+                snapshot.width,
+                snapshot.height,
+                self.region,
+                snapshot.clipRing,
+            )
+            a, d, b, e, c, f = AffineTransform.fromGdal(grid.geotransform).toWorldFile()
 
+        if not self.isExportOnlyWorldFile:
+            # export image
+            if self.isPutRotationInWorldFile:
+                self.saveImage(img, rasterPath, rasterFormat)
             else:
-                # transform the image with rotation and scaling between the
-                # axes
-                # maintain at least the original resolution of the raster
-                ratio = layer.xScale / layer.yScale
-                if ratio > 1:
-                    # increase x
-                    scaleX = ratio
-                    scaleY = 1
-                else:
-                    # increase y
-                    scaleX = 1
-                    scaleY = 1.0 / ratio
-
-                width = abs(scaleX * originalWidth * math.cos(radRotation)) + abs(
-                    scaleY * originalHeight * math.sin(radRotation)
-                )
-                height = abs(scaleX * originalWidth * math.sin(radRotation)) + abs(
-                    scaleY * originalHeight * math.cos(radRotation)
+                rasterexport.exportGeorefRaster(
+                    self.sourceRaster(),
+                    transform,
+                    grid,
+                    rasterPath,
+                    rasterFormat,
+                    snapshot.crs.toWkt(),
+                    self.resampling,
+                    feedback=self.feedback,
                 )
 
-                qDebug("wh %f,%f" % (width, height))
+        self.worldFilePath = rasterexport.writeWorldFile(
+            rasterPath, rasterFormat, (a, d, b, e, c, f)
+        )
+        rasterexport.writeAuxFile(
+            rasterPath, snapshot.crs.toWkt(), snapshot.crs.isGeographic()
+        )
 
-                img = QImage(
-                    QSize(math.ceil(width), math.ceil(height)), QImage.Format_ARGB32
-                )
-                # transparent background
-                img.fill(QColor(0, 0, 0, 0))
+    def saveImage(self, img, rasterPath, rasterFormat):
+        if rasterFormat == "tif":
+            writer = QImageWriter()
+            # use LZW compression for tiff
+            # useful for scanned documents (mostly white)
+            writer.setCompression(1)
+            writer.setFormat(b"TIFF")
+            writer.setFileName(rasterPath)
+            writer.write(img)
+        else:
+            img.save(rasterPath, rasterFormat)
 
-                painter = QPainter(img)
-                painter.setRenderHint(QPainter.Antialiasing, True)
-                # painter.setRenderHint(QPainter.SmoothPixmapTransform, True)
+    def sourceRaster(self):
+        return snapshotSourceRaster(self.snapshot)
 
-                rect = QRectF(
-                    QPointF(-layer.image.width() / 2.0, -layer.image.height() / 2.0),
-                    QPointF(layer.image.width() / 2.0, layer.image.height() / 2.0),
-                )
 
-                painter.translate(QPointF(width / 2.0, height / 2.0))
-                painter.rotate(layer.rotation)
-                painter.scale(scaleX, scaleY)
-                painter.drawImage(rect, layer.image)
-                painter.end()
-
-                extent = layer.extent()
-                a = extent.width() / width
-                e = -extent.height() / height
-                # 2nd term because (0,0) of world file is on center of upper
-                # left pixel instead of upper left corner of that pixel
-                c = extent.xMinimum() + a / 2
-                f = extent.yMaximum() + e / 2
-                b = d = 0.0
-
-            if not isExportOnlyWorldFile:
-                # export image
-                if rasterFormat == "tif":
-                    writer = QImageWriter()
-                    # use LZW compression for tiff
-                    # useful for scanned documents (mostly white)
-                    writer.setCompression(1)
-                    writer.setFormat(b"TIFF")
-                    writer.setFileName(rasterPath)
-                    writer.write(img)
-                else:
-                    img.save(rasterPath, rasterFormat)
-
-            worldFilePath = baseRasterFilePath + "."
-            if rasterFormat == "jpg":
-                worldFilePath += "jgw"
-            elif rasterFormat == "png":
-                worldFilePath += "pgw"
-            elif rasterFormat == "bmp":
-                worldFilePath += "bpw"
-            elif rasterFormat == "tif":
-                worldFilePath += "tfw"
-
-            with open(worldFilePath, "w") as writer:
-                # order is as described at
-                # http://webhelp.esri.com/arcims/9.3/General/topics/author_world_files.htm
-                writer.write(
-                    "%.13f\n%.13f\n%.13f\n%.13f\n%.13f\n%.13f" % (a, d, b, e, c, f)
-                )
+class ExportGeorefRasterCommand(object):
+    def __init__(self, iface):
+        self.iface = iface
+        # keep a reference to the running tasks (else garbage collected)
+        self.tasks = []
 
-            crsFilePath = rasterPath + ".aux.xml"
-            with open(crsFilePath, "w") as writer:
-                writer.write(
-                    self.auxContent(
-                        self.iface.mapCanvas().mapSettings().destinationCrs()
-                    )
-                )
+    def exportGeorefRaster(
+        self,
+        layer,
+        rasterPath,
+        isPutRotationInWorldFile,
+        isExportOnlyWorldFile,
+        resampling=rasterexport.RESAMPLING_NEAREST,
+        isCog=False,
+        compression="DEFLATE",
+        region=None,
+    ):
+        """
+        Starts the export as a background task
+        """
+        task = ExportGeorefRasterTask(
+            self.iface,
+            ExportSnapshot(layer),
+            rasterPath,
+            isPutRotationInWorldFile,
+            isExportOnlyWorldFile,
+            resampling,
+            isCog,
+            compression,
+            region,
+        )
+        task.taskCompleted.connect(lambda: self._removeTask(task))
+        task.taskTerminated.connect(lambda: self._removeTask(task))
+        self.tasks.append(task)
+        QgsApplication.taskManager().addTask(task)
+        return task
+
+    def batchExport(self, layers, options):
+        """
+        Exports all the layers with the same options (BatchOptions) in a
+        background task
+        """
+        jobs = [batchexport.BatchJob.fromLayer(layer) for layer in layers]
+        task = BatchExportTask(self.iface, jobs, options)
+        task.taskCompleted.connect(lambda: self._removeTask(task))
+        task.taskTerminated.connect(lambda: self._removeTask(task))
+        self.tasks.append(task)
+        QgsApplication.taskManager().addTask(task)
+        return task
+
+    def _removeTask(self, task):
+        if task in self.tasks:
+            self.tasks.remove(task)
+
+    def cancelTasks(self):
+        for task in list(self.tasks):
+            task.cancel()
+
+
+class ExportGeorefRasterTask(QgsTask):
+    def __init__(
+        self,
+        iface,
+        snapshot,
+        rasterPath,
+        isPutRotationInWorldFile,
+        isExportOnlyWorldFile,
+        resampling,
+        isCog,
+        compression,
+        region=None,
+    ):
+        QgsTask.__init__(
+            self,
+            "Export georeferenced raster %s" % os.path.basename(rasterPath),
+            QgsTask.CanCancel,
+        )
+        self.iface = iface
+        self.export = GeorefRasterExport(
+            snapshot,
+            rasterPath,
+            isPutRotationInWorldFile,
+            isExportOnlyWorldFile,
+            resampling,
+            isCog,
+            compression,
+            region,
+        )
+        self.exception = None
+
+    def run(self):
+        # in a background thread: no access to the layer or the GUI
+        try:
+            self.export.run(feedback=self)
+            return True
+        except rasterexport.ExportCanceled:
+            return False
+        except Exception as ex:
+            self.exception = ex
+            return False
 
+    def finished(self, result):
+        if result:
             widget = QgsMessageBar.createMessage(
                 "Raster Geoferencer", "Raster exported successfully."
             )
             self.iface.messageBar().pushWidget(widget, Qgis.Info, 2)
-        except Exception as ex:
-            QgsMessageLog.logMessage(repr(ex))
+        elif self.exception is not None:
+            QgsMessageLog.logMessage(repr(self.exception))
             widget = QgsMessageBar.createMessage(
                 "Raster Geoferencer",
                 "There was an error performing this command. "
                 "See QGIS Message log for details.",
             )
             self.iface.messageBar().pushWidget(widget, Qgis.Critical, 5)
+        else:
+            widget = QgsMessageBar.createMessage(
+                "Raster Geoferencer", "Raster export canceled."
+            )
+            self.iface.messageBar().pushWidget(widget, Qgis.Info, 2)
+
+
+class BatchExportTask(QgsTask):
+    """
+    Batch export inside QGIS: the layers are exported one after the other,
+    each export using all the cores (a process pool cannot be used from
+    QGIS)
+    """
+
+    def __init__(self, iface, jobs, options):
+        QgsTask.__init__(
+            self, "Export %d georeferenced rasters" % len(jobs), QgsTask.CanCancel
+        )
+        self.iface = iface
+        self.jobs = jobs
+        self.options = options
+        self.results = []
+        self.duration = 0
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            os.makedirs(self.options.outputDir, exist_ok=True)
+            paths = batchexport.outputPaths(self.jobs, self.options)
+            count = len(self.jobs)
+            for i, (job, path) in enumerate(zip(self.jobs, paths)):
+                feedback = rasterexport.SubFeedback(
+                    self, 100.0 * i / count, 100.0 * (i + 1) / count
+                )
+                feedback.checkCanceled()
+                self.results.append(
+                    batchexport.exportJob(job, path, self.options, feedback)
+                )
+            return True
+        except rasterexport.ExportCanceled:
+            return False
+        finally:
+            self.duration = time.monotonic() - start
+
+    def finished(self, result):
+        summary = batchexport.summary(self.results, self.duration)
+        QgsMessageLog.logMessage(summary)
+        message = summary.splitlines()[0]
+        if not result:
+            message = "Batch export canceled. " + message
+        if any(result.error is not None for result in self.results):
+            widget = QgsMessageBar.createMessage(
+                "Raster Geoferencer",
+                message + ". See QGIS Message log for details.",
+            )
+            self.iface.messageBar().pushWidget(widget, Qgis.Warning, 5)
+        else:
+            widget = QgsMessageBar.createMessage("Raster Geoferencer", message + ".")
+            self.iface.messageBar().pushWidget(widget, Qgis.Info, 5)
+
+
+class DeskewTask(QgsTask):
+    """
+    Estimates in the background the skew of the image of a new layer, then
+    rotates the layer to straighten it unless it was moved in the meantime
+    """
+
+    def __init__(self, layer):
+        QgsTask.__init__(self, "Deskew %s" % layer.name(), QgsTask.CanCancel)
+        self.layer = layer
+        self.layerId = layer.id()
+        self.parameters = self.layerParameters()
+        # the image must not be read in the background: the cached thumbnail
+        # of the layer (same aspect ratio, so the same skew) is read now
+        thumbnail, _, _ = layer.thumbnailImage()
+        self.gray = alignment.toGray(
+            imageSourceRaster(thumbnail).read(
+                0, 0, thumbnail.width(), thumbnail.height()
+            )
+        )
+        self.skew = None
+        self.exception = None
+
+    def layerParameters(self):
+        layer = self.layer
+        return (
+            layer.center.x(),
+            layer.center.y(),
+            layer.rotation,
+            layer.xScale,
+            layer.yScale,
+        )
+
+    def run(self):
+        try:
+            self.skew = deskew.estimateSkew(self.gray)
+            return not self.isCanceled()
+        except Exception as ex:
+            self.exception = ex
+            return False
+
+    def finished(self, result):
+        if self.exception is not None:
+            QgsMessageLog.logMessage(repr(self.exception))
+        if not result or self.skew is None or self.skew == 0:
+            return
+        if QgsProject.instance().mapLayer(self.layerId) is not self.layer:
+            return
+        if self.layerParameters() != self.parameters:
+            return
+        self.layer.pushHistory()
+        self.layer.setRotation(self.layer.rotation - self.skew)
+        self.layer.commitTransformParameters()
+        self.layer.showStatusMessage(
+            "Deskewed %s by %.2f degrees" % (self.layer.name(), -self.skew), 5000
+        )
+
+
+class DeskewCommand(object):
+    def __init__(self, iface):
+        self.iface = iface
+        # keep a reference to the running tasks (else garbage collected)
+        self.tasks = []
+
+    def deskew(self, layer):
+        task = DeskewTask(layer)
+        task.taskCompleted.connect(lambda: self._removeTask(task))
+        task.taskTerminated.connect(lambda: self._removeTask(task))
+        self.tasks.append(task)
+        QgsApplication.taskManager().addTask(task)
+        return task
+
+    def _removeTask(self, task):
+        if task in self.tasks:
+            self.tasks.remove(task)
+
+    def cancelTasks(self):
+        for task in list(self.tasks):
+            task.cancel()
+
+
+def renderLayers(layers, gridTransform, width, height, crs):
+    """
+    RGBA pixels (height, width, 4) of the layers rendered on the north-up
+    grid gridTransform (AffineTransform, pixel to map in crs)
+    """
+    xMin, yMax = gridTransform.map(0, 0)
+    xMax, yMin = gridTransform.map(width, height)
+    settings = QgsMapSettings()
+    settings.setLayers(layers)
+    settings.setDestinationCrs(crs)
+    settings.setTransformContext(QgsProject.instance().transformContext())
+    settings.setOutputSize(QSize(width, height))
+    settings.setExtent(QgsRectangle(xMin, yMin, xMax, yMax))
+    settings.setBackgroundColor(QColor(0, 0, 0, 0))
+    job = QgsMapRendererSequentialJob(settings)
+    job.start()
+    job.waitForFinished()
+    image = job.renderedImage()
+    return imageSourceRaster(image).read(0, 0, image.width(), image.height())
+
+
+def sampleLayer(layer, gridTransform, width, height):
+    """
+    RGBA pixels (height, width, 4) of the image of a layer (with its
+    transform and warp) resampled on the grid gridTransform (pixel to map
+    in the CRS of the layer), read from the cached thumbnail of the layer if
+    the grid is coarser than the thumbnail, else from a decimated image
+    """
+    pixelSize = math.hypot(gridTransform.a, gridTransform.d)
+    transform = layer.imageTransform()
+    thumbnail, xFactor, yFactor = layer.thumbnailImage()
+    imagePixelSize = max(
+        math.hypot(transform.a, transform.d), math.hypot(transform.b, transform.e)
+    )
+    if pixelSize * min(xFactor, yFactor) >= imagePixelSize:
+        # the thumbnail is detailed enough: no full resolution copy
+        source = imageSourceRaster(thumbnail)
+        transform = transform.compose(
+            AffineTransform(1.0 / xFactor, 0.0, 0.0, 0.0, 1.0 / yFactor, 0.0),
+            first=True,
+        )
+    else:
+        source, transform = rasterexport.overviewSource(
+            imageSourceRaster(layer.image), transform, pixelSize
+        )
+    xs, ys = gridTransform.mapArrays(
+        *np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+    )
+    us, vs = transform.inverted().mapArrays(xs, ys)
+    return rasterexport.samplePixels(source, us, vs, rasterexport.RESAMPLING_BILINEAR)
+
+
+class AutoAlignCommand(object):
+    """
+    Aligns a layer on reference layers: the references are rendered around
+    the footprint of the layer, the layer is resampled on the same grid and
+    the similarity between both is estimated by phase correlation
+    """
+
+    # side in pixels of the rendered images
+    RENDER_SIZE = 512
+    # margin around the footprint (fraction of its size) so the layer can move
+    MARGIN = 0.25
+    # below this correlation peak, the match is not reliable
+    MIN_RESPONSE = 0.02
+
+    def __init__(self, iface):
+        self.iface = iface
+
+    def alignmentGrid(self, layer):
+        """
+        North-up square grid (AffineTransform) around the footprint of the
+        layer
+        """
+        extent = layer.extent()
+        size = max(extent.width(), extent.height()) * (1 + 2 * self.MARGIN)
+        pixelSize = size / self.RENDER_SIZE
+        center = extent.center()
+        return AffineTransform(
+            pixelSize,
+            0.0,
+            center.x() - size / 2,
+            0.0,
+            -pixelSize,
+            center.y() + size / 2,
+        )
+
+    def autoAlign(self, layer, referenceLayers):
+        """
+        Moves, rotates and scales the layer on the references (one undo
+        step). Returns False if no reliable match was found
+        """
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            gridTransform = self.alignmentGrid(layer)
+            size = self.RENDER_SIZE
+            reference = renderLayers(
+                referenceLayers, gridTransform, size, size, layer.crs()
+            )
+            moving = sampleLayer(layer, gridTransform, size, size)
+            transform, response = alignment.align(
+                alignment.toGray(reference), alignment.toGray(moving)
+            )
+        except Exception as ex:
+            QgsMessageLog.logMessage(repr(ex))
+            self.iface.messageBar().pushMessage(
+                "Raster Geoferencer",
+                "Alignment failed. See QGIS Message log for details.",
+                Qgis.Critical,
+                5,
+            )
+            return False
+        finally:
+            QApplication.restoreOverrideCursor()
+
+        if response < self.MIN_RESPONSE:
+            self.iface.messageBar().pushMessage(
+                "Raster Geoferencer",
+                "No reliable match found with the reference layers "
+                "(correlation %.3f)." % response,
+                Qgis.Warning,
+                5,
+            )
+            return False
+
+        # from the pixels of the grid to the map
+        correction = gridTransform.inverted().compose(transform).compose(gridTransform)
+        centerX, centerY, rotation, xScale, yScale = (
+            layer.affineTransform()
+            .compose(correction)
+            .parameters(layer.image.width(), layer.image.height())
+        )
+        layer.pushHistory()
+        layer.setCenter(QgsPointXY(centerX, centerY))
+        layer.setRotation(rotation)
+        layer.setScale(xScale, yScale)
+        layer.commitTransformParameters()
+        self.iface.messageBar().pushMessage(
+            "Raster Geoferencer",
+            "Layer aligned (correlation %.3f)." % response,
+            Qgis.Info,
+            3,
+        )
+        return True
+
+
+class ClipCommand(object):
+    """
+    Clip polygon of a layer detected from the frame of the map (see
+    collar.py), on the thumbnail of the layer (cached, bounded size)
+    """
+
+    def __init__(self, iface):
+        self.iface = iface
+
+    def detectCollar(self, layer):
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            thumbnail, xFactor, yFactor = layer.thumbnailImage()
+            pixels = imageSourceRaster(thumbnail).read(
+                0, 0, thumbnail.width(), thumbnail.height()
+            )
+            ring = collar.detectCollar(alignment.toGray(pixels))
+        except Exception as ex:
+            QgsMessageLog.logMessage(repr(ex))
+            self.iface.messageBar().pushMessage(
+                "Raster Geoferencer",
+                "Collar detection failed. See QGIS Message log for details.",
+                Qgis.Critical,
+                5,
+            )
+            return
+        finally:
+            QApplication.restoreOverrideCursor()
+        if ring is None:
+            self.iface.messageBar().pushMessage(
+                "Raster Geoferencer", "No collar detected.", Qgis.Info, 3
+            )
+            return
+        # from the thumbnail to the image
+        ring /= (xFactor, yFactor)
+        layer.setClipRing(ring)
+        layer.repaint()
 
-    def auxContent(self, crs):
-        content = """<PAMDataset>
-  <Metadata domain="xml:ESRI" format="xml">
-    <GeodataXform xsi:type="typens:IdentityXform" 
-      xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
-      xmlns:xs="http://www.w3.org/2001/XMLSchema" 
-      xmlns:typens="http://www.esri.com/schemas/ArcGIS/9.2">
-      <SpatialReference xsi:type="typens:%sCoordinateSystem">
-        <WKT>%s</WKT>
-      </SpatialReference>
-    </GeodataXform>
-  </Metadata>
-</PAMDataset>"""  # noqa
-        geogOrProj = "Geographic" if crs.isGeographic() else "Projected"
-        return content % (geogOrProj, crs.toWkt())
+    def removeClip(self, layer):
+        layer.setClipRing(None)
+        layer.repaint()
@@ -9,6 +9,7 @@
  ***************************************************************************/
 """
 
+from collections import OrderedDict
 import math
 import os
 
@@ -23,8 +24,18 @@ from PyQt5.QtCore import (
     QSettings,
     QSize,
     Qt,
+    QTimer,
 )
-from PyQt5.QtGui import QColor, QImage, QImageReader, QPainter, QPen
+from PyQt5.QtGui import (
+    QColor,
+    QImage,
+    QImageReader,
+    QPainter,
+    QPainterPath,
+    QPen,
+    QPolygonF,
+)
+from PyQt5.QtWidgets import QDialog
 from qgis.core import (
     Qgis,
     QgsCoordinateReferenceSystem,
@@ -41,7 +52,33 @@ from qgis.core import (
 )
 
 from . import gdal_utils, utils
+from .affine import AffineTransform
+from .alphamask import AlphaMask, MASK_GDAL
+from .collar import densifyRing, ringFromJson, ringToJson
+from .history import TransformHistory, TransformSnapshot
 from .loaderrordialog import LoadErrorDialog
+from .reprojection import crsKey, transformPoints
+from .stretch import QuantizedBand, Stretch
+from .uniformtiles import tileStarts, transparentTiles
+from .warp import imageTransform, Warp
+from .warpmesh import mapToPixelTransform, WarpMesh
+
+
+def imageFromBands(pixels):
+    """
+    QImage (gray or RGB) of 8-bit pixels (bands, h, w) with 1 or 3 bands
+    """
+    nbands, height, width = pixels.shape
+    # band at the end
+    pixels = np.ascontiguousarray(np.transpose(pixels, [1, 2, 0]))
+    if nbands == 1:
+        # monochrome
+        format = QImage.Format_Grayscale8
+    else:
+        format = QImage.Format_RGB888
+    image = QImage(pixels, width, height, nbands * width, format)
+    # copy: the QImage does not own the numpy buffer
+    return image.copy()
 
 
 class LayerDefaultSettings:
@@ -53,6 +90,25 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
 
     LAYER_TYPE = "FreehandRasterGeoreferencerLayer"
     transformParametersChanged = pyqtSignal(tuple)
+    # a change was recorded, undone or redone
+    historyChanged = pyqtSignal()
+    # number of points per side of the image for reprojection
+    REPROJECTION_GRID_SIZE = 9
+    # number of cells per side of the mesh for reprojection on the fly
+    WARP_MESH_SIZE = 16
+    # same for a layer with a warp (polynomial, thin plate spline)
+    WARPED_MESH_SIZE = 32
+    # points per edge of the clip polygon drawn through the mesh
+    CLIP_RING_DENSITY = 8
+    # largest side of the decimated image drawn while a stretch is edited
+    PREVIEW_SIZE = 2048
+    # memory of the preview images kept for the last stretches (bytes)
+    PREVIEW_CACHE_BYTES = 64 * 1024 * 1024
+    # largest side (pixels) of the thumbnail drawn in place of the image
+    # when the image is displayed smaller than that
+    THUMBNAIL_SIZE = 512
+    # below this displayed size (device pixels), only the outline is drawn
+    OUTLINE_ONLY_SIZE = 8
 
     def __init__(self, plugin, filepath, title, screenExtent):
         QgsPluginLayer.__init__(
@@ -64,7 +120,7 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
         self.title = title
         self.filepath = filepath
         self.screenExtent = screenExtent
-        self.history = []
+        self.history = TransformHistory(utils.undoLimit())
         # set custom properties
         self.setCustomProperty("title", title)
         self.setCustomProperty("filepath", self.filepath)
@@ -79,12 +135,53 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
         self.rotation = 0.0
         self.xScale = 1.0
         self.yScale = 1.0
-
+        # non-affine correction of the image (warp.Warp), None if affine
+        self.warp = None
+        # incremented on each change of the warp (key of the mesh cache)
+        self._warpVersion = 0
+        # clip polygon of the image ((N, 2) array of pixel coordinates, see
+        # collar.py), None if the whole image is drawn
+        self.clipRing = None
+        self._clipPath = None
+        # transparent pixels (alphamask.AlphaMask), None if opaque. The image
+        # displayed is the image loaded with the mask in its alpha channel
+        self.alphaMask = None
+        self.unmaskedImage = None
+        # bands of a high bit depth raster (stretch.QuantizedBand), None for
+        # an 8-bit image, displayed with the stretch (stretch.Stretch)
+        self.rawBands = None
+        self.stretch = None
+        # stretch being edited, drawn on a decimated level of the rawBands
+        # (the full resolution image is computed once, by setStretch)
+        self.previewStretch = None
+        # (stretch, step, image cache key): preview QImage
+        self._previewCache = OrderedDict()
+        self._previewCacheBytes = 0
+        # (image cache key, step, alpha of the image decimated by step)
+        self._previewAlpha = None
+        # fully transparent tiles of the image, skipped when drawing:
+        # (image cache key, {(row starts, col starts): tiles}, opaque path)
+        self._tilesCache = None
+        # (image cache key, thumbnail) drawn when zoomed out
+        self._thumbnailCache = None
+
+        # commits of the transform parameters are deferred to the next turn
+        # of the event loop (see commitTransformParameters)
+        self._extent = None
+        self._warpMeshCache = None
+        self._commitPending = False
+        self._repaintPending = False
+        self._commitTimer = QTimer()
+        self._commitTimer.setSingleShot(True)
+        self._commitTimer.setInterval(0)
+        self._commitTimer.timeout.connect(self.flushTransformParameters)
+
+        # True if placed on the screen extent (no georeferencing in the file)
+        self.placedByDefault = False
         self.error = False
         self.initializing = False
         self.initialized = False
         self.initializeLayer(screenExtent)
-        self._extent = None
 
         self.provider = FreehandRasterGeoreferencerLayerProvider(self)
 
@@ -96,6 +193,7 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
     def setScale(self, xScale, yScale):
         self.xScale = xScale
         self.yScale = yScale
+        self._extent = None
 
     def setRotation(self, rotation):
         # 3 decimals ought to be enough for everybody
@@ -106,13 +204,335 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
         if rotation > 180:
             rotation -= 360
         self.rotation = rotation
+        self._extent = None
 
     def setCenter(self, center):
         self.center = center
+        self._extent = None
 
-    def commitTransformParameters(self):
+    def setWarp(self, warp):
+        """
+        Sets the warp (None to remove it), stored immediately in the custom
+        properties. The caller commits the transform parameters
+        """
+        self.warp = warp
+        self._warpVersion += 1
+        self._extent = None
+        if warp is None:
+            self.removeCustomProperty("warp")
+        else:
+            self.setCustomProperty("warp", warp.toJson())
+
+    def setClipRing(self, ring):
+        """
+        Sets the clip polygon of the image (pixel coordinates, None to remove
+        it), stored immediately in the custom properties
+        """
+        self.clipRing = None if ring is None else np.asarray(ring, dtype=np.float64)
+        self._clipPath = None
+        QgsProject.instance().setDirty(True)
+        # the footprint changes
+        self.commitTransformParameters(repaint=False)
+        if ring is None:
+            self.removeCustomProperty("clipRing")
+        else:
+            self.setCustomProperty("clipRing", ringToJson(self.clipRing))
+
+    def setAlphaMask(self, alphaMask):
+        """
+        Sets the transparent pixels (None for none), stored immediately in
+        the custom properties, and computes the image to display
+        """
+        self.alphaMask = alphaMask
+        if alphaMask is None:
+            self.removeCustomProperty("alphaMask")
+        else:
+            self.setCustomProperty("alphaMask", alphaMask.toJson())
         QgsProject.instance().setDirty(True)
+        if self.initialized:
+            self.applyAlphaMask()
+            self.repaint()
+
+    def setStretch(self, stretch):
+        """
+        Sets the stretch of a high bit depth raster, stored immediately in
+        the custom properties, and computes the image to display (once, at
+        full resolution: see setPreviewStretch while the stretch is edited)
+        """
+        self.previewStretch = None
+        self.stretch = stretch
+        self.setCustomProperty("stretch", stretch.toJson())
+        QgsProject.instance().setDirty(True)
+        if self.initialized and self.rawBands is not None:
+            self.unmaskedImage = self.stretchedImage()
+            self.applyAlphaMask()
+            self.repaint()
+
+    def stretchedImage(self):
+        """
+        8-bit image of the rawBands with the stretch (from the minimum to the
+        maximum of each band if not set)
+        """
+        if self.stretch is None or len(self.stretch.minimums) != len(self.rawBands):
+            self.stretch = Stretch.fromBands(self.rawBands)
+        return imageFromBands(self.stretch.apply(self.rawBands))
+
+    def setPreviewStretch(self, stretch):
+        """
+        Draws the layer with stretch (None to stop) without computing the
+        full resolution image: only a decimated level of the rawBands,
+        whose size does not depend on the size of the raster
+        """
+        if self.rawBands is None:
+            return
+        self.previewStretch = stretch
+        if stretch is None:
+            self._previewCache.clear()
+            self._previewCacheBytes = 0
+            self._previewAlpha = None
+        self.repaint()
+
+    def previewImage(self, deviceScale):
+        """
+        RGBA QImage of the rawBands with the previewStretch, decimated by a
+        power of 2 so that it is at most PREVIEW_SIZE and not finer than
+        displayed. Cached per stretch and level, bounded in bytes
+        """
+        width, height = self.image.width(), self.image.height()
+        step = max(
+            1,
+            math.ceil(max(width, height) / self.PREVIEW_SIZE),
+            int(1 / deviceScale),
+        )
+        # powers of 2: the levels are reused while zooming
+        step = 2 ** math.ceil(math.log2(step))
+        key = (self.previewStretch.toJson(), step, self.image.cacheKey())
+        image = self._previewCache.pop(key, None)
+        if image is None:
+            pixels = self.previewStretch.apply(self.rawBands, step)
+            rgba = np.empty(pixels.shape[1:] + (4,), dtype=np.uint8)
+            rgba[..., :3] = np.transpose(pixels, [1, 2, 0])
+            rgba[..., 3] = 255
+            if self.alphaMask is not None:
+                gdalMask = None
+                if self.alphaMask.method == MASK_GDAL:
+                    # the GDAL mask does not depend on the stretch: alpha of
+                    # the image displayed
+                    gdalMask = self.decimatedAlpha(step)
+                self.alphaMask.applyTo(rgba, gdalMask)
+            image = QImage(
+                rgba,
+                rgba.shape[1],
+                rgba.shape[0],
+                4 * rgba.shape[1],
+                QImage.Format_RGBA8888,
+            ).copy()
+            self._previewCacheBytes += image.bytesPerLine() * image.height()
+        self._previewCache[key] = image
+        while (
+            self._previewCacheBytes > self.PREVIEW_CACHE_BYTES
+            and len(self._previewCache) > 1
+        ):
+            _, dropped = self._previewCache.popitem(last=False)
+            self._previewCacheBytes -= dropped.bytesPerLine() * dropped.height()
+        return image
+
+    def decimatedAlpha(self, step):
+        """
+        Alpha channel of the image decimated by step (computed once per
+        image and step)
+        """
+        key = self.image.cacheKey()
+        if self._previewAlpha is None or self._previewAlpha[:2] != (key, step):
+            alpha = self.image.convertToFormat(QImage.Format_Alpha8)
+            bits = alpha.constBits()
+            bits.setsize(alpha.bytesPerLine() * alpha.height())
+            array = np.frombuffer(bits, dtype=np.uint8).reshape(
+                alpha.height(), alpha.bytesPerLine()
+            )[:, : alpha.width()]
+            self._previewAlpha = (key, step, array[::step, ::step].copy())
+        return self._previewAlpha[2]
+
+    def applyAlphaMask(self):
+        """
+        Image to display: the image loaded with the transparent pixels in
+        its alpha channel, computed once (vectorized) so drawing it costs a
+        plain premultiplied ARGB blit
+        """
+        if self.alphaMask is None or self.unmaskedImage is None:
+            self.image = self.unmaskedImage
+            return
+        # bytes in R, G, B, A order whatever the byte order of the platform
+        image = self.unmaskedImage.convertToFormat(QImage.Format_RGBA8888)
+        width, height = image.width(), image.height()
+        bits = image.bits()
+        bits.setsize(image.bytesPerLine() * height)
+        pixels = np.frombuffer(bits, dtype=np.uint8).reshape(
+            height, image.bytesPerLine()
+        )
+        pixels = pixels[:, : width * 4].reshape(height, width, 4)
+        gdalMask = None
+        if self.alphaMask.method == MASK_GDAL:
+            gdalMask = gdal_utils.mask(self.getAbsoluteFilepath())
+            if gdalMask is not None and gdalMask.shape != (height, width):
+                gdalMask = None
+        self.alphaMask.applyTo(pixels, gdalMask)
+        self.image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+
+    def clipPath(self):
+        """
+        QPainterPath of the clip polygon in pixel coordinates (cached), None
+        if the image is not clipped
+        """
+        if self.clipRing is None:
+            return None
+        if self._clipPath is None:
+            path = QPainterPath()
+            path.addPolygon(QPolygonF([QPointF(u, v) for u, v in self.clipRing]))
+            path.closeSubpath()
+            self._clipPath = path
+        return self._clipPath
+
+    def _imageTilesCache(self):
+        key = self.image.cacheKey()
+        if self._tilesCache is None or self._tilesCache[0] != key:
+            self._tilesCache = (key, {}, [])
+        return self._tilesCache
+
+    def transparentTiles(self, rowStarts, colStarts):
+        """
+        Boolean array (rows, cols) of the fully transparent tiles of the image
+        split at rowStarts and colStarts (see uniformtiles), None if the
+        image has no alpha channel. Computed once per image and split
+        """
+        if not self.image.hasAlphaChannel():
+            return None
+        _, tiles, _ = self._imageTilesCache()
+        key = (tuple(rowStarts), tuple(colStarts))
+        if key not in tiles:
+            image = self.image
+            if image.format() != QImage.Format_ARGB32_Premultiplied:
+                # transparent pixels are 0
+                image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+            width, height = image.width(), image.height()
+            bits = image.constBits()
+            bits.setsize(image.bytesPerLine() * height)
+            argb = np.frombuffer(bits, dtype=np.uint32).reshape(
+                height, image.bytesPerLine() // 4
+            )[:, :width]
+            tiles[key] = transparentTiles(argb, rowStarts, colStarts)
+        return tiles[key]
+
+    def opaqueTilesRect(self):
+        """
+        QRectF (pixel coordinates) bounding the tiles of the image that are
+        not fully transparent, None if there is no transparent tile: only
+        this part of the image is drawn, so the transparent margins of a
+        scan are not blended (a rectangle keeps the fast path of the clip)
+        """
+        _, _, rects = self._imageTilesCache()
+        if not rects:
+            rowStarts = tileStarts(self.image.height())
+            colStarts = tileStarts(self.image.width())
+            tiles = self.transparentTiles(rowStarts, colStarts)
+            rect = None
+            if tiles is not None and tiles.all():
+                rect = QRectF()
+            elif tiles is not None and tiles.any():
+                rows = np.flatnonzero(~tiles.all(axis=1))
+                cols = np.flatnonzero(~tiles.all(axis=0))
+                rowEnds = np.append(rowStarts[1:], self.image.height())
+                colEnds = np.append(colStarts[1:], self.image.width())
+                rect = QRectF(
+                    QPointF(colStarts[cols[0]], rowStarts[rows[0]]),
+                    QPointF(colEnds[cols[-1]], rowEnds[rows[-1]]),
+                )
+            rects.append(rect)
+        return rects[0]
+
+    def displayImage(self, deviceScale):
+        """
+        (image, xFactor, yFactor): image to draw at deviceScale device pixels
+        per pixel of the image, and its size relative to the image. When the
+        image is displayed smaller than THUMBNAIL_SIZE, its thumbnail
+        (computed once) is drawn, so zoomed out the cost does not depend on
+        the size of the scan. While a stretch is edited, its preview is
+        drawn. None if the image is too small on screen to be drawn (only
+        the outline)
+        """
+        width, height = self.image.width(), self.image.height()
+        displayedSize = max(width, height) * deviceScale
+        if displayedSize < self.OUTLINE_ONLY_SIZE:
+            return None
+        if self.previewStretch is not None:
+            preview = self.previewImage(deviceScale)
+            return preview, preview.width() / width, preview.height() / height
+        if displayedSize > self.THUMBNAIL_SIZE:
+            return self.image, 1.0, 1.0
+        return self.thumbnailImage()
+
+    def thumbnailImage(self):
+        """
+        (image, xFactor, yFactor): the image reduced to THUMBNAIL_SIZE
+        (computed once per image, the image itself if not larger) and its
+        size relative to the image
+        """
+        width, height = self.image.width(), self.image.height()
+        if max(width, height) <= self.THUMBNAIL_SIZE:
+            return self.image, 1.0, 1.0
+        key = self.image.cacheKey()
+        if self._thumbnailCache is None or self._thumbnailCache[0] != key:
+            thumbnail = self.image.scaled(
+                self.THUMBNAIL_SIZE,
+                self.THUMBNAIL_SIZE,
+                Qt.KeepAspectRatio,
+                Qt.SmoothTransformation,
+            )
+            self._thumbnailCache = (key, thumbnail)
+        thumbnail = self._thumbnailCache[1]
+        return thumbnail, thumbnail.width() / width, thumbnail.height() / height
+
+    def footprintPolygon(self):
+        """
+        Outline of the displayed part of the image in map coordinates of the
+        layer, (N, 2) array: the clip polygon if any, else the outline of
+        the (warped) image
+        """
+        transform = self.imageTransform()
+        if self.clipRing is not None:
+            ring = self.clipRing
+            if self.warp is not None:
+                ring = densifyRing(ring, self.CLIP_RING_DENSITY)
+            return transform.mapArray(ring)
+        if self.warp is not None:
+            return transform.boundary()
+        return transform.corners(self.image.width(), self.image.height())
+
+    def commitTransformParameters(self, repaint=True):
+        """
+        Schedules the commit of the transform parameters (custom properties,
+        transformParametersChanged signal and repaint) for the next turn of
+        the event loop: all the changes made in the same turn are committed
+        only once. If repaint is False, the caller takes care of refreshing
+        the map
+        """
         self._extent = None
+        self._commitPending = True
+        self._repaintPending = self._repaintPending or repaint
+        if not self._commitTimer.isActive():
+            self._commitTimer.start()
+
+    def flushTransformParameters(self):
+        """
+        Commits immediately the pending transform parameters, if any. To be
+        called before the custom properties are read (save, export...)
+        """
+        self._commitTimer.stop()
+        if not self._commitPending:
+            return
+        self._commitPending = False
+
+        QgsProject.instance().setDirty(True)
         self.setCustomProperty("xScale", self.xScale)
         self.setCustomProperty("yScale", self.yScale)
         self.setCustomProperty("rotation", self.rotation)
@@ -121,57 +541,108 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
         self.transformParametersChanged.emit(
             (self.xScale, self.yScale, self.rotation, self.center)
         )
+        if self._repaintPending:
+            self._repaintPending = False
+            self.repaint()
 
-    def reprojectTransformParameters(self, oldCrs, newCrs):
-        transform = QgsCoordinateTransform(oldCrs, newCrs, QgsProject.instance())
+    def pushHistory(self, mergeKey=None):
+        """
+        To be called before changing the transform parameters so the change
+        can be undone
+        """
+        self.history.push(TransformSnapshot.fromLayer(self), mergeKey)
+        self.historyChanged.emit()
 
-        newCenter = transform.transform(self.center)
-        newExtent = transform.transform(self.extent())
+    def undo(self):
+        return self._restore(self.history.undo(TransformSnapshot.fromLayer(self)))
 
-        # transform the parameters except rotation
-        # TODO rotation could be better handled (maybe check rotation between
-        # old and new extent)
-        # but not really worth the effort ?
-        self.setCrs(newCrs)
-        self.setCenter(newCenter)
-        self.resetScale(newExtent.width(), newExtent.height())
+    def redo(self):
+        return self._restore(self.history.redo(TransformSnapshot.fromLayer(self)))
 
-    def resetTransformParametersToNewCrs(self):
+    def _restore(self, snapshot):
+        if snapshot is None:
+            return False
+        snapshot.applyTo(self)
+        self.commitTransformParameters()
+        self.historyChanged.emit()
+        return True
+
+    def alignToMapCrs(self):
         """
-        Attempts to keep the layer on the same region of the map when
-        the map CRS is changed
+        Reprojects the transform parameters to the CRS of the map before the
+        first edit made on the map (undoable). Returns True if reprojected
         """
-        oldCrs = self.crs()
-        newCrs = self.iface.mapCanvas().mapSettings().destinationCrs()
-        self.reprojectTransformParameters(oldCrs, newCrs)
+        mapCrs = self.iface.mapCanvas().mapSettings().destinationCrs()
+        if not self.initialized or self.crs() == mapCrs:
+            return False
+        self.reprojectTransformParameters(self.crs(), mapCrs)
         self.commitTransformParameters()
+        self.showBarMessage(
+            "Layer reprojected",
+            "The transform parameters of the layer have been reprojected to the "
+            "CRS of the map for editing (undo to go back to its CRS).",
+            Qgis.Info,
+            5,
+        )
+        return True
 
-    def setupCrsEvents(self):
-        layerId = self.id()
+    def reprojectTransformParameters(self, oldCrs, newCrs):
+        transform = QgsCoordinateTransform(oldCrs, newCrs, QgsProject.instance())
+        xs, ys = self.footprintPoints()
+        newXs, newYs = transformPoints(transform, xs, ys)
+        return self.applyReprojectedFootprint(newCrs, newXs, newYs)
 
-        def removeCrsChangeHandler(layerIds):
-            if layerId in layerIds:
-                try:
-                    self.iface.mapCanvas().destinationCrsChanged.disconnect(
-                        self.resetTransformParametersToNewCrs
-                    )
-                except Exception:
-                    pass
-                try:
-                    QgsProject.instance().disconnect(removeCrsChangeHandler)
-                except Exception:
-                    pass
-
-        self.iface.mapCanvas().destinationCrsChanged.connect(
-            self.resetTransformParametersToNewCrs
+    def footprintPixels(self):
+        """
+        Grid of pixel coordinates covering the image, used to compute the
+        transform parameters in another CRS
+        """
+        n = FreehandRasterGeoreferencerLayer.REPROJECTION_GRID_SIZE
+        us, vs = np.meshgrid(
+            np.linspace(0, self.image.width(), n),
+            np.linspace(0, self.image.height(), n),
         )
-        QgsProject.instance().layersRemoved.connect(removeCrsChangeHandler)
+        return us.ravel(), vs.ravel()
 
-    def setupCrs(self):
-        mapCrs = self.iface.mapCanvas().mapSettings().destinationCrs()
-        self.setCrs(mapCrs)
+    def footprintPoints(self):
+        """
+        Map coordinates of the footprintPixels, to be reprojected and passed
+        to applyReprojectedFootprint
+        """
+        return self.pixelToMap(*self.footprintPixels())
+
+    def applyReprojectedFootprint(self, newCrs, xs, ys):
+        """
+        Sets the transform parameters from the footprint reprojected to
+        newCrs (least squares fit of the affine transform), undoable.
+        Returns the root mean square of the residuals (in map units of
+        newCrs)
+        """
+        pixels = np.column_stack(self.footprintPixels())
+        transform, residuals = AffineTransform.fit(pixels, np.column_stack([xs, ys]))
+        xCenter, yCenter, rotation, xScale, yScale = transform.parameters(
+            self.image.width(), self.image.height()
+        )
+        rms = float(np.sqrt(np.mean(residuals**2)))
+        QgsMessageLog.logMessage(
+            "Reprojected %s to %s: RMS of residuals %f"
+            % (self.name(), newCrs.authid(), rms)
+        )
+
+        # the snapshots keep their CRS: undo goes back to the old CRS
+        self.pushHistory()
+        self.setCrs(newCrs)
+        self.setCenter(QgsPointXY(xCenter, yCenter))
+        self.setRotation(rotation)
+        self.setScale(xScale, yScale)
+        return rms
 
-        self.setupCrsEvents()
+    def setupCrs(self):
+        # the layer keeps its own CRS (read from the project if any) and is
+        # reprojected on the fly if it is different from the CRS of the map
+        if not self.crs().isValid():
+            mapCrs = self.iface.mapCanvas().mapSettings().destinationCrs()
+            self.setCrs(mapCrs)
 
     def repaint(self):
         self.repaintRequested.emit()
@@ -235,6 +706,8 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
 
             self.initialized = True
             self.initializing = False
+            self.unmaskedImage = self.image
+            self.applyAlphaMask()
 
             self.setupCrs()
 
@@ -253,6 +726,7 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
                     self.initializeExistingGeoreferencing(dataset, georef)
                 else:
                     # init to default params
+                    self.placedByDefault = True
                     self.setCenter(screenExtent.center())
                     self.setRotation(0.0)
 
@@ -281,45 +755,26 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
 
         if datatype != "Byte":
             pixels = pixels if pixels is not None else gdal_utils.pixels(filepath)
-
-            bands = np.empty(np.shape(pixels), dtype=np.uint8)
-            for i in range(nbands):
-                band_pixels = pixels[i]
-                bands[i] = gdal_utils.to_byte(band_pixels)
-            pixels = bands
+            # native values kept: the stretch can be changed without reading
+            # the file again
+            self.rawBands = [QuantizedBand(band) for band in pixels]
+            self.image = self.stretchedImage()
+            return True
 
         if pixels is not None:
-            # some transformation done# band at the end
-            pixels = np.transpose(pixels, [1, 2, 0])
-            pixels = pixels.ravel()
-
-            if nbands == 1:
-                # monochrome
-                format = QImage.Format_Grayscale8
-                bytesPerLine = width
-            else:
-                format = QImage.Format_RGB888
-                bytesPerLine = 3 * width
-
-            # Byte
-            qImg = QImage(pixels, width, height, bytesPerLine, format)
-            self.image = qImg
-
+            # some transformation done
+            self.image = imageFromBands(pixels)
             return True
 
         return False
 
     def initializeExistingGeoreferencing(self, dataset, georef):
         # georef can have scaling, rotation or translation
-        rotation = 180 / math.pi * -math.atan2(georef[4], georef[1])
-        sx = math.sqrt(georef[1] ** 2 + georef[4] ** 2)
-        sy = math.sqrt(georef[2] ** 2 + georef[5] ** 2)
-        i_center_x = self.image.width() / 2
-        i_center_y = self.image.height() / 2
-        center = QgsPointXY(
-            georef[0] + georef[1] * i_center_x + georef[2] * i_center_y,
-            georef[3] + georef[4] * i_center_x + georef[5] * i_center_y,
+        transform = AffineTransform.fromGdal(georef)
+        xCenter, yCenter, rotation, sx, sy = transform.parameters(
+            self.image.width(), self.image.height()
         )
+        center = QgsPointXY(xCenter, yCenter)
 
         qDebug(repr(rotation) + " " + repr((sx, sy)) + " " + repr(center))
 
@@ -330,47 +785,25 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
         self.commitTransformParameters()
 
         crs_wkt = dataset.GetProjection()
-        message_shown = False
+        message = "Found existing georeferencing in raster"
         if crs_wkt:
             qcrs = QgsCoordinateReferenceSystem(crs_wkt)
-            # TODO check change
-            if qcrs.description() != self.crs().description():
-                # reproject
-                try:
-                    self.reprojectTransformParameters(qcrs, self.crs())
-                    self.commitTransformParameters()
-                    self.showBarMessage(
-                        "Transform parameters changed: ",
-                        "Found existing georeferencing in raster but "
-                        "its CRS does not match the CRS of the map. "
-                        "Reprojected the extent.",
-                        Qgis.Warning,
-                        25,
-                    )
-                    message_shown = True
-                except Exception as ex:
-                    QgsMessageLog.logMessage(repr(ex))
-                    self.showBarMessage(
-                        "CRS does not match",
-                        "Found existing georeferencing in raster but "
-                        "its CRS does not match the CRS of the map. "
-                        "Unable to reproject.",
-                        Qgis.Warning,
-                        5,
-                    )
-                    message_shown = True
+            if qcrs.isValid() and qcrs != self.crs():
+                # keep the CRS of the raster: displayed reprojected on the fly
+                self.setCrs(qcrs)
+                message += (
+                    " with a CRS different from the CRS of the map (%s). "
+                    "It is displayed reprojected." % qcrs.authid()
+                )
         # if no projection info, assume it is the same CRS
-        # as the map and no warning
-        if not message_shown:
-            self.showBarMessage(
-                "Georeferencing loaded",
-                "Found existing georeferencing in raster",
-                Qgis.Info,
-                3,
-            )
+        # as the map
+        self.showBarMessage("Georeferencing loaded", message, Qgis.Info, 5)
 
         # zoom (assume the user wants to work on the image)
-        self.iface.mapCanvas().setExtent(self.extent())
+        mapSettings = self.iface.mapCanvas().mapSettings()
+        self.iface.mapCanvas().setExtent(
+            mapSettings.layerExtentToOutputExtent(self, self.extent())
+        )
 
     def is_default_geotransform(self, georef):
         """
@@ -401,6 +834,7 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
         self.setCustomProperty("filepath", self.filepath)
         self.setName(title)
 
+        previousSize = self.image.size()
         fileInfo = QFileInfo(filepath)
         ext = fileInfo.suffix()
         if ext == "pdf":
@@ -417,6 +851,19 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
         else:
             reader = QImageReader(filepath)
             self.image = reader.read()
+        self.rawBands = None
+        self.setPreviewStretch(None)
+        self.unmaskedImage = self.image
+        self.applyAlphaMask()
+        # the clip polygon and the warp are in the pixels of the previous image
+        if self.clipRing is not None and self.image.size() != previousSize:
+            self.setClipRing(None)
+        # the warp is fitted on the pixels of the previous image
+        if self.warp is not None and (
+            self.warp.width != self.image.width()
+            or self.warp.height != self.image.height()
+        ):
+            self.setWarp(None)
         self.repaint()
 
     def clone(self):
@@ -427,6 +874,11 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
         layer.rotation = self.rotation
         layer.xScale = self.xScale
         layer.yScale = self.yScale
+        layer.setWarp(self.warp)
+        layer.setClipRing(self.clipRing)
+        layer.setAlphaMask(self.alphaMask)
+        if self.stretch is not None and layer.rawBands is not None:
+            layer.setStretch(self.stretch)
         layer.commitTransformParameters()
         return layer
 
@@ -450,122 +902,135 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
         if self._extent:
             return self._extent
 
-        topLeft, topRight, bottomRight, bottomLeft = self.cornerCoordinates()
-
-        left = min(topLeft.x(), topRight.x(), bottomRight.x(), bottomLeft.x())
-        right = max(topLeft.x(), topRight.x(), bottomRight.x(), bottomLeft.x())
-        top = max(topLeft.y(), topRight.y(), bottomRight.y(), bottomLeft.y())
-        bottom = min(topLeft.y(), topRight.y(), bottomRight.y(), bottomLeft.y())
-
-        # recenter + create rectangle
-        self._extent = QgsRectangle(left, bottom, right, top)
+        transform = self.imageTransform()
+        bounds = transform.bounds(self.image.width(), self.image.height())
+        self._extent = QgsRectangle(*bounds)
         return self._extent
 
-    def cornerCoordinates(self):
-        return self.transformedCornerCoordinates(
+    def affineTransform(self):
+        """
+        Pixel to map transform of the layer
+        """
+        return self.transformFromParameters(
             self.center, self.rotation, self.xScale, self.yScale
         )
 
-    def transformedCornerCoordinates(self, center, rotation, xScale, yScale):
-        # scale
-        topLeft = QgsPointXY(
-            -self.image.width() / 2.0 * xScale, self.image.height() / 2.0 * yScale
-        )
-        topRight = QgsPointXY(
-            self.image.width() / 2.0 * xScale, self.image.height() / 2.0 * yScale
-        )
-        bottomLeft = QgsPointXY(
-            -self.image.width() / 2.0 * xScale, -self.image.height() / 2.0 * yScale
-        )
-        bottomRight = QgsPointXY(
-            self.image.width() / 2.0 * xScale, -self.image.height() / 2.0 * yScale
+    def imageTransform(self):
+        """
+        Pixel to map mapping of the layer including the warp, if any
+        (warp.WarpedTransform or AffineTransform)
+        """
+        return imageTransform(self.affineTransform(), self.warp)
+
+    def transformFromParameters(self, center, rotation, xScale, yScale):
+        return AffineTransform.fromParameters(
+            center.x(),
+            center.y(),
+            rotation,
+            xScale,
+            yScale,
+            self.image.width(),
+            self.image.height(),
         )
 
-        # rotate
-        # minus sign because rotation is CW in this class and Qt)
-        rotationRad = -rotation * math.pi / 180
-        cosRot = math.cos(rotationRad)
-        sinRot = math.sin(rotationRad)
-
-        topLeft = self._rotate(topLeft, cosRot, sinRot)
-        topRight = self._rotate(topRight, cosRot, sinRot)
-        bottomRight = self._rotate(bottomRight, cosRot, sinRot)
-        bottomLeft = self._rotate(bottomLeft, cosRot, sinRot)
-
-        topLeft.set(topLeft.x() + center.x(), topLeft.y() + center.y())
-        topRight.set(topRight.x() + center.x(), topRight.y() + center.y())
-        bottomRight.set(bottomRight.x() + center.x(), bottomRight.y() + center.y())
-        bottomLeft.set(bottomLeft.x() + center.x(), bottomLeft.y() + center.y())
-
-        return (topLeft, topRight, bottomRight, bottomLeft)
-
-    def transformedCornerCoordinatesFromPoint(
-        self, startPoint, rotation, xScale, yScale
-    ):
+    def transformFromPoint(self, startPoint, rotation, xScale, yScale):
         # startPoint is a fixed point for this new movement (rotation and
         # scale)
-        # rotation is the global rotation of the image
+        # rotation is the rotation to add to the global rotation of the image
         # xScale is the new xScale factor to be multiplied by self.xScale
         # idem for yScale
         # Calculate the coordinate of the center in a startPoint origin
         # coordinate system and apply scales
         dX = (self.center.x() - startPoint.x()) * xScale
         dY = (self.center.y() - startPoint.y()) * yScale
-        # Half width and half height in the current transformation
-        hW = (self.image.width() / 2.0) * self.xScale * xScale
-        hH = (self.image.height() / 2.0) * self.yScale * yScale
-        # Actual rectangle coordinates :
-        pt1 = QgsPointXY(-hW, hH)
-        pt2 = QgsPointXY(hW, hH)
-        pt3 = QgsPointXY(hW, -hH)
-        pt4 = QgsPointXY(-hW, -hH)
-        # Actual rotation from the center
-        # minus sign because rotation is CW in this class and Qt)
-        rotationRad = -self.rotation * math.pi / 180
-        cosRot = math.cos(rotationRad)
-        sinRot = math.sin(rotationRad)
-        pt1 = self._rotate(pt1, cosRot, sinRot)
-        pt2 = self._rotate(pt2, cosRot, sinRot)
-        pt3 = self._rotate(pt3, cosRot, sinRot)
-        pt4 = self._rotate(pt4, cosRot, sinRot)
-        # Second transformation
-        # displacement of the origin
-        pt1 = QgsPointXY(pt1.x() + dX, pt1.y() + dY)
-        pt2 = QgsPointXY(pt2.x() + dX, pt2.y() + dY)
-        pt3 = QgsPointXY(pt3.x() + dX, pt3.y() + dY)
-        pt4 = QgsPointXY(pt4.x() + dX, pt4.y() + dY)
-        # Rotation
-        # minus sign because rotation is CW in this class and Qt)
-        rotationRad = -rotation * math.pi / 180
-        cosRot = math.cos(rotationRad)
-        sinRot = math.sin(rotationRad)
-        pt1 = self._rotate(pt1, cosRot, sinRot)
-        pt2 = self._rotate(pt2, cosRot, sinRot)
-        pt3 = self._rotate(pt3, cosRot, sinRot)
-        pt4 = self._rotate(pt4, cosRot, sinRot)
-        # translate to startPoint
-        pt1 = QgsPointXY(pt1.x() + startPoint.x(), pt1.y() + startPoint.y())
-        pt2 = QgsPointXY(pt2.x() + startPoint.x(), pt2.y() + startPoint.y())
-        pt3 = QgsPointXY(pt3.x() + startPoint.x(), pt3.y() + startPoint.y())
-        pt4 = QgsPointXY(pt4.x() + startPoint.x(), pt4.y() + startPoint.y())
-
-        return (pt1, pt2, pt3, pt4)
-
-    def moveCenterFromPointRotate(self, startPoint, rotation, xScale, yScale):
-        cornerPoints = self.transformedCornerCoordinatesFromPoint(
-            startPoint, rotation, xScale, yScale
+        scaled = AffineTransform.fromParameters(
+            startPoint.x() + dX,
+            startPoint.y() + dY,
+            self.rotation,
+            self.xScale * xScale,
+            self.yScale * yScale,
+            self.image.width(),
+            self.image.height(),
         )
-        self.center = QgsPointXY(
-            (cornerPoints[0].x() + cornerPoints[2].x()) / 2,
-            (cornerPoints[0].y() + cornerPoints[2].y()) / 2,
+        return scaled.compose(
+            AffineTransform.rotationAround(rotation, startPoint.x(), startPoint.y())
+        )
+
+    def cornerCoordinates(self):
+        return self.transformedCornerCoordinates(
+            self.center, self.rotation, self.xScale, self.yScale
         )
 
-    def _rotate(self, point, cosRot, sinRot):
-        return QgsPointXY(
-            point.x() * cosRot - point.y() * sinRot,
-            point.x() * sinRot + point.y() * cosRot,
+    def transformedCornerCoordinates(self, center, rotation, xScale, yScale):
+        transform = self.transformFromParameters(center, rotation, xScale, yScale)
+        return self.cornerPoints(transform)
+
+    def transformedCornerCoordinatesFromPoint(
+        self, startPoint, rotation, xScale, yScale
+    ):
+        transform = self.transformFromPoint(startPoint, rotation, xScale, yScale)
+        return self.cornerPoints(transform)
+
+    def moveCenterFromPointRotate(self, startPoint, rotation, xScale, yScale):
+        transform = self.transformFromPoint(startPoint, rotation, xScale, yScale)
+        self.setCenter(
+            QgsPointXY(
+                *transform.map(self.image.width() / 2.0, self.image.height() / 2.0)
+            )
         )
 
+    def pixelToMap(self, us, vs):
+        """
+        Map coordinates of arrays of pixel coordinates (origin on the
+        upper left corner of the image)
+        """
+        return self.affineTransform().mapArrays(us, vs)
+
+    def mapToPixel(self, xs, ys):
+        return self.affineTransform().inverted().mapArrays(xs, ys)
+
+    def canvasCrsTransform(self, toCanvas=True):
+        """
+        QgsCoordinateTransform from the CRS of the layer to the CRS of the
+        map canvas (the reverse if not toCanvas), None if they are the same
+        """
+        mapCrs = self.iface.mapCanvas().mapSettings().destinationCrs()
+        if not self.crs().isValid() or self.crs() == mapCrs:
+            return None
+        if toCanvas:
+            return QgsCoordinateTransform(self.crs(), mapCrs, QgsProject.instance())
+        return QgsCoordinateTransform(mapCrs, self.crs(), QgsProject.instance())
+
+    def canvasToImage(self, xs, ys):
+        """
+        Pixels of the image as displayed (with the warp) of arrays of
+        coordinates in the CRS of the map canvas, so points can be picked
+        without reprojecting the layer
+        """
+        transform = self.canvasCrsTransform(toCanvas=False)
+        if transform is not None:
+            xs, ys = transformPoints(transform, xs, ys)
+        return self.imageTransform().inverted().mapArrays(xs, ys)
+
+    def imageToCanvas(self, us, vs):
+        """
+        Coordinates in the CRS of the map canvas of arrays of pixels of the
+        image as displayed (with the warp)
+        """
+        xs, ys = self.imageTransform().mapArrays(us, vs)
+        transform = self.canvasCrsTransform()
+        if transform is not None:
+            xs, ys = transformPoints(transform, xs, ys)
+        return xs, ys
+
+    def cornerPoints(self, transform):
+        """
+        Corners of the image as QgsPointXY for the pixel to map transform
+        """
+        corners = transform.corners(self.image.width(), self.image.height())
+        # topLeft, topRight, bottomRight, bottomLeft
+        return tuple(QgsPointXY(float(x), float(y)) for x, y in corners)
+
     def createMapRenderer(self, rendererContext):
         return FreehandRasterGeoreferencerLayerRenderer(self, rendererContext)
 
@@ -601,6 +1066,14 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
         painter = renderContext.painter()
         painter.setRenderHint(QPainter.SmoothPixmapTransform, True)
 
+        coordinateTransform = renderContext.coordinateTransform()
+        if coordinateTransform.isValid() and not coordinateTransform.isShortCircuited():
+            self.drawWarpedRaster(renderContext, coordinateTransform)
+            return
+        if self.warp is not None:
+            self.drawWarpedRaster(renderContext, None)
+            return
+
         self.map2pixel = renderContext.mapToPixel()
 
         scaleX = self.xScale / self.map2pixel.mapUnitsPerPixel()
@@ -616,8 +1089,157 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
         painter.translate(QPointF(mapCenter.x(), mapCenter.y()))
         painter.rotate(self.rotation)
         painter.scale(scaleX, scaleY)
-        painter.drawImage(rect, self.image)
+        clipPath = self.clipPath()
+        display = self.displayImage(max(abs(scaleX), abs(scaleY)))
+        targetRect = rect
+        painter.save()
+        if clipPath is not None:
+            # only the part of the image inside the clip polygon is drawn
+            clipPath = clipPath.translated(rect.topLeft())
+            painter.setClipPath(clipPath, Qt.IntersectClip)
+            targetRect = clipPath.boundingRect().intersected(rect)
+        # the tiles of the preview of a stretch may differ from the image
+        opaqueRect = None if self.previewStretch else self.opaqueTilesRect()
+        if opaqueRect is not None:
+            # fully transparent margins are skipped
+            targetRect = targetRect.intersected(opaqueRect.translated(rect.topLeft()))
+        if display is not None and not targetRect.isEmpty():
+            image, xFactor, yFactor = display
+            sourceRect = targetRect.translated(-rect.topLeft())
+            sourceRect = QRectF(
+                sourceRect.x() * xFactor,
+                sourceRect.y() * yFactor,
+                sourceRect.width() * xFactor,
+                sourceRect.height() * yFactor,
+            )
+            painter.drawImage(targetRect, image, sourceRect)
+        painter.restore()
+
+        self.prepareOutlineStyle(painter)
+        if clipPath is None:
+            painter.drawRect(rect)
+        else:
+            painter.drawPath(clipPath)
 
+    def drawWarpedRaster(self, renderContext, coordinateTransform):
+        """
+        Draws the image warped and/or reprojected to the CRS of the map
+        (coordinateTransform, None if the same CRS) through a mesh of affine
+        patches
+        """
+        try:
+            mesh = self.warpMesh(coordinateTransform)
+        except Exception as ex:
+            QgsMessageLog.logMessage(repr(ex))
+            return
+
+        mapToPixel = renderContext.mapToPixel()
+        origin = mapToPixel.toMapCoordinates(0, 0)
+        mapToDevice = mapToPixelTransform(
+            mapToPixel,
+            origin.x(),
+            origin.y(),
+            100 * mapToPixel.mapUnitsPerPixel(),
+        )
+        painter = renderContext.painter()
+        device = painter.device()
+        inverted, _ = painter.transform().inverted()
+        visibleRect = inverted.mapRect(QRectF(0, 0, device.width(), device.height()))
+        outline = mesh.outline(mapToDevice)
+        outlineRect = outline.boundingRect()
+        display = self.displayImage(
+            max(
+                outlineRect.width() / self.image.width(),
+                outlineRect.height() / self.image.height(),
+            )
+        )
+        if display is None:
+            self.prepareOutlineStyle(painter)
+            painter.drawPolygon(outline)
+            return
+        image, xFactor, yFactor = display
+
+        hiddenCells = None
+        cellStarts = mesh.cellStarts()
+        if cellStarts is not None and self.previewStretch is None:
+            # fully transparent cells are skipped
+            hiddenCells = self.transparentTiles(*cellStarts)
+        clipPath = self.clipPath()
+        if clipPath is None:
+            mesh.draw(
+                painter,
+                image,
+                mapToDevice,
+                visibleRect,
+                None,
+                hiddenCells,
+                (xFactor, yFactor),
+            )
+        else:
+            # clip polygon through the mesh: its edges follow the patches
+            us, vs = densifyRing(self.clipRing, self.CLIP_RING_DENSITY).T
+            points = mapToDevice.mapArray(np.column_stack(mesh.mapArrays(us, vs)))
+            outline = QPolygonF([QPointF(x, y) for x, y in points])
+            devicePath = QPainterPath()
+            devicePath.addPolygon(outline)
+            devicePath.closeSubpath()
+            painter.save()
+            painter.setClipPath(devicePath, Qt.IntersectClip)
+            mesh.draw(
+                painter,
+                image,
+                mapToDevice,
+                visibleRect,
+                clipPath.boundingRect(),
+                hiddenCells,
+                (xFactor, yFactor),
+            )
+            painter.restore()
+
+        self.prepareOutlineStyle(painter)
+        painter.drawPolygon(outline)
+
+    def warpMesh(self, coordinateTransform):
+        """
+        Mesh of the image in the destination CRS of coordinateTransform (the
+        CRS of the layer if None). Cached as long as the CRS pair, the
+        transform parameters and the warp do not change (so panning and
+        zooming reuse it)
+        """
+        transform = self.affineTransform()
+        if coordinateTransform is None:
+            crsPair = None
+        else:
+            crsPair = (
+                crsKey(coordinateTransform.sourceCrs()),
+                crsKey(coordinateTransform.destinationCrs()),
+            )
+        key = (
+            crsPair,
+            transform.coefficients(),
+            self._warpVersion,
+            self.image.width(),
+            self.image.height(),
+        )
+        cached = self._warpMeshCache
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        if self.warp is None:
+            size = FreehandRasterGeoreferencerLayer.WARP_MESH_SIZE
+        else:
+            size = FreehandRasterGeoreferencerLayer.WARPED_MESH_SIZE
+        mesh = WarpMesh.fromMapping(
+            self.image.width(),
+            self.image.height(),
+            size,
+            imageTransform(transform, self.warp).mapArrays,
+            coordinateTransform,
+        )
+        self._warpMeshCache = (key, mesh)
+        return mesh
+
+    def prepareOutlineStyle(self, painter):
         painter.setOpacity(1.0)
         painter.setBrush(Qt.NoBrush)
         pen = QPen()
@@ -625,7 +1247,6 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
         pen.setWidth(3)
         pen.setCosmetic(True)
         painter.setPen(pen)
-        painter.drawRect(rect)
 
     def prepareStyle(self, painter):
         painter.setOpacity(1.0 - self.transparency / 100.0)
@@ -640,6 +1261,33 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
         xCenter = float(self.customProperty("xCenter", 0.0))
         yCenter = float(self.customProperty("yCenter", 0.0))
         self.center = QgsPointXY(xCenter, yCenter)
+        try:
+            self.warp = Warp.fromJson(self.customProperty("warp", ""))
+        except (ValueError, KeyError) as ex:
+            QgsMessageLog.logMessage(repr(ex))
+            self.warp = None
+        self._warpVersion += 1
+        try:
+            self.clipRing = ringFromJson(self.customProperty("clipRing", ""))
+        except ValueError as ex:
+            QgsMessageLog.logMessage(repr(ex))
+            self.clipRing = None
+        self._clipPath = None
+        try:
+            self.alphaMask = AlphaMask.fromJson(self.customProperty("alphaMask", ""))
+        except (ValueError, KeyError) as ex:
+            QgsMessageLog.logMessage(repr(ex))
+            self.alphaMask = None
+        try:
+            self.stretch = Stretch.fromJson(self.customProperty("stretch", ""))
+        except (ValueError, KeyError) as ex:
+            QgsMessageLog.logMessage(repr(ex))
+            self.stretch = None
+        if self.initialized:
+            if self.rawBands is not None:
+                self.unmaskedImage = self.stretchedImage()
+            self.applyAlphaMask()
+        self._extent = None
         self.setTransparency(
             int(self.customProperty("transparency", LayerDefaultSettings.TRANSPARENCY))
         )
@@ -649,6 +1297,7 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
         return True
 
     def writeXml(self, node, doc, context):
+        self.flushTransformParameters()
         element = node.toElement()
         self.writeCustomProperties(node, doc)
         element.setAttribute("type", "plugin")
@@ -669,6 +1318,27 @@ class FreehandRasterGeoreferencerLayer(QgsPluginLayer):
         lines.append(fmt % (self.tr("Y center"), str(self.center.y())))
         lines.append(fmt % (self.tr("X scale"), str(self.xScale)))
         lines.append(fmt % (self.tr("Y scale"), str(self.yScale)))
+        if self.warp is not None:
+            lines.append(fmt % (self.tr("Warp"), self.warp.method))
+        if self.alphaMask is not None:
+            lines.append(fmt % (self.tr("Transparent pixels"), self.alphaMask.method))
+        if self.rawBands is not None:
+            lines.append(
+                fmt
+                % (
+                    self.tr("Stretch"),
+                    "brightness %.2f, contrast %.2f, gamma %.2f"
+                    % (
+                        self.stretch.brightness,
+                        self.stretch.contrast,
+                        self.stretch.gamma,
+                    ),
+                )
+            )
+        if self.clipRing is not None:
+            lines.append(
+                fmt % (self.tr("Clip polygon"), "%d points" % len(self.clipRing))
+            )
 
         return "\n".join(lines)
 
@@ -710,7 +1380,15 @@ class FreehandRasterGeoreferencerLayerType(QgsPluginLayerType):
         )
         dialog.spinBox_Transparency.valueChanged.connect(layer.transparencyChanged)
 
-        dialog.exec_()
+        # the stretch is previewed while it is edited
+        if dialog.exec_() == QDialog.Accepted:
+            stretch = dialog.stretch()
+            if stretch is not None and stretch != layer.stretch:
+                layer.setStretch(stretch)
+            alphaMask = dialog.alphaMask()
+            if alphaMask != layer.alphaMask:
+                layer.setAlphaMask(alphaMask)
+        layer.setPreviewStretch(None)
 
         dialog.horizontalSlider_Transparency.valueChanged.disconnect(
             layer.transparencyChanged
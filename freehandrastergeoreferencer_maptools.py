@@ -17,8 +17,11 @@ from PyQt5.QtWidgets import QApplication, QInputDialog, QMessageBox
 from qgis.core import QgsGeometry, QgsPointXY, QgsWkbTypes
 from qgis.gui import QgsMapToolEmitPoint, QgsRubberBand
 
+from .affine import AffineTransform
+from .controlpoints import ControlPoints
 from .rastershadowmapcanvasitem import RasterShadowMapCanvasItem
 from .utils import tryfloat
+from .warp import minimumPointCount, WARP_METHODS
 
 
 def isLayerVisible(iface, layer):
@@ -66,21 +69,19 @@ class MoveRasterMapTool(QgsMapToolEmitPoint):
         self.layer = None
 
     def canvasPressEvent(self, e):
+        # edited in the CRS of the map
+        self.layer.alignToMapCrs()
         self.startPoint = self.toMapCoordinates(e.pos())
         self.endPoint = self.startPoint
         self.isEmittingPoint = True
         self.originalCenter = self.layer.center
-        # this tool do the displacement itself TODO update so it is done by
-        # transformed coordinates + new center)
-        self.originalCornerPoints = self.layer.transformedCornerCoordinates(
-            *self.layer.transformParameters()
-        )
+        self.originalTransform = self.layer.affineTransform()
 
         self.isLayerVisible = isLayerVisible(self.iface, self.layer)
         setLayerVisible(self.iface, self.layer, False)
 
         self.showDisplacement(self.startPoint, self.endPoint)
-        self.layer.history.append({"action": "move", "center": self.layer.center})
+        self.layer.pushHistory()
 
     def canvasReleaseEvent(self, e):
         self.isEmittingPoint = False
@@ -94,7 +95,6 @@ class MoveRasterMapTool(QgsMapToolEmitPoint):
         self.layer.setCenter(QgsPointXY(x, y))
 
         setLayerVisible(self.iface, self.layer, self.isLayerVisible)
-        self.layer.repaint()
 
         self.layer.commitTransformParameters()
 
@@ -113,13 +113,17 @@ class MoveRasterMapTool(QgsMapToolEmitPoint):
         self.rubberBandDisplacement.addPoint(point2, True)  # true to update canvas
         self.rubberBandDisplacement.show()
 
+        displacement = AffineTransform.translation(
+            endPoint.x() - startPoint.x(), endPoint.y() - startPoint.y()
+        )
+        cornerPoints = self.layer.cornerPoints(
+            self.originalTransform.compose(displacement)
+        )
         self.rubberBandExtent.reset(QgsWkbTypes.LineGeometry)
-        for point in self.originalCornerPoints:
-            self._addDisplacementToPoint(self.rubberBandExtent, point, False)
+        for point in cornerPoints:
+            self.rubberBandExtent.addPoint(point, False)
         # for closing
-        self._addDisplacementToPoint(
-            self.rubberBandExtent, self.originalCornerPoints[0], True
-        )
+        self.rubberBandExtent.addPoint(cornerPoints[0], True)
         self.rubberBandExtent.show()
 
         self.rasterShadow.reset(self.layer)
@@ -130,11 +134,6 @@ class MoveRasterMapTool(QgsMapToolEmitPoint):
         )
         self.rasterShadow.show()
 
-    def _addDisplacementToPoint(self, rubberBand, point, doUpdate):
-        x = point.x() + self.endPoint.x() - self.startPoint.x()
-        y = point.y() + self.endPoint.y() - self.startPoint.y()
-        self.rubberBandExtent.addPoint(QgsPointXY(x, y), doUpdate)
-
 
 # move the mouse in the Y axis to rotate
 
@@ -173,6 +172,8 @@ class RotateRasterMapTool(QgsMapToolEmitPoint):
         self.layer = None
 
     def canvasPressEvent(self, e):
+        # edited in the CRS of the map
+        self.layer.alignToMapCrs()
         self.startY = e.pos().y()
         self.endY = self.startY
         self.isEmittingPoint = True
@@ -189,13 +190,7 @@ class RotateRasterMapTool(QgsMapToolEmitPoint):
         rotation = self.computeRotation()
         self.showRotation(rotation)
 
-        self.layer.history.append(
-            {
-                "action": "rotation",
-                "rotation": self.layer.rotation,
-                "center": self.layer.center,
-            }
-        )  # rotation set
+        self.layer.pushHistory()
 
     def canvasReleaseEvent(self, e):
         self.isEmittingPoint = False
@@ -212,7 +207,6 @@ class RotateRasterMapTool(QgsMapToolEmitPoint):
         self.layer.setRotation(val)
 
         setLayerVisible(self.iface, self.layer, self.isLayerVisible)
-        self.layer.repaint()
 
         self.layer.commitTransformParameters()
 
@@ -301,6 +295,8 @@ class ScaleRasterMapTool(QgsMapToolEmitPoint):
     def canvasPressEvent(self, e):
         pressed_button = e.button()
         if pressed_button == 1:
+            # edited in the CRS of the map
+            self.layer.alignToMapCrs()
             self.startPoint = e.pos()
             self.endPoint = self.startPoint
             self.isEmittingPoint = True
@@ -315,13 +311,7 @@ class ScaleRasterMapTool(QgsMapToolEmitPoint):
 
             scaling = self.computeScaling()
             self.showScaling(*scaling)
-        self.layer.history.append(
-            {
-                "action": "scale",
-                "xScale": self.layer.xScale,
-                "yScale": self.layer.yScale,
-            }
-        )
+            self.layer.pushHistory()
 
     def canvasReleaseEvent(self, e):
         pressed_button = e.button()
@@ -340,11 +330,9 @@ class ScaleRasterMapTool(QgsMapToolEmitPoint):
                 None, "Scale & DPI", "Enter scale,dpi (e.g. 3000,96)"
             )
             if not ok:
-                self.layer.history.pop()
                 return
             scales = number.split(",")
             if len(scales) != 2:
-                self.layer.history.pop()
                 QMessageBox.information(
                     self.iface.mainWindow(), "Error", "Must be 2 numbers"
                 )
@@ -355,7 +343,6 @@ class ScaleRasterMapTool(QgsMapToolEmitPoint):
                 xScale = scale / (dpi / 0.0254)
                 yScale = xScale
             else:
-                self.layer.history.pop()
                 QMessageBox.information(
                     self.iface.mainWindow(),
                     "Error",
@@ -363,9 +350,11 @@ class ScaleRasterMapTool(QgsMapToolEmitPoint):
                 )
                 return
 
+            # edited in the CRS of the map
+            self.layer.alignToMapCrs()
+            self.layer.pushHistory()
             self.layer.setScale(xScale, yScale)
 
-        self.layer.repaint()
         self.layer.commitTransformParameters()
 
     def canvasMoveEvent(self, e):
@@ -443,6 +432,8 @@ class AdjustRasterMapTool(QgsMapToolEmitPoint):
         self.layer = None
 
     def canvasPressEvent(self, e):
+        # edited in the CRS of the map
+        self.layer.alignToMapCrs()
         # find the side of the rectangle closest to the click and some data
         # necessary to compute the new cneter and scale
         topLeft, topRight, bottomRight, bottomLeft = self.layer.cornerCoordinates()
@@ -475,14 +466,7 @@ class AdjustRasterMapTool(QgsMapToolEmitPoint):
 
         adjustment = self.computeAdjustment()
         self.showAdjustment(*adjustment)
-        self.layer.history.append(
-            {
-                "action": "adjust",
-                "center": self.layer.center,
-                "xScale": self.layer.xScale,
-                "yScale": self.layer.yScale,
-            }
-        )
+        self.layer.pushHistory()
 
     def minDistance(self, distances):
         sortedDistances = [
@@ -519,7 +503,6 @@ class AdjustRasterMapTool(QgsMapToolEmitPoint):
         self.layer.setScale(xScale * self.layer.xScale, yScale * self.layer.yScale)
 
         setLayerVisible(self.iface, self.layer, self.isLayerVisible)
-        self.layer.repaint()
 
         self.layer.commitTransformParameters()
 
@@ -636,24 +619,20 @@ class GeorefRasterBy2PointsMapTool(QgsMapToolEmitPoint):
         self.reset()
 
     def canvasPressEvent(self, e):
+        # edited in the CRS of the map
+        self.layer.alignToMapCrs()
         if self.firstPoint is None:
             self.startPoint = self.toMapCoordinates(e.pos())
             self.endPoint = self.startPoint
             self.isEmittingPoint = True
             self.originalCenter = self.layer.center
-            # this tool do the displacement itself TODO update so it is done by
-            # transformed coordinates + new center)
-            self.originalCornerPoints = self.layer.transformedCornerCoordinates(
-                *self.layer.transformParameters()
-            )
+            self.originalTransform = self.layer.affineTransform()
 
             self.isLayerVisible = isLayerVisible(self.iface, self.layer)
             setLayerVisible(self.iface, self.layer, False)
 
             self.showDisplacement(self.startPoint, self.endPoint)
-            self.layer.history.append(
-                {"action": "2pointsA", "center": self.layer.center}
-            )
+            self.layer.pushHistory()
         else:
             self.startPoint = self.toMapCoordinates(e.pos())
             self.endPoint = self.startPoint
@@ -669,15 +648,7 @@ class GeorefRasterBy2PointsMapTool(QgsMapToolEmitPoint):
             rotation = self.computeRotation()
             xScale = yScale = self.computeScale()
             self.showRotationScale(rotation, xScale, yScale)
-            self.layer.history.append(
-                {
-                    "action": "2pointsB",
-                    "center": self.layer.center,
-                    "xScale": self.layer.xScale,
-                    "yScale": self.layer.yScale,
-                    "rotation": self.layer.rotation,
-                }
-            )
+            self.layer.pushHistory()
 
     def canvasReleaseEvent(self, e):
         self.isEmittingPoint = False
@@ -693,7 +664,6 @@ class GeorefRasterBy2PointsMapTool(QgsMapToolEmitPoint):
             self.firstPoint = self.endPoint
 
             setLayerVisible(self.iface, self.layer, self.isLayerVisible)
-            self.layer.repaint()
 
             self.layer.commitTransformParameters()
         else:
@@ -706,7 +676,6 @@ class GeorefRasterBy2PointsMapTool(QgsMapToolEmitPoint):
             self.layer.setScale(self.layer.xScale * xScale, self.layer.yScale * yScale)
 
             setLayerVisible(self.iface, self.layer, self.isLayerVisible)
-            self.layer.repaint()
 
             self.layer.commitTransformParameters()
 
@@ -794,13 +763,17 @@ class GeorefRasterBy2PointsMapTool(QgsMapToolEmitPoint):
         self.rubberBandDisplacement.addPoint(point2, True)  # true to update canvas
         self.rubberBandDisplacement.show()
 
+        displacement = AffineTransform.translation(
+            endPoint.x() - startPoint.x(), endPoint.y() - startPoint.y()
+        )
+        cornerPoints = self.layer.cornerPoints(
+            self.originalTransform.compose(displacement)
+        )
         self.rubberBandExtent.reset(QgsWkbTypes.LineGeometry)
-        for point in self.originalCornerPoints:
-            self._addDisplacementToPoint(self.rubberBandExtent, point, False)
+        for point in cornerPoints:
+            self.rubberBandExtent.addPoint(point, False)
         # for closing
-        self._addDisplacementToPoint(
-            self.rubberBandExtent, self.originalCornerPoints[0], True
-        )
+        self.rubberBandExtent.addPoint(cornerPoints[0], True)
         self.rubberBandExtent.show()
 
         self.rasterShadow.reset(self.layer)
@@ -811,7 +784,281 @@ class GeorefRasterBy2PointsMapTool(QgsMapToolEmitPoint):
         )
         self.rasterShadow.show()
 
-    def _addDisplacementToPoint(self, rubberBand, point, doUpdate):
-        x = point.x() + self.endPoint.x() - self.startPoint.x()
-        y = point.y() + self.endPoint.y() - self.startPoint.y()
-        self.rubberBandExtent.addPoint(QgsPointXY(x, y), doUpdate)
+
+class GeorefRasterByPointsMapTool(QgsMapToolEmitPoint):
+    """
+    Control points: press on a point of the raster and release on its
+    position on the map. The transform is solved on all the points and
+    previewed after each change, with the residuals in the status bar. The
+    map position of a point can be dragged, right click removes a point.
+    Enter applies the transform (one undo step), A toggles between similarity
+    and affine, W cycles through the warps (none, polynomials, thin plate
+    spline), Escape removes all the points
+    """
+
+    WARP_METHODS = (None,) + WARP_METHODS
+
+    # distance in device pixels to pick the map position of a point
+    TOLERANCE = 8
+
+    def __init__(self, iface):
+        self.iface = iface
+        self.canvas = iface.mapCanvas()
+        QgsMapToolEmitPoint.__init__(self, self.canvas)
+
+        self.rubberBandTargets = QgsRubberBand(self.canvas, QgsWkbTypes.PointGeometry)
+        self.rubberBandTargets.setColor(Qt.red)
+        self.rubberBandTargets.setIcon(QgsRubberBand.ICON_CIRCLE)
+        self.rubberBandTargets.setIconSize(7)
+        self.rubberBandTargets.setWidth(2)
+
+        self.rubberBandLinks = QgsRubberBand(self.canvas, QgsWkbTypes.LineGeometry)
+        self.rubberBandLinks.setColor(Qt.red)
+        self.rubberBandLinks.setWidth(1)
+
+        self.rubberBandExtent = QgsRubberBand(self.canvas, QgsWkbTypes.LineGeometry)
+        self.rubberBandExtent.setColor(Qt.red)
+        self.rubberBandExtent.setWidth(2)
+
+        self.controlPoints = ControlPoints()
+        self.isAffine = False
+        self.warpMethod = None
+
+        self.reset()
+
+    def setLayer(self, layer):
+        self.layer = layer
+
+    def reset(self):
+        self.controlPoints.clear()
+        self.dragIndex = None
+        self.rubberBandTargets.reset(QgsWkbTypes.PointGeometry)
+        self.rubberBandLinks.reset(QgsWkbTypes.LineGeometry)
+        self.rubberBandExtent.reset(QgsWkbTypes.LineGeometry)
+        if getattr(self, "layer", None) is not None:
+            self.layer.showStatusMessage("", 0)
+        self.layer = None
+
+    def deactivate(self):
+        QgsMapToolEmitPoint.deactivate(self)
+        self.reset()
+
+    def canvasPressEvent(self, e):
+        if self.layer is None:
+            return
+        index = self.nearestPoint(e.pos())
+        if e.button() == Qt.RightButton:
+            if index is None and len(self.controlPoints):
+                index = len(self.controlPoints) - 1
+            if index is not None:
+                self.controlPoints.remove(index)
+                self.updateFit()
+            return
+
+        if index is None:
+            point = self.toMapCoordinates(e.pos())
+            # point of the image as displayed (with the warp of the layer)
+            us, vs = self.layer.canvasToImage([point.x()], [point.y()])
+            index = self.controlPoints.add((us[0], vs[0]), (point.x(), point.y()))
+        self.dragIndex = index
+        self.updateFit()
+
+    def canvasMoveEvent(self, e):
+        if self.dragIndex is None:
+            return
+        point = self.toMapCoordinates(e.pos())
+        self.controlPoints.setMapPoint(self.dragIndex, (point.x(), point.y()))
+        self.updateFit()
+
+    def canvasReleaseEvent(self, e):
+        self.dragIndex = None
+
+    def keyPressEvent(self, e):
+        if self.layer is None:
+            return
+        if e.key() in (Qt.Key_Return, Qt.Key_Enter):
+            self.applyFit()
+        elif e.key() == Qt.Key_Escape:
+            self.controlPoints.clear()
+            self.updateFit()
+        elif e.key() == Qt.Key_A:
+            self.isAffine = not self.isAffine
+            self.updateFit()
+        elif e.key() == Qt.Key_W:
+            index = self.WARP_METHODS.index(self.warpMethod) + 1
+            self.warpMethod = self.WARP_METHODS[index % len(self.WARP_METHODS)]
+            self.updateFit()
+        elif e.key() in (Qt.Key_Backspace, Qt.Key_Delete) and len(self.controlPoints):
+            self.controlPoints.remove(len(self.controlPoints) - 1)
+            self.updateFit()
+        else:
+            e.ignore()
+            return
+        e.accept()
+
+    def nearestPoint(self, pos):
+        """
+        Index of the point whose map position is the nearest to pos (device
+        pixels), None if none within TOLERANCE
+        """
+        best, bestDistance = None, self.TOLERANCE
+        for i, (x, y) in enumerate(self.controlPoints.mapPoints):
+            p = self.toCanvasCoordinates(QgsPointXY(x, y))
+            distance = math.hypot(p.x() - pos.x(), p.y() - pos.y())
+            if distance <= bestDistance:
+                best, bestDistance = i, distance
+        return best
+
+    def solve(self):
+        return self.controlPoints.solve(
+            self.layer.affineTransform(),
+            self.layer.image.width(),
+            self.layer.image.height(),
+            self.isAffine,
+            self.warpMethod,
+        )
+
+    def updateFit(self):
+        controlPoints = self.controlPoints
+        self.rubberBandTargets.reset(QgsWkbTypes.PointGeometry)
+        self.rubberBandLinks.reset(QgsWkbTypes.LineGeometry)
+        self.rubberBandExtent.reset(QgsWkbTypes.LineGeometry)
+
+        # link from the current position of the point of the raster to its
+        # position on the map
+        xs, ys = self.layer.imageToCanvas(*controlPoints.pixelPoints.T)
+        for i, (x0, y0, (x1, y1)) in enumerate(zip(xs, ys, controlPoints.mapPoints)):
+            target = QgsPointXY(float(x1), float(y1))
+            self.rubberBandTargets.addPoint(target, False)
+            self.rubberBandLinks.addPoint(QgsPointXY(float(x0), float(y0)), False, i)
+            self.rubberBandLinks.addPoint(target, False, i)
+        self.rubberBandTargets.show()
+        self.rubberBandLinks.show()
+
+        fit = self.solve()
+        mode = "affine" if self.isAffine else "similarity"
+        if self.warpMethod is not None:
+            mode += ", %s warp" % self.warpMethod
+        if fit is None:
+            message = "press on the raster and release on the map"
+            if self.warpMethod is not None:
+                message = "at least %d points needed for the warp" % (
+                    minimumPointCount(self.warpMethod)
+                )
+            self.layer.showStatusMessage("Control points (%s): %s" % (mode, message), 0)
+            self.canvas.refresh()
+            return
+
+        cornerPoints = self.layer.cornerPoints(fit.transform)
+        for point in cornerPoints:
+            self.rubberBandExtent.addPoint(point, False)
+        self.rubberBandExtent.addPoint(cornerPoints[0], True)
+        self.rubberBandExtent.show()
+
+        residuals = ", ".join("%.3g" % residual for residual in fit.residuals)
+        self.layer.showStatusMessage(
+            "%d control points (%s): RMSE %.3g, residuals %s. Enter to apply"
+            % (len(controlPoints), mode, fit.rmse, residuals),
+            0,
+        )
+
+    def applyFit(self):
+        fit = self.solve()
+        if fit is None:
+            return
+        # the fit is in the CRS of the map: so must be the layer
+        if self.layer.alignToMapCrs():
+            fit = self.solve()
+        centerX, centerY, rotation, xScale, yScale = fit.parameters
+        self.layer.pushHistory()
+        self.layer.setCenter(QgsPointXY(centerX, centerY))
+        self.layer.setRotation(rotation)
+        self.layer.setScale(xScale, yScale)
+        # the points define the whole georeferencing: no warp if not fitted
+        self.layer.setWarp(fit.warp)
+        self.layer.commitTransformParameters()
+        self.controlPoints.clear()
+        self.updateFit()
+
+
+class ClipRasterMapTool(QgsMapToolEmitPoint):
+    """
+    Clip polygon of the raster (for example to hide the collar of a scanned
+    sheet): click the vertices, right click or Enter clips the raster,
+    Backspace removes the last vertex, Escape removes all the vertices
+    """
+
+    def __init__(self, iface):
+        self.iface = iface
+        self.canvas = iface.mapCanvas()
+        QgsMapToolEmitPoint.__init__(self, self.canvas)
+
+        self.rubberBandPolygon = QgsRubberBand(self.canvas, QgsWkbTypes.PolygonGeometry)
+        self.rubberBandPolygon.setStrokeColor(Qt.red)
+        self.rubberBandPolygon.setFillColor(Qt.transparent)
+        self.rubberBandPolygon.setWidth(2)
+
+        self.points = []
+        self.reset()
+
+    def setLayer(self, layer):
+        self.layer = layer
+
+    def reset(self):
+        self.points = []
+        self.rubberBandPolygon.reset(QgsWkbTypes.PolygonGeometry)
+        self.layer = None
+
+    def deactivate(self):
+        QgsMapToolEmitPoint.deactivate(self)
+        self.reset()
+
+    def canvasPressEvent(self, e):
+        if self.layer is None:
+            return
+        if e.button() == Qt.RightButton:
+            self.applyClip()
+            return
+        self.points.append(self.toMapCoordinates(e.pos()))
+        self.updateRubberBand(None)
+
+    def canvasMoveEvent(self, e):
+        if self.layer is None or not self.points:
+            return
+        self.updateRubberBand(self.toMapCoordinates(e.pos()))
+
+    def keyPressEvent(self, e):
+        if self.layer is None:
+            return
+        if e.key() in (Qt.Key_Return, Qt.Key_Enter):
+            self.applyClip()
+        elif e.key() == Qt.Key_Escape:
+            self.points = []
+            self.updateRubberBand(None)
+        elif e.key() in (Qt.Key_Backspace, Qt.Key_Delete) and self.points:
+            self.points.pop()
+            self.updateRubberBand(None)
+        else:
+            e.ignore()
+            return
+        e.accept()
+
+    def updateRubberBand(self, currentPoint):
+        points = list(self.points)
+        if currentPoint is not None:
+            points.append(currentPoint)
+        self.rubberBandPolygon.setToGeometry(QgsGeometry.fromPolygonXY([points]), None)
+
+    def applyClip(self):
+        if len(self.points) < 3:
+            self.layer.showStatusMessage("A clip polygon needs at least 3 points", 2000)
+            return
+        # pixels of the image as displayed (with the warp of the layer)
+        us, vs = self.layer.canvasToImage(
+            [point.x() for point in self.points],
+            [point.y() for point in self.points],
+        )
+        self.layer.setClipRing(list(zip(us, vs)))
+        self.layer.repaint()
+        self.points = []
+        self.updateRubberBand(None)
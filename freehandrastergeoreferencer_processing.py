@@ -0,0 +1,501 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+
+from PyQt5.QtGui import QIcon
+from qgis.core import (
+    QgsCoordinateTransform,
+    QgsFeatureRequest,
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingException,
+    QgsProcessingOutputFile,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterCrs,
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterExtent,
+    QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterFile,
+    QgsProcessingParameterFileDestination,
+    QgsProcessingParameterFolderDestination,
+    QgsProcessingParameterMapLayer,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterRasterDestination,
+    QgsProcessingProvider,
+)
+
+from . import batchexport, rasterexport, tileexport, utils
+from .freehandrastergeoreferencer_commands import (
+    ExportSnapshot,
+    GeorefRasterExport,
+    snapshotSourceRaster,
+)
+from .reprojection import isPluginLayer
+
+# formats written by the algorithms (from the extension of the output)
+OUTPUT_FORMATS = ("tif", "png", "jpg", "bmp", "vrt")
+
+
+class FreehandRasterGeoreferencerProvider(QgsProcessingProvider):
+    def loadAlgorithms(self):
+        self.addAlgorithm(ExportGeorefRasterAlgorithm())
+        self.addAlgorithm(WriteWorldFileAlgorithm())
+        self.addAlgorithm(ApplyAffineParametersAlgorithm())
+        self.addAlgorithm(GenerateMbtilesAlgorithm())
+        self.addAlgorithm(GenerateXyzTilesAlgorithm())
+
+    def id(self):
+        return "freehandrastergeoreferencer"
+
+    def name(self):
+        return "Freehand raster georeferencer"
+
+    def icon(self):
+        return QIcon(":/plugins/freehandrastergeoreferencer/icon.png")
+
+    def supportedOutputRasterLayerExtensions(self):
+        return list(OUTPUT_FORMATS)
+
+
+class BaseAlgorithm(QgsProcessingAlgorithm):
+    def createInstance(self):
+        return type(self)()
+
+    def group(self):
+        return "Georeferencing"
+
+    def groupId(self):
+        return "georeferencing"
+
+    def addResamplingParameter(self):
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                "RESAMPLING",
+                "Resampling",
+                options=[
+                    method.capitalize() for method in rasterexport.RESAMPLING_METHODS
+                ],
+                defaultValue=0,
+            )
+        )
+
+    def addCogParameters(self):
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                "COG", "Cloud-Optimized GeoTIFF (if .tif)", defaultValue=False
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                "COMPRESSION",
+                "Compression of the Cloud-Optimized GeoTIFF",
+                options=list(rasterexport.COG_COMPRESSIONS),
+                defaultValue=0,
+            )
+        )
+
+    def addRegionParameters(self):
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                "PIXEL_SIZE",
+                "Pixel size (0 for the original resolution)",
+                QgsProcessingParameterNumber.Double,
+                defaultValue=0.0,
+                minValue=0.0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterExtent("CLIP_EXTENT", "Clip extent", optional=True)
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                "CLIP_POLYGON",
+                "Clip polygons",
+                [QgsProcessing.TypeVectorPolygon],
+                optional=True,
+            )
+        )
+
+    def region(self, parameters, context, crs):
+        """
+        rasterexport.ExportRegion in crs (the CRS of the raster)
+        """
+        pixelSize = self.parameterAsDouble(parameters, "PIXEL_SIZE", context)
+        extent = None
+        if parameters.get("CLIP_EXTENT"):
+            rectangle = self.parameterAsExtent(parameters, "CLIP_EXTENT", context, crs)
+            extent = (
+                rectangle.xMinimum(),
+                rectangle.yMinimum(),
+                rectangle.xMaximum(),
+                rectangle.yMaximum(),
+            )
+        rings = None
+        source = self.parameterAsSource(parameters, "CLIP_POLYGON", context)
+        if source is not None:
+            transform = QgsCoordinateTransform(
+                source.sourceCrs(), crs, context.transformContext()
+            )
+            rings = []
+            request = QgsFeatureRequest().setNoAttributes()
+            for feature in source.getFeatures(request):
+                geometry = feature.geometry()
+                if geometry.isEmpty():
+                    continue
+                geometry.transform(transform)
+                if geometry.isMultipart():
+                    polygons = geometry.asMultiPolygon()
+                else:
+                    polygons = [geometry.asPolygon()]
+                for polygon in polygons:
+                    rings.extend([(p.x(), p.y()) for p in ring] for ring in polygon)
+            if not rings:
+                raise QgsProcessingException("No clip polygon")
+        return rasterexport.ExportRegion(pixelSize or None, extent, rings)
+
+    def resampling(self, parameters, context):
+        index = self.parameterAsEnum(parameters, "RESAMPLING", context)
+        return rasterexport.RESAMPLING_METHODS[index]
+
+    def compression(self, parameters, context):
+        index = self.parameterAsEnum(parameters, "COMPRESSION", context)
+        return rasterexport.COG_COMPRESSIONS[index]
+
+    def outputFormat(self, outputPath):
+        rasterFormat = utils.imageFormat(outputPath)
+        if rasterFormat not in OUTPUT_FORMATS:
+            raise QgsProcessingException(
+                "Unsupported output format: %s" % os.path.basename(outputPath)
+            )
+        return rasterFormat
+
+
+class LayerAlgorithm(BaseAlgorithm):
+    """
+    Algorithm on a layer of the plugin: the layer is read in
+    prepareAlgorithm (main thread), the export runs on a snapshot
+    """
+
+    def addLayerParameter(self):
+        self.addParameter(
+            QgsProcessingParameterMapLayer(
+                "LAYER", "Freehand raster georeferencer layer"
+            )
+        )
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        layer = self.parameterAsLayer(parameters, "LAYER", context)
+        if not isPluginLayer(layer):
+            raise QgsProcessingException(
+                "The layer must be a Freehand raster georeferencer layer"
+            )
+        if not layer.initialized:
+            raise QgsProcessingException("The layer could not be loaded")
+        # export reads the transform parameters of the layer
+        layer.flushTransformParameters()
+        self.snapshot = ExportSnapshot(layer)
+        return True
+
+    def runExport(self, export, feedback):
+        """
+        False if canceled
+        """
+        try:
+            export.run(feedback)
+            return True
+        except rasterexport.ExportCanceled:
+            feedback.reportError("Canceled")
+            return False
+        except ValueError as ex:
+            raise QgsProcessingException(str(ex))
+
+
+class ExportGeorefRasterAlgorithm(LayerAlgorithm):
+    def name(self):
+        return "exportgeorefraster"
+
+    def displayName(self):
+        return "Export georeferenced raster"
+
+    def shortHelpString(self):
+        return (
+            "Exports the raster of a Freehand raster georeferencer layer, "
+            "rotated and scaled to a north-up grid, with a world file. With a "
+            ".vrt output, a VRT referencing the original raster is written "
+            "instead."
+        )
+
+    def initAlgorithm(self, config=None):
+        self.addLayerParameter()
+        self.addResamplingParameter()
+        self.addRegionParameters()
+        self.addCogParameters()
+        self.addParameter(
+            QgsProcessingParameterRasterDestination("OUTPUT", "Georeferenced raster")
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        outputPath = self.parameterAsOutputLayer(parameters, "OUTPUT", context)
+        rasterFormat = self.outputFormat(outputPath)
+        isCog = (
+            self.parameterAsBool(parameters, "COG", context) and rasterFormat == "tif"
+        )
+        export = GeorefRasterExport(
+            self.snapshot,
+            outputPath,
+            False,
+            False,
+            self.resampling(parameters, context),
+            isCog,
+            self.compression(parameters, context),
+            self.region(parameters, context, self.snapshot.crs),
+        )
+        if not self.runExport(export, feedback):
+            return {}
+        return {"OUTPUT": outputPath}
+
+
+class WriteWorldFileAlgorithm(LayerAlgorithm):
+    def name(self):
+        return "writeworldfile"
+
+    def displayName(self):
+        return "Write world file"
+
+    def shortHelpString(self):
+        return (
+            "Writes the world file (including the rotation) and the .aux.xml "
+            "file with the CRS next to the raster of a Freehand raster "
+            "georeferencer layer. The raster itself is not modified."
+        )
+
+    def initAlgorithm(self, config=None):
+        self.addLayerParameter()
+        self.addOutput(QgsProcessingOutputFile("OUTPUT", "World file"))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        rasterPath = self.snapshot.filepath
+        rasterFormat = utils.imageFormat(rasterPath)
+        if rasterFormat not in rasterexport.WORLD_FILE_EXTENSIONS:
+            raise QgsProcessingException(
+                "No world file for the format of %s" % os.path.basename(rasterPath)
+            )
+        export = GeorefRasterExport(self.snapshot, rasterPath, True, True)
+        if not self.runExport(export, feedback):
+            return {}
+        return {"OUTPUT": export.worldFilePath}
+
+
+class ApplyAffineParametersAlgorithm(BaseAlgorithm):
+    def name(self):
+        return "applyaffineparameters"
+
+    def displayName(self):
+        return "Apply affine parameters to raster"
+
+    def shortHelpString(self):
+        return (
+            "Georeferences a raster file with the transform parameters of the "
+            "plugin (center, rotation clockwise in degrees, scales in map "
+            "units per pixel) and exports it to a north-up grid. With a .vrt "
+            "output, a VRT referencing the raster is written instead. The "
+            "raster must have 1 or 3 Byte bands."
+        )
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterFile("INPUT", "Raster"))
+        for name, description, default in (
+            ("X_CENTER", "X of the center", 0.0),
+            ("Y_CENTER", "Y of the center", 0.0),
+            ("ROTATION", "Rotation (CW, degrees)", 0.0),
+            ("X_SCALE", "X scale (map units per pixel)", 1.0),
+            ("Y_SCALE", "Y scale (map units per pixel)", 1.0),
+        ):
+            self.addParameter(
+                QgsProcessingParameterNumber(
+                    name,
+                    description,
+                    QgsProcessingParameterNumber.Double,
+                    defaultValue=default,
+                )
+            )
+        self.addParameter(QgsProcessingParameterCrs("CRS", "CRS"))
+        self.addResamplingParameter()
+        self.addRegionParameters()
+        self.addCogParameters()
+        self.addParameter(
+            QgsProcessingParameterRasterDestination("OUTPUT", "Georeferenced raster")
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        xScale = self.parameterAsDouble(parameters, "X_SCALE", context)
+        yScale = self.parameterAsDouble(parameters, "Y_SCALE", context)
+        if xScale <= 0 or yScale <= 0:
+            raise QgsProcessingException("The scales must be positive")
+        inputPath = self.parameterAsFile(parameters, "INPUT", context)
+        crs = self.parameterAsCrs(parameters, "CRS", context)
+        job = batchexport.BatchJob(
+            os.path.basename(inputPath),
+            inputPath,
+            self.parameterAsDouble(parameters, "X_CENTER", context),
+            self.parameterAsDouble(parameters, "Y_CENTER", context),
+            self.parameterAsDouble(parameters, "ROTATION", context),
+            xScale,
+            yScale,
+            crs.toWkt(),
+        )
+
+        outputPath = self.parameterAsOutputLayer(parameters, "OUTPUT", context)
+        rasterFormat = self.outputFormat(outputPath)
+        if rasterFormat == "tif" and self.parameterAsBool(parameters, "COG", context):
+            rasterFormat = "cog"
+        options = batchexport.BatchOptions(
+            os.path.dirname(outputPath),
+            rasterFormat,
+            self.resampling(parameters, context),
+            self.compression(parameters, context),
+            threadCount=None,
+            region=self.region(parameters, context, crs),
+        )
+        try:
+            result = batchexport.exportJob(job, outputPath, options, feedback)
+        except rasterexport.ExportCanceled:
+            feedback.reportError("Canceled")
+            return {}
+        if result.error is not None:
+            raise QgsProcessingException(result.error)
+        feedback.pushInfo("Exported in %.2f s" % result.duration)
+        return {"OUTPUT": outputPath}
+
+
+class TilesAlgorithm(LayerAlgorithm):
+    """
+    Web Mercator tiles of a layer (rendered in a thread pool)
+    """
+
+    def addTileParameters(self):
+        self.addLayerParameter()
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                "MIN_ZOOM",
+                "Minimum zoom (default: maximum zoom - 4)",
+                QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                maxValue=tileexport.MAX_ZOOM,
+                optional=True,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                "MAX_ZOOM",
+                "Maximum zoom (default: resolution of the raster)",
+                QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                maxValue=tileexport.MAX_ZOOM,
+                optional=True,
+            )
+        )
+        self.addResamplingParameter()
+
+    def zoom(self, parameters, name, context):
+        if parameters.get(name) is None:
+            return None
+        return self.parameterAsInt(parameters, name, context)
+
+    def exportTiles(self, parameters, context, feedback, outputPath):
+        snapshot = self.snapshot
+        renderer = tileexport.TileRenderer(
+            snapshotSourceRaster(snapshot),
+            snapshot.transform,
+            snapshot.crs.toWkt(),
+            self.resampling(parameters, context),
+            snapshot.clipRing,
+        )
+        try:
+            stats = tileexport.exportTiles(
+                renderer,
+                outputPath,
+                self.zoom(parameters, "MIN_ZOOM", context),
+                self.zoom(parameters, "MAX_ZOOM", context),
+                name=os.path.splitext(os.path.basename(snapshot.filepath))[0],
+                feedback=feedback,
+            )
+        except rasterexport.ExportCanceled:
+            feedback.reportError("Canceled")
+            return False
+        except ValueError as ex:
+            raise QgsProcessingException(str(ex))
+        feedback.pushInfo(str(stats))
+        return True
+
+
+class GenerateMbtilesAlgorithm(TilesAlgorithm):
+    def name(self):
+        return "generatembtiles"
+
+    def displayName(self):
+        return "Generate MBTiles"
+
+    def shortHelpString(self):
+        return (
+            "Renders the raster of a Freehand raster georeferencer layer to "
+            "Web Mercator tiles in an MBTiles file. Transparent tiles are "
+            "skipped and identical tiles are stored once."
+        )
+
+    def initAlgorithm(self, config=None):
+        self.addTileParameters()
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                "OUTPUT", "MBTiles", "MBTiles (*.mbtiles)"
+            )
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        outputPath = self.parameterAsFileOutput(parameters, "OUTPUT", context)
+        if not tileexport.isMbtiles(outputPath):
+            raise QgsProcessingException("The output must be a .mbtiles file")
+        if not self.exportTiles(parameters, context, feedback, outputPath):
+            return {}
+        return {"OUTPUT": outputPath}
+
+
+class GenerateXyzTilesAlgorithm(TilesAlgorithm):
+    def name(self):
+        return "generatexyztiles"
+
+    def displayName(self):
+        return "Generate XYZ tiles (directory)"
+
+    def shortHelpString(self):
+        return (
+            "Renders the raster of a Freehand raster georeferencer layer to "
+            "Web Mercator tiles in a z/x/y.png directory. Transparent tiles "
+            "are skipped and identical tiles are hard links to the same file."
+        )
+
+    def initAlgorithm(self, config=None):
+        self.addTileParameters()
+        self.addParameter(
+            QgsProcessingParameterFolderDestination("OUTPUT", "Output directory")
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        outputPath = self.parameterAsFileOutput(parameters, "OUTPUT", context)
+        if tileexport.isMbtiles(outputPath):
+            raise QgsProcessingException(
+                "The output must be a directory, use Generate MBTiles for "
+                "a .mbtiles file"
+            )
+        if not self.exportTiles(parameters, context, feedback, outputPath):
+            return {}
+        return {"OUTPUT": outputPath}
@@ -39,6 +39,9 @@ class FreehandRasterGeoreferencerDialog(QDialog, Ui_FreehandRasterGeoreferencer)
             imagepath = layer.filepath
 
         self.lineEditImagePath.setText(imagepath)
+        self.checkBoxDeskew.setChecked(
+            utils.readSetting(utils.SETTING_DESKEW_ON_ADD, False, bool)
+        )
 
     def showBrowserDialog(self):
         bDir, found = QgsProject.instance().readEntry(
@@ -90,6 +93,9 @@ class FreehandRasterGeoreferencerDialog(QDialog, Ui_FreehandRasterGeoreferencer)
 
         result, message, details = self.validate()
         if result:
+            utils.writeSetting(
+                utils.SETTING_DESKEW_ON_ADD, self.checkBoxDeskew.isChecked()
+            )
             self.done(retValue)
         else:
             msgBox = QMessageBox()
@@ -1,4 +1,3 @@
-import numpy as np
 from osgeo import gdal
 
 
@@ -26,9 +25,15 @@ def pixels(filepath):
     return data
 
 
-def to_byte(data):
-    min_ = np.min(data)
-    max_ = np.max(data)
-    data = 255.0 * (data - min_) / (max_ - min_)
-    data = data.astype(np.uint8)
-    return data
+def mask(filepath):
+    """
+    GDAL mask band of the first band (0 for the invalid pixels), None if all
+    the pixels are valid
+    """
+    dataset = gdal.Open(filepath, gdal.GA_ReadOnly)
+    if dataset is None or dataset.RasterCount == 0:
+        return None
+    band = dataset.GetRasterBand(1)
+    if band.GetMaskFlags() & gdal.GMF_ALL_VALID:
+        return None
+    return band.GetMaskBand().ReadAsArray()
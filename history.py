@@ -0,0 +1,115 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from collections import deque
+import time
+
+from qgis.core import QgsPointXY
+
+
+class TransformSnapshot(object):
+    """
+    Full transform parameters of a layer at some point in time
+    """
+
+    __slots__ = ("xCenter", "yCenter", "rotation", "xScale", "yScale", "warp", "crs")
+
+    def __init__(self, xCenter, yCenter, rotation, xScale, yScale, warp=None, crs=None):
+        self.xCenter = xCenter
+        self.yCenter = yCenter
+        self.rotation = rotation
+        self.xScale = xScale
+        self.yScale = yScale
+        # warp.Warp (immutable, shared with the layer)
+        self.warp = warp
+        # CRS of the parameters (QgsCoordinateReferenceSystem), None to keep
+        # the CRS of the layer
+        self.crs = crs
+
+    @classmethod
+    def fromLayer(cls, layer):
+        return cls(
+            layer.center.x(),
+            layer.center.y(),
+            layer.rotation,
+            layer.xScale,
+            layer.yScale,
+            layer.warp,
+            layer.crs(),
+        )
+
+    def applyTo(self, layer):
+        if self.crs is not None and layer.crs() != self.crs:
+            layer.setCrs(self.crs)
+        layer.setCenter(QgsPointXY(self.xCenter, self.yCenter))
+        layer.setRotation(self.rotation)
+        layer.setScale(self.xScale, self.yScale)
+        if layer.warp is not self.warp:
+            layer.setWarp(self.warp)
+
+
+class TransformHistory(object):
+    """
+    Bounded undo / redo stacks of transform snapshots. When full, the oldest
+    entries are dropped.
+    """
+
+    # consecutive pushes with the same merge key closer than this (in
+    # seconds) are coalesced into a single entry
+    MERGE_INTERVAL = 1.0
+
+    def __init__(self, limit):
+        self._undoStack = deque(maxlen=limit)
+        self._redoStack = deque(maxlen=limit)
+        self._mergeKey = None
+        self._mergeTime = 0
+
+    def push(self, snapshot, mergeKey=None):
+        """
+        Records the state before a change. If mergeKey is not None and the
+        previous push had the same key, the change is merged with the
+        previous one: undo will go back to the state before the first change
+        """
+        now = time.monotonic()
+        isMerged = (
+            mergeKey is not None
+            and mergeKey == self._mergeKey
+            and now - self._mergeTime < self.MERGE_INTERVAL
+            and len(self._undoStack) > 0
+        )
+        if not isMerged:
+            self._undoStack.append(snapshot)
+        self._redoStack.clear()
+        self._mergeKey = mergeKey
+        self._mergeTime = now
+
+    def undo(self, current):
+        """
+        Returns the snapshot to restore or None if nothing to undo. current
+        is the snapshot of the current state, to be restored by redo
+        """
+        return self._move(self._undoStack, self._redoStack, current)
+
+    def redo(self, current):
+        return self._move(self._redoStack, self._undoStack, current)
+
+    def _move(self, fromStack, toStack, current):
+        self._mergeKey = None
+        if not fromStack:
+            return None
+        toStack.append(current)
+        return fromStack.pop()
+
+    def canUndo(self):
+        return len(self._undoStack) > 0
+
+    def canRedo(self):
+        return len(self._redoStack) > 0
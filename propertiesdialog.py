@@ -9,8 +9,11 @@
  ***************************************************************************/
 """
 
+from PyQt5.QtCore import QTimer
+from PyQt5.QtGui import QColor
 from PyQt5.QtWidgets import QDialog
 
+from .alphamask import AlphaMask, MASK_COLOR_KEY, MASK_GDAL, MASK_NODATA
 from .ui_propertiesdialog import Ui_Dialog
 
 
@@ -28,6 +31,42 @@ class PropertiesDialog(QDialog, Ui_Dialog):
         self.textEdit_Properties.setText(layer.metadata())
         self.spinBox_Transparency.setValue(layer.transparency)
 
+        self.comboBox_AlphaMask.addItem(self.tr("None"), None)
+        self.comboBox_AlphaMask.addItem(self.tr("Nodata value"), MASK_NODATA)
+        self.comboBox_AlphaMask.addItem(self.tr("Color (e.g. paper)"), MASK_COLOR_KEY)
+        self.comboBox_AlphaMask.addItem(self.tr("GDAL mask band"), MASK_GDAL)
+        self.comboBox_AlphaMask.currentIndexChanged.connect(self.alphaMaskChanged)
+        alphaMask = layer.alphaMask or AlphaMask(MASK_COLOR_KEY, tolerance=16)
+        self.spinBox_Nodata.setValue(alphaMask.nodata)
+        self.colorButton_ColorKey.setColor(QColor(*alphaMask.color))
+        self.spinBox_Tolerance.setValue(alphaMask.tolerance)
+        method = layer.alphaMask.method if layer.alphaMask is not None else None
+        self.comboBox_AlphaMask.setCurrentIndex(
+            self.comboBox_AlphaMask.findData(method)
+        )
+        self.alphaMaskChanged()
+
+        # stretch of a high bit depth raster, previewed on the layer while
+        # it is edited (once per turn of the event loop)
+        self.stretchTimer = QTimer(self)
+        self.stretchTimer.setSingleShot(True)
+        self.stretchTimer.setInterval(0)
+        self.stretchTimer.timeout.connect(self.applyStretch)
+        hasStretch = layer.rawBands is not None and layer.stretch is not None
+        for widget in (
+            self.spinBox_Brightness,
+            self.doubleSpinBox_Contrast,
+            self.doubleSpinBox_Gamma,
+        ):
+            widget.setEnabled(hasStretch)
+        if hasStretch:
+            self.spinBox_Brightness.setValue(round(layer.stretch.brightness * 100))
+            self.doubleSpinBox_Contrast.setValue(layer.stretch.contrast)
+            self.doubleSpinBox_Gamma.setValue(layer.stretch.gamma)
+            self.spinBox_Brightness.valueChanged.connect(self.stretchTimer.start)
+            self.doubleSpinBox_Contrast.valueChanged.connect(self.stretchTimer.start)
+            self.doubleSpinBox_Gamma.valueChanged.connect(self.stretchTimer.start)
+
     def sliderChanged(self, val):
         s = self.spinBox_Transparency
         s.blockSignals(True)
@@ -39,3 +78,40 @@ class PropertiesDialog(QDialog, Ui_Dialog):
         s.blockSignals(True)
         s.setValue(val)
         s.blockSignals(False)
+
+    def alphaMaskChanged(self):
+        method = self.comboBox_AlphaMask.currentData()
+        self.spinBox_Nodata.setEnabled(method == MASK_NODATA)
+        self.colorButton_ColorKey.setEnabled(method == MASK_COLOR_KEY)
+        self.spinBox_Tolerance.setEnabled(method == MASK_COLOR_KEY)
+
+    def alphaMask(self):
+        """
+        AlphaMask chosen in the dialog, None for none
+        """
+        method = self.comboBox_AlphaMask.currentData()
+        if method is None:
+            return None
+        color = self.colorButton_ColorKey.color()
+        return AlphaMask(
+            method,
+            self.spinBox_Nodata.value(),
+            (color.red(), color.green(), color.blue()),
+            self.spinBox_Tolerance.value(),
+        )
+
+    def stretch(self):
+        """
+        Stretch chosen in the dialog, None if the layer has no stretch
+        """
+        if self.layer.rawBands is None or self.layer.stretch is None:
+            return None
+        return self.layer.stretch.withAdjustments(
+            self.spinBox_Brightness.value() / 100.0,
+            self.doubleSpinBox_Contrast.value(),
+            self.doubleSpinBox_Gamma.value(),
+        )
+
+    def applyStretch(self):
+        # preview only: the full resolution image is computed if accepted
+        self.layer.setPreviewStretch(self.stretch())
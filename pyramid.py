@@ -0,0 +1,51 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import numpy as np
+
+
+def halve(array):
+    """
+    Array at half the resolution (mean of 2 x 2 pixels, the last row or
+    column is dropped if odd). Works on (h, w) and (h, w, channels) arrays
+    """
+    height, width = array.shape[0] // 2 * 2, array.shape[1] // 2 * 2
+    array = array[:height, :width].astype(np.float32)
+    return (
+        array[0::2, 0::2] + array[1::2, 0::2] + array[0::2, 1::2] + array[1::2, 1::2]
+    ) / 4
+
+
+def pyramidLevels(array, minSize=32):
+    """
+    Levels of the pyramid of an array, from the full resolution to the
+    coarsest level whose smallest side is at least minSize
+    """
+    levels = [np.asarray(array, dtype=np.float32)]
+    while min(levels[-1].shape[:2]) // 2 >= minSize:
+        levels.append(halve(levels[-1]))
+    return levels
+
+
+def thumbnail(source, size=512):
+    """
+    RGBA thumbnail (float32) of a source raster (see rasterexport) whose
+    largest side is at most size: the source is read decimated to less than
+    twice the size then halved, so the cost is bounded by the size of the
+    thumbnail whatever the size of the source
+    """
+    stride = max(1, max(source.width, source.height) // (2 * size))
+    level = np.asarray(
+        source.read(0, 0, source.width, source.height, stride), dtype=np.float32
+    )
+    while max(level.shape[:2]) > size:
+        level = halve(level)
+    return level
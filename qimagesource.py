@@ -0,0 +1,49 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Pixels of a QImage read as a source raster (see rasterexport), kept apart
+so rasterexport does not need Qt.
+"""
+
+import numpy as np
+from PyQt5.QtCore import QSysInfo
+from PyQt5.QtGui import QImage
+
+from .rasterexport import ArraySourceRaster
+
+
+def imageSourceRaster(image):
+    """
+    Source raster reading the pixels of a QImage (without copy for the
+    common 32-bit formats)
+    """
+    if image.format() not in (
+        QImage.Format_RGB32,
+        QImage.Format_ARGB32,
+        QImage.Format_RGBA8888,
+    ):
+        image = image.convertToFormat(QImage.Format_ARGB32)
+    bits = image.constBits()
+    bits.setsize(image.bytesPerLine() * image.height())
+    array = np.frombuffer(bits, dtype=np.uint8).reshape(
+        image.height(), image.bytesPerLine()
+    )
+    array = array[:, : image.width() * 4].reshape(image.height(), image.width(), 4)
+    if image.format() == QImage.Format_RGBA8888:
+        # bytes in R, G, B, A order whatever the byte order of the platform
+        return ArraySourceRaster(array, (0, 1, 2), 3, owner=image)
+    # 32-bit 0xAARRGGBB values: the order of the bytes depends on the platform
+    if QSysInfo.ByteOrder == QSysInfo.LittleEndian:
+        channels, alphaChannel = (2, 1, 0), 3
+    else:
+        channels, alphaChannel = (1, 2, 3), 0
+    if image.format() == QImage.Format_RGB32:
+        alphaChannel = None
+    return ArraySourceRaster(array, channels, alphaChannel, owner=image)
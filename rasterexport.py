@@ -0,0 +1,791 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+import threading
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from osgeo import gdal
+
+from .affine import AffineTransform
+from .alphamask import MASK_GDAL
+from .collar import densifyRing
+from .uniformtiles import isBlank
+
+# size of the blocks (output tiles) processed at once
+BLOCK_SIZE = 512
+# points per edge of the clip polygon of a warped image
+CLIP_RING_DENSITY = 16
+
+RESAMPLING_NEAREST = "nearest"
+RESAMPLING_BILINEAR = "bilinear"
+RESAMPLING_CUBIC = "cubic"
+RESAMPLING_METHODS = (RESAMPLING_NEAREST, RESAMPLING_BILINEAR, RESAMPLING_CUBIC)
+
+COG_COMPRESSIONS = ("DEFLATE", "ZSTD", "JPEG", "WEBP")
+
+# GDAL resampling of the COG overviews for each resampling method
+COG_OVERVIEW_RESAMPLING = {
+    RESAMPLING_NEAREST: "NEAREST",
+    RESAMPLING_BILINEAR: "BILINEAR",
+    RESAMPLING_CUBIC: "CUBIC",
+}
+
+# GDAL driver and number of bands (RGBA or RGB) for the exported formats
+FORMATS = {
+    "tif": ("GTiff", 4),
+    "png": ("PNG", 4),
+    "jpg": ("JPEG", 3),
+    "bmp": ("BMP", 3),
+}
+
+
+class ExportCanceled(Exception):
+    pass
+
+
+class SubFeedback(object):
+    """
+    Maps the progress (0 - 100) of a step to the range [start, end] of the
+    progress of a feedback (QgsTask, QgsFeedback or any object with
+    setProgress and isCanceled)
+    """
+
+    def __init__(self, feedback, start, end):
+        self.feedback = feedback
+        self.start = start
+        self.end = end
+
+    def setProgress(self, progress):
+        if self.feedback is not None:
+            self.feedback.setProgress(
+                self.start + (self.end - self.start) * progress / 100.0
+            )
+
+    def isCanceled(self):
+        return self.feedback is not None and self.feedback.isCanceled()
+
+    def checkCanceled(self):
+        if self.isCanceled():
+            raise ExportCanceled()
+
+    def gdalCallback(self, complete, message, data):
+        # GDAL progress callback: returning 0 interrupts the operation
+        self.setProgress(complete * 100)
+        return 0 if self.isCanceled() else 1
+
+
+class ArraySourceRaster(object):
+    """
+    Image already in memory as an array of shape (height, width, channels)
+    """
+
+    def __init__(self, array, channels, alphaChannel=None, owner=None):
+        # channels: index of R, G, B in the last dimension of array
+        self.array = array
+        self.channels = channels
+        self.alphaChannel = alphaChannel
+        # keeps alive the object owning the memory (for example QImage)
+        self.owner = owner
+        self.height, self.width = array.shape[:2]
+
+    def read(self, xoff, yoff, xsize, ysize, factor=1):
+        """
+        Window of pixels as an RGBA array of shape (ysize, xsize, 4). If
+        factor > 1, the window is decimated by factor in both directions
+        (shape (ceil(ysize / factor), ceil(xsize / factor), 4))
+        """
+        window = self.array[yoff : yoff + ysize : factor, xoff : xoff + xsize : factor]
+        rgba = np.empty(window.shape[:2] + (4,), dtype=np.uint8)
+        for i, channel in enumerate(self.channels):
+            rgba[..., i] = window[..., channel]
+        if self.alphaChannel is None:
+            rgba[..., 3] = 255
+        else:
+            rgba[..., 3] = window[..., self.alphaChannel]
+        return rgba
+
+
+class GdalSourceRaster(object):
+    """
+    Image read by windows from a GDAL raster with 1 (grayscale) or 3 (RGB)
+    Byte bands
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # GDAL datasets must not be shared between threads: one per thread
+        self._local = threading.local()
+        dataset = self.dataset()
+        self.width = dataset.RasterXSize
+        self.height = dataset.RasterYSize
+        self.bandCount = dataset.RasterCount
+
+    def dataset(self):
+        dataset = getattr(self._local, "dataset", None)
+        if dataset is None:
+            dataset = gdal.Open(self.path, gdal.GA_ReadOnly)
+            if dataset is None:
+                raise IOError("Unable to open %s" % self.path)
+            self._local.dataset = dataset
+        return dataset
+
+    @staticmethod
+    def isSupported(path, width, height):
+        """
+        True if the raster can be read with GDAL and gives the same pixels
+        as the image displayed by the plugin
+        """
+        dataset = gdal.Open(path, gdal.GA_ReadOnly)
+        if dataset is None:
+            return False
+        if (dataset.RasterXSize, dataset.RasterYSize) != (width, height):
+            return False
+        if dataset.RasterCount not in (1, 3):
+            return False
+        for i in range(dataset.RasterCount):
+            band = dataset.GetRasterBand(i + 1)
+            if band.DataType != gdal.GDT_Byte or band.GetColorTable() is not None:
+                return False
+        return True
+
+    def read(self, xoff, yoff, xsize, ysize, factor=1):
+        # when decimated, GDAL reads from the nearest overview if any
+        bufXSize = math.ceil(xsize / factor)
+        bufYSize = math.ceil(ysize / factor)
+        data = self.dataset().ReadAsArray(
+            xoff, yoff, xsize, ysize, buf_xsize=bufXSize, buf_ysize=bufYSize
+        )
+        if data is None:
+            raise IOError("Unable to read %s" % self.path)
+        if data.ndim == 2:
+            data = data[np.newaxis, ...]
+        rgba = np.empty((bufYSize, bufXSize, 4), dtype=np.uint8)
+        for i in range(3):
+            rgba[..., i] = data[min(i, len(data) - 1)]
+        rgba[..., 3] = 255
+        return rgba
+
+    def readMask(self, xoff, yoff, xsize, ysize, factor=1):
+        """
+        Window of the GDAL mask band of the first band (0 for the invalid
+        pixels), decimated as read
+        """
+        band = self.dataset().GetRasterBand(1).GetMaskBand()
+        return band.ReadAsArray(
+            xoff,
+            yoff,
+            xsize,
+            ysize,
+            buf_xsize=math.ceil(xsize / factor),
+            buf_ysize=math.ceil(ysize / factor),
+        )
+
+
+class MaskedSourceRaster(object):
+    """
+    Source raster whose pixels are made transparent by an
+    alphamask.AlphaMask, window by window
+    """
+
+    def __init__(self, source, alphaMask):
+        # GdalSourceRaster if the mask is the GDAL mask band
+        self.source = source
+        self.alphaMask = alphaMask
+        self.width = source.width
+        self.height = source.height
+
+    def read(self, xoff, yoff, xsize, ysize, factor=1):
+        rgba = self.source.read(xoff, yoff, xsize, ysize, factor)
+        gdalMask = None
+        if self.alphaMask.method == MASK_GDAL:
+            gdalMask = self.source.readMask(xoff, yoff, xsize, ysize, factor)
+        return self.alphaMask.applyTo(rgba, gdalMask)
+
+
+class DecimatedSourceRaster(object):
+    """
+    Source raster at a lower resolution (1 pixel for factor x factor pixels
+    of the source), read from the overviews of the source if it has some
+    """
+
+    def __init__(self, source, factor):
+        self.source = source
+        self.factor = factor
+        self.width = math.ceil(source.width / factor)
+        self.height = math.ceil(source.height / factor)
+
+    def read(self, xoff, yoff, xsize, ysize):
+        f = self.factor
+        sourceXoff = xoff * f
+        sourceYoff = yoff * f
+        return self.source.read(
+            sourceXoff,
+            sourceYoff,
+            min(xsize * f, self.source.width - sourceXoff),
+            min(ysize * f, self.source.height - sourceYoff),
+            f,
+        )
+
+
+def overviewSource(source, transform, pixelSize):
+    """
+    (source, transform) to read for an output of pixelSize: the source is
+    decimated by the largest power of 2 that keeps at least one source pixel
+    per output pixel
+    """
+    sourcePixelSize = max(
+        math.hypot(transform.a, transform.d), math.hypot(transform.b, transform.e)
+    )
+    ratio = pixelSize / sourcePixelSize
+    if ratio < 2:
+        return source, transform
+    factor = 2 ** int(math.floor(math.log2(ratio)))
+    scale = AffineTransform(factor, 0.0, 0.0, 0.0, factor, 0.0)
+    return DecimatedSourceRaster(source, factor), transform.compose(scale, first=True)
+
+
+def pointsInPolygon(xs, ys, rings):
+    """
+    Boolean array: True for the points (arrays xs, ys of the same shape)
+    inside the polygon, given as a list of rings ((N, 2) array-likes; even-odd
+    rule so holes and multipolygons can be given as a flat list of rings)
+    """
+    inside = np.zeros(np.shape(xs), dtype=bool)
+    for ring in rings:
+        ring = np.asarray(ring, dtype=np.float64)
+        x0s, y0s = ring[:, 0], ring[:, 1]
+        x1s, y1s = np.roll(x0s, -1), np.roll(y0s, -1)
+        for x0, y0, x1, y1 in zip(x0s, y0s, x1s, y1s):
+            if y0 == y1:
+                continue
+            crosses = (y0 > ys) != (y1 > ys)
+            xCross = x0 + (ys - y0) * (x1 - x0) / (y1 - y0)
+            inside ^= crosses & (xs < xCross)
+    return inside
+
+
+class ExportRegion(object):
+    """
+    Part of the georeferenced raster to export: pixel size of the output
+    (None for the original resolution), clip extent (xMin, yMin, xMax, yMax)
+    and clip polygon (list of rings, see pointsInPolygon), all optional and
+    in the CRS of the layer
+    """
+
+    __slots__ = ("pixelSize", "extent", "rings")
+
+    def __init__(self, pixelSize=None, extent=None, rings=None):
+        self.pixelSize = pixelSize
+        self.extent = extent
+        self.rings = rings
+
+    def clipBounds(self, bounds):
+        """
+        Intersection of bounds with the clip extent and polygon, None if
+        empty
+        """
+        xMin, yMin, xMax, yMax = bounds
+        clips = []
+        if self.extent is not None:
+            clips.append(self.extent)
+        if self.rings:
+            points = np.concatenate([np.asarray(ring) for ring in self.rings])
+            clips.append(tuple(points.min(axis=0)) + tuple(points.max(axis=0)))
+        for cxMin, cyMin, cxMax, cyMax in clips:
+            xMin, yMin = max(xMin, cxMin), max(yMin, cyMin)
+            xMax, yMax = min(xMax, cxMax), min(yMax, cyMax)
+        if xMin >= xMax or yMin >= yMax:
+            return None
+        return (xMin, yMin, xMax, yMax)
+
+
+class OutputGrid(object):
+    """
+    North-up grid of the exported raster. Pixels outside of rings or of
+    clipRings (if not None) are transparent
+    """
+
+    __slots__ = ("geotransform", "width", "height", "rings", "clipRings")
+
+    def __init__(self, geotransform, width, height, rings=None, clipRings=None):
+        self.geotransform = geotransform
+        self.width = width
+        self.height = height
+        self.rings = rings
+        # clip polygon of the layer (collar.py) in map coordinates
+        self.clipRings = clipRings
+
+    def mask(self, xs, ys):
+        """
+        Boolean array: True for the map coordinates inside the clip rings,
+        None if the grid is not clipped
+        """
+        mask = None
+        for rings in (self.rings, self.clipRings):
+            if rings:
+                inside = pointsInPolygon(xs, ys, rings)
+                mask = inside if mask is None else mask & inside
+        return mask
+
+    def pixelSize(self):
+        return self.geotransform[1]
+
+    def blockCount(self, blockSize=BLOCK_SIZE):
+        return math.ceil(self.width / blockSize) * math.ceil(self.height / blockSize)
+
+    def blocks(self, blockSize=BLOCK_SIZE):
+        """
+        (xoff, yoff, xsize, ysize) of the blocks covering the grid
+        """
+        for yoff in range(0, self.height, blockSize):
+            for xoff in range(0, self.width, blockSize):
+                yield (
+                    xoff,
+                    yoff,
+                    min(blockSize, self.width - xoff),
+                    min(blockSize, self.height - yoff),
+                )
+
+
+def outputGrid(transform, width, height, region=None, clipRing=None):
+    """
+    Grid covering the image transformed with transform (pixel to map). By
+    default, maintain at least the original resolution of the raster.
+    region (ExportRegion) can set the pixel size and clip the grid.
+    clipRing is the clip polygon of the image (pixel coordinates, see
+    collar.py), the grid is reduced to its bounds
+    """
+    region = region or ExportRegion()
+    pixelSize = region.pixelSize
+    if not pixelSize:
+        xScale = math.hypot(transform.a, transform.d)
+        yScale = math.hypot(transform.b, transform.e)
+        pixelSize = min(xScale, yScale)
+    bounds = region.clipBounds(transform.bounds(width, height))
+    clipRings = None
+    if clipRing is not None and bounds is not None:
+        if not isinstance(transform, AffineTransform):
+            # warped: the edges of the polygon are curves on the map
+            clipRing = densifyRing(clipRing, CLIP_RING_DENSITY)
+        clipRings = [transform.mapArray(clipRing)]
+        bounds = ExportRegion(rings=clipRings).clipBounds(bounds)
+    if bounds is None:
+        raise ValueError("The clip region does not intersect the raster")
+    xMin, yMin, xMax, yMax = bounds
+    outWidth = max(1, math.ceil((xMax - xMin) / pixelSize))
+    outHeight = max(1, math.ceil((yMax - yMin) / pixelSize))
+    geotransform = (float(xMin), pixelSize, 0.0, float(yMax), 0.0, -pixelSize)
+    return OutputGrid(geotransform, outWidth, outHeight, region.rings, clipRings)
+
+
+def _cubicWeights(t):
+    # Keys cubic convolution (a = -0.5), for the taps at -1, 0, 1, 2
+    t2 = t * t
+    t3 = t2 * t
+    return (
+        -0.5 * t3 + t2 - 0.5 * t,
+        1.5 * t3 - 2.5 * t2 + 1,
+        -1.5 * t3 + 2 * t2 + 0.5 * t,
+        0.5 * t3 - 0.5 * t2,
+    )
+
+
+def _kernel(coordinates, resampling):
+    """
+    First tap (integer pixel index) and weights of the taps for each of the
+    continuous pixel coordinates
+    """
+    if resampling == RESAMPLING_NEAREST:
+        return np.floor(coordinates).astype(np.int64), (1.0,)
+    # pixel centers are at i + 0.5
+    coordinates = coordinates - 0.5
+    start = np.floor(coordinates)
+    t = coordinates - start
+    start = start.astype(np.int64)
+    if resampling == RESAMPLING_BILINEAR:
+        return start, (1 - t, t)
+    return start - 1, _cubicWeights(t)
+
+
+def sampleBlock(source, inverse, grid, block, resampling=RESAMPLING_NEAREST):
+    """
+    RGBA pixels (shape (ysize, xsize, 4)) of a block of the output grid,
+    resampled from the source. inverse is the map to pixel transform of the
+    source. Outside of the source (or of the clip polygon of the grid),
+    pixels are transparent
+    """
+    xoff, yoff, xsize, ysize = block
+    cols = np.arange(xoff, xoff + xsize) + 0.5
+    rows = np.arange(yoff, yoff + ysize) + 0.5
+    outputTransform = AffineTransform.fromGdal(grid.geotransform)
+    xs, ys = outputTransform.mapArrays(*np.meshgrid(cols, rows))
+    mask = grid.mask(xs, ys)
+    if mask is not None and not mask.any():
+        # fully clipped: the source is not read
+        return np.zeros((ysize, xsize, 4), dtype=np.uint8)
+    us, vs = inverse.mapArrays(xs, ys)
+    return samplePixels(source, us, vs, resampling, mask)
+
+
+def samplePixels(source, us, vs, resampling=RESAMPLING_NEAREST, mask=None):
+    """
+    RGBA pixels (shape us.shape + (4,)) of the source at the pixel
+    coordinates us, vs (continuous: pixel centers at i + 0.5). Outside of the
+    source or where mask is False, pixels are transparent
+    """
+    valid = (us >= 0) & (us < source.width) & (vs >= 0) & (vs < source.height)
+    if mask is not None:
+        valid &= mask
+    pixels = np.zeros(us.shape + (4,), dtype=np.uint8)
+    if not valid.any():
+        return pixels
+
+    us = us[valid]
+    vs = vs[valid]
+    uStart, uWeights = _kernel(us, resampling)
+    vStart, vWeights = _kernel(vs, resampling)
+    # taps outside of the source are clamped to the edge
+    uTaps = [np.clip(uStart + i, 0, source.width - 1) for i in range(len(uWeights))]
+    vTaps = [np.clip(vStart + i, 0, source.height - 1) for i in range(len(vWeights))]
+
+    # only read the part of the source covered by the pixels
+    x0, x1 = uTaps[0].min(), uTaps[-1].max()
+    y0, y1 = vTaps[0].min(), vTaps[-1].max()
+    window = source.read(x0, y0, x1 - x0 + 1, y1 - y0 + 1)
+
+    if resampling == RESAMPLING_NEAREST:
+        pixels[valid] = window[vTaps[0] - y0, uTaps[0] - x0]
+        return pixels
+
+    # interpolate with premultiplied alpha so transparent pixels do not bleed
+    window = window.astype(np.float32)
+    window[..., :3] *= window[..., 3:] / 255.0
+    values = np.zeros((len(us), 4), dtype=np.float32)
+    for vTap, vWeight in zip(vTaps, vWeights):
+        for uTap, uWeight in zip(uTaps, uWeights):
+            weight = (vWeight * uWeight).astype(np.float32)
+            values += weight[:, np.newaxis] * window[vTap - y0, uTap - x0]
+    alpha = np.clip(values[:, 3:], 0, 255)
+    values[:, :3] *= 255.0 / np.maximum(alpha, 1e-6)
+    values[:, 3:] = alpha
+    pixels[valid] = np.clip(np.rint(values), 0, 255).astype(np.uint8)
+    return pixels
+
+
+def sampledBlocks(source, inverse, grid, resampling, threadCount=None):
+    """
+    Yields (block, pixels) for all the blocks of the grid, in order. The
+    blocks are resampled in parallel in a thread pool (NumPy and GDAL release
+    the GIL) with a bounded number of blocks in flight
+    """
+    threadCount = threadCount or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=threadCount) as executor:
+        pending = deque()
+        for block in grid.blocks():
+            future = executor.submit(
+                sampleBlock, source, inverse, grid, block, resampling
+            )
+            pending.append((block, future))
+            if len(pending) >= 2 * threadCount:
+                block, future = pending.popleft()
+                yield block, future.result()
+        while pending:
+            block, future = pending.popleft()
+            yield block, future.result()
+
+
+def writeGeoTiff(
+    source,
+    transform,
+    grid,
+    path,
+    bandCount,
+    crsWkt,
+    resampling=RESAMPLING_NEAREST,
+    threadCount=None,
+    compression="LZW",
+    feedback=None,
+):
+    """
+    Writes the source image transformed with transform (pixel to map) on the
+    grid to a tiled GeoTIFF, block by block, so the memory used does not
+    depend on the size of the image. resampling is one of RESAMPLING_METHODS.
+    LZW compression by default: useful for scanned documents (mostly white).
+    Blank blocks (transparent corners of a rotated image, clipped parts) are
+    not written at all: sparse blocks, read as transparent. The progress is
+    reported to feedback after each block; if canceled, the partial file is
+    deleted and ExportCanceled is raised
+    """
+    feedback = SubFeedback(feedback, 0, 100)
+    options = [
+        "TILED=YES",
+        "BLOCKXSIZE=%d" % BLOCK_SIZE,
+        "BLOCKYSIZE=%d" % BLOCK_SIZE,
+        "COMPRESS=%s" % compression,
+        "PHOTOMETRIC=RGB",
+        "BIGTIFF=IF_SAFER",
+        "SPARSE_OK=TRUE",
+    ]
+    if bandCount == 4:
+        options.append("ALPHA=YES")
+    driver = gdal.GetDriverByName("GTiff")
+    dataset = driver.Create(
+        path, grid.width, grid.height, bandCount, gdal.GDT_Byte, options=options
+    )
+    if dataset is None:
+        raise IOError("Unable to create %s" % path)
+
+    isComplete = False
+    try:
+        dataset.SetGeoTransform(grid.geotransform)
+        if crsWkt:
+            dataset.SetProjection(crsWkt)
+
+        # lower resolution output: read less pixels
+        source, transform = overviewSource(source, transform, grid.pixelSize())
+        inverse = transform.inverted()
+        blockCount = grid.blockCount()
+        # written from this thread only
+        blocks = sampledBlocks(source, inverse, grid, resampling, threadCount)
+        for i, (block, pixels) in enumerate(blocks):
+            feedback.checkCanceled()
+            xoff, yoff, _, _ = block
+            if not isBlank(pixels, bandCount):
+                for band in range(bandCount):
+                    dataset.GetRasterBand(band + 1).WriteArray(
+                        pixels[..., band], xoff, yoff
+                    )
+            feedback.setProgress(100.0 * (i + 1) / blockCount)
+        dataset.FlushCache()
+        isComplete = True
+    finally:
+        dataset = None
+        if not isComplete:
+            deleteRaster(path)
+
+
+def copyRaster(sourcePath, path, driverName, options, feedback=None):
+    feedback = SubFeedback(feedback, 0, 100)
+    driver = gdal.GetDriverByName(driverName)
+    if driver is None:
+        raise IOError("GDAL driver %s not available" % driverName)
+    source = gdal.Open(sourcePath, gdal.GA_ReadOnly)
+    copy = driver.CreateCopy(
+        path, source, options=options, callback=feedback.gdalCallback
+    )
+    source = None
+    if copy is None:
+        deleteRaster(path)
+        feedback.checkCanceled()
+        raise IOError("Unable to write %s" % path)
+    copy = None
+
+
+def deleteRaster(path):
+    if os.path.exists(path):
+        driver = gdal.IdentifyDriver(path)
+        if driver is not None:
+            # also deletes the auxiliary files
+            driver.Delete(path)
+        else:
+            os.remove(path)
+
+
+def exportGeorefRaster(
+    source,
+    transform,
+    grid,
+    path,
+    rasterFormat,
+    crsWkt,
+    resampling=RESAMPLING_NEAREST,
+    threadCount=None,
+    feedback=None,
+):
+    """
+    Exports the source image transformed on the grid (see writeGeoTiff) in
+    one of the FORMATS
+    """
+    driverName, bandCount = FORMATS[rasterFormat]
+    if driverName == "GTiff":
+        writeGeoTiff(
+            source,
+            transform,
+            grid,
+            path,
+            bandCount,
+            crsWkt,
+            resampling,
+            threadCount,
+            feedback=feedback,
+        )
+        return
+
+    # other drivers do not support Create: tiled GeoTIFF then copy
+    tiffPath = path + ".tmp.tif"
+    try:
+        writeGeoTiff(
+            source,
+            transform,
+            grid,
+            tiffPath,
+            bandCount,
+            crsWkt,
+            resampling,
+            threadCount,
+            feedback=SubFeedback(feedback, 0, 80),
+        )
+        copyRaster(
+            tiffPath,
+            path,
+            driverName,
+            ["WORLDFILE=NO"],
+            SubFeedback(feedback, 80, 100),
+        )
+    finally:
+        deleteRaster(tiffPath)
+
+
+def exportCog(
+    source,
+    transform,
+    grid,
+    path,
+    crsWkt,
+    resampling=RESAMPLING_NEAREST,
+    compression="DEFLATE",
+    threadCount=None,
+    feedback=None,
+):
+    """
+    Exports the source image transformed on the grid as a Cloud-Optimized
+    GeoTIFF: geotransform and CRS embedded, internal overviews. compression
+    is one of COG_COMPRESSIONS
+    """
+    if gdal.GetDriverByName("COG") is None:
+        raise IOError("Cloud-Optimized GeoTIFF export requires GDAL >= 3.1")
+
+    # the COG driver only supports CreateCopy: fast intermediate GeoTIFF
+    tiffPath = path + ".tmp.tif"
+    threads = str(threadCount) if threadCount else "ALL_CPUS"
+    previousThreads = gdal.GetConfigOption("GDAL_NUM_THREADS")
+    try:
+        writeGeoTiff(
+            source,
+            transform,
+            grid,
+            tiffPath,
+            4,
+            crsWkt,
+            resampling,
+            threadCount,
+            compression="NONE",
+            feedback=SubFeedback(feedback, 0, 50),
+        )
+        # overviews computed in parallel
+        gdal.SetConfigOption("GDAL_NUM_THREADS", threads)
+        options = [
+            "COMPRESS=%s" % compression,
+            "BLOCKSIZE=%d" % BLOCK_SIZE,
+            "NUM_THREADS=%s" % threads,
+            "OVERVIEWS=IGNORE_EXISTING",
+            "RESAMPLING=%s" % COG_OVERVIEW_RESAMPLING[resampling],
+            "BIGTIFF=IF_SAFER",
+        ]
+        if compression in ("JPEG", "WEBP"):
+            options.append("QUALITY=85")
+        copyRaster(tiffPath, path, "COG", options, SubFeedback(feedback, 50, 100))
+    finally:
+        gdal.SetConfigOption("GDAL_NUM_THREADS", previousThreads)
+        deleteRaster(tiffPath)
+
+
+def exportVrt(sourcePath, path, transform, crsWkt):
+    """
+    Writes a VRT referencing the source raster (not copied) with the affine
+    transform (pixel to map, may be rotated) and the CRS. The source is
+    referenced relative to the VRT when possible
+    """
+    source = gdal.Open(sourcePath, gdal.GA_ReadOnly)
+    if source is None:
+        raise IOError("Unable to open %s" % sourcePath)
+    # in memory: only the XML is needed
+    vrt = gdal.GetDriverByName("VRT").CreateCopy("", source)
+    if vrt is None:
+        raise IOError("Unable to create VRT for %s" % sourcePath)
+    vrt.SetGeoTransform(transform.toGdal())
+    if crsWkt:
+        vrt.SetProjection(crsWkt)
+    root = ET.fromstring(vrt.GetMetadata("xml:VRT")[0])
+    vrt = None
+    source = None
+
+    sourceFilename = os.path.abspath(sourcePath)
+    try:
+        relativeFilename = os.path.relpath(
+            sourceFilename, os.path.dirname(os.path.abspath(path))
+        )
+        isRelative = True
+    except ValueError:
+        # on a different drive
+        relativeFilename = sourceFilename
+        isRelative = False
+    for element in root.iter("SourceFilename"):
+        element.text = relativeFilename.replace(os.sep, "/")
+        element.set("relativeToVRT", "1" if isRelative else "0")
+
+    ET.ElementTree(root).write(path, encoding="UTF-8")
+
+
+# extension of the world file for each format
+WORLD_FILE_EXTENSIONS = {"jpg": "jgw", "png": "pgw", "bmp": "bpw", "tif": "tfw"}
+
+
+def writeWorldFile(rasterPath, rasterFormat, parameters):
+    """
+    parameters in world file order (a, d, b, e, c, f). Returns the path of
+    the world file
+    """
+    baseRasterFilePath, _ = os.path.splitext(rasterPath)
+    worldFilePath = baseRasterFilePath + "." + WORLD_FILE_EXTENSIONS[rasterFormat]
+    with open(worldFilePath, "w") as writer:
+        # order is as described at
+        # http://webhelp.esri.com/arcims/9.3/General/topics/author_world_files.htm
+        writer.write("%.13f\n%.13f\n%.13f\n%.13f\n%.13f\n%.13f" % tuple(parameters))
+    return worldFilePath
+
+
+def writeAuxFile(rasterPath, crsWkt, isGeographic):
+    crsFilePath = rasterPath + ".aux.xml"
+    with open(crsFilePath, "w") as writer:
+        writer.write(auxContent(crsWkt, isGeographic))
+
+
+def auxContent(crsWkt, isGeographic):
+    content = """<PAMDataset>
+  <Metadata domain="xml:ESRI" format="xml">
+    <GeodataXform xsi:type="typens:IdentityXform" 
+      xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
+      xmlns:xs="http://www.w3.org/2001/XMLSchema" 
+      xmlns:typens="http://www.esri.com/schemas/ArcGIS/9.2">
+      <SpatialReference xsi:type="typens:%sCoordinateSystem">
+        <WKT>%s</WKT>
+      </SpatialReference>
+    </GeodataXform>
+  </Metadata>
+</PAMDataset>"""  # noqa
+    geogOrProj = "Geographic" if isGeographic else "Projected"
+    return content % (geogOrProj, crsWkt)
@@ -9,21 +9,186 @@
  ***************************************************************************/
 """
 
-from PyQt5.QtCore import QPointF, QRectF
-from PyQt5.QtGui import QPainter
-from qgis.core import QgsPointXY, QgsRectangle
+import time
+
+import numpy as np
+from PyQt5.QtCore import QPointF, QRectF, QSize, Qt, QTimer
+from PyQt5.QtGui import QColor, QPainter
+from qgis.core import (
+    QgsMapRendererParallelJob,
+    QgsMapSettings,
+    QgsPointXY,
+    QgsRectangle,
+)
 from qgis.gui import QgsMapCanvasItem
 
+from . import alignment, rasterexport
+from .affine import AffineTransform
+from .qimagesource import imageSourceRaster
+from .warp import imageTransform
+
+
+class AlignmentScore(object):
+    """
+    Live score of the alignment of the shadow of a layer with the other
+    layers of the canvas: normalized cross-correlation of the edges of both
+    at low resolution. The other layers are rendered once in the background
+    when the shadow appears and the image of the layer is decimated once, so
+    a score only resamples a small thumbnail. Scores are throttled to keep
+    the shadow responsive
+    """
+
+    # width in pixels of the grid of the score
+    SIZE = 256
+    # minimum interval between 2 scores (ms)
+    INTERVAL = 100
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.layer = None
+        self.transform = None
+        self.key = None
+        self.job = None
+        # (gridTransform, edges, alpha) of the rendered other layers
+        self.reference = None
+        # (thumbnail cache key, ArraySourceRaster)
+        self.thumbnail = None
+        self.lastTime = 0
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.update)
+
+    def start(self, layer):
+        """
+        Renders the other layers for the layer, unless already done for the
+        same layer and canvas extent
+        """
+        settings = QgsMapSettings(self.canvas.mapSettings())
+        extent = settings.visibleExtent()
+        key = (layer.id(), extent.toString(), settings.destinationCrs().authid())
+        if key == self.key:
+            return
+        self.stop()
+        self.layer = layer
+        self.key = key
+        layers = [other for other in settings.layers() if other.id() != layer.id()]
+        if not layers:
+            return
+        outputSize = settings.outputSize()
+        width = self.SIZE
+        height = max(1, round(width * outputSize.height() / max(outputSize.width(), 1)))
+        settings.setLayers(layers)
+        settings.setOutputSize(QSize(width, height))
+        settings.setExtent(extent)
+        settings.setBackgroundColor(QColor(0, 0, 0, 0))
+        self.job = QgsMapRendererParallelJob(settings)
+        self.job.finished.connect(self._rendered)
+        self.job.start()
+
+    def stop(self):
+        if self.job is not None:
+            self.job.finished.disconnect(self._rendered)
+            self.job.cancelWithoutBlocking()
+            self.job = None
+        self.timer.stop()
+        self.layer = None
+        self.transform = None
+        self.key = None
+        self.reference = None
+
+    def _rendered(self):
+        job = self.job
+        self.job = None
+        settings = job.mapSettings()
+        extent = settings.visibleExtent()
+        image = job.renderedImage()
+        pixels = imageSourceRaster(image).read(0, 0, image.width(), image.height())
+        gridTransform = AffineTransform(
+            extent.width() / image.width(),
+            0.0,
+            extent.xMinimum(),
+            0.0,
+            -extent.height() / image.height(),
+            extent.yMaximum(),
+        )
+        self.reference = (
+            gridTransform,
+            alignment.edgeMagnitude(alignment.toGray(pixels)),
+            pixels[..., 3] > 0,
+        )
+        self.update()
+
+    def setTransform(self, transform):
+        """
+        Scores the shadow transform (now or at the end of the interval)
+        """
+        self.transform = transform
+        if self.timer.isActive():
+            return
+        elapsed = (time.monotonic() - self.lastTime) * 1000
+        if elapsed >= self.INTERVAL:
+            self.update()
+        else:
+            self.timer.start(int(self.INTERVAL - elapsed))
+
+    def layerThumbnail(self):
+        """
+        (source, xFactor, yFactor): thumbnail of the layer (the one drawn
+        zoomed out, shared with the rendering) and its size relative to the
+        image. The score grid is small, so the thumbnail is detailed enough
+        """
+        image, xFactor, yFactor = self.layer.thumbnailImage()
+        key = image.cacheKey()
+        if self.thumbnail is None or self.thumbnail[0] != key:
+            source = imageSourceRaster(image)
+            array = source.read(0, 0, source.width, source.height)
+            self.thumbnail = (key, rasterexport.ArraySourceRaster(array, (0, 1, 2), 3))
+        return self.thumbnail[1], xFactor, yFactor
+
+    def score(self):
+        gridTransform, referenceEdges, referenceMask = self.reference
+        height, width = referenceEdges.shape
+        source, xFactor, yFactor = self.layerThumbnail()
+        transform = imageTransform(self.transform, self.layer.warp).compose(
+            AffineTransform(1.0 / xFactor, 0.0, 0.0, 0.0, 1.0 / yFactor, 0.0),
+            first=True,
+        )
+        xs, ys = gridTransform.mapArrays(
+            *np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+        )
+        us, vs = transform.inverted().mapArrays(xs, ys)
+        pixels = rasterexport.samplePixels(
+            source, us, vs, rasterexport.RESAMPLING_BILINEAR
+        )
+        return alignment.normalizedCrossCorrelation(
+            alignment.edgeMagnitude(alignment.toGray(pixels)),
+            referenceEdges,
+            referenceMask & (pixels[..., 3] > 0),
+        )
+
+    def update(self):
+        if self.layer is None or self.reference is None or self.transform is None:
+            return
+        self.lastTime = time.monotonic()
+        score = self.score()
+        if score is not None:
+            self.layer.showStatusMessage("Alignment score: %.2f" % score, 2000)
+
 
 class RasterShadowMapCanvasItem(QgsMapCanvasItem):
     def __init__(self, canvas):
         QgsMapCanvasItem.__init__(self, canvas)
 
         self.canvas = canvas
+        self.alignmentScore = AlignmentScore(canvas)
         self.reset()
 
     def reset(self, layer=None):
         self.layer = layer
+        if layer is None:
+            self.alignmentScore.stop()
+        else:
+            self.alignmentScore.start(layer)
         self.setVisible(False)
 
         self.dx = 0
@@ -61,42 +226,35 @@ class RasterShadowMapCanvasItem(QgsMapCanvasItem):
             self.update()
 
     def updateRect(self):
-        topLeft, topRight, bottomRight, bottomLeft = self.cornerCoordinates()
-
-        left = min(topLeft.x(), topRight.x(), bottomRight.x(), bottomLeft.x())
-        right = max(topLeft.x(), topRight.x(), bottomRight.x(), bottomLeft.x())
-        top = max(topLeft.y(), topRight.y(), bottomRight.y(), bottomLeft.y())
-        bottom = min(topLeft.y(), topRight.y(), bottomRight.y(), bottomLeft.y())
-
-        self.setRect(QgsRectangle(left, bottom, right, top))
+        self._setRectFromTransform(self.shadowTransform())
 
     def updateRectFromPoint(self, startPoint):
-        topLeft, topRight, bottomRight, bottomLeft = self.cornerCoordinatesFromPoint(
-            startPoint
-        )
+        self._setRectFromTransform(self.shadowTransformFromPoint(startPoint))
 
-        left = min(topLeft.x(), topRight.x(), bottomRight.x(), bottomLeft.x())
-        right = max(topLeft.x(), topRight.x(), bottomRight.x(), bottomLeft.x())
-        top = max(topLeft.y(), topRight.y(), bottomRight.y(), bottomLeft.y())
-        bottom = min(topLeft.y(), topRight.y(), bottomRight.y(), bottomLeft.y())
+    def _setRectFromTransform(self, transform):
+        bounds = transform.bounds(self.layer.image.width(), self.layer.image.height())
+        self.setRect(QgsRectangle(*bounds))
+        self.alignmentScore.setTransform(transform)
 
-        self.setRect(QgsRectangle(left, bottom, right, top))
-
-    def cornerCoordinates(self):
+    def shadowTransform(self):
         center = QgsPointXY(
             self.layer.center.x() + self.dx, self.layer.center.y() + self.dy
         )
-        return self.layer.transformedCornerCoordinates(
+        return self.layer.transformFromParameters(
             center,
             self.layer.rotation + self.drotation,
             self.layer.xScale * self.fxscale,
             self.layer.yScale * self.fyscale,
         )
 
+    def shadowTransformFromPoint(self, startPoint):
+        return self.layer.transformFromPoint(startPoint, self.drotation, 1, 1)
+
+    def cornerCoordinates(self):
+        return self.layer.cornerPoints(self.shadowTransform())
+
     def cornerCoordinatesFromPoint(self, startPoint):
-        return self.layer.transformedCornerCoordinatesFromPoint(
-            startPoint, self.drotation, 1, 1
-        )
+        return self.layer.cornerPoints(self.shadowTransformFromPoint(startPoint))
 
     def paint(self, painter, options, widget):
         painter.save()
@@ -124,6 +282,9 @@ class RasterShadowMapCanvasItem(QgsMapCanvasItem):
         painter.translate(targetRect.center())
         painter.rotate(self.layer.rotation + self.drotation)
         painter.scale(scaleX, scaleY)
+        clipPath = self.layer.clipPath()
+        if clipPath is not None:
+            painter.setClipPath(clipPath.translated(rect.topLeft()), Qt.IntersectClip)
         painter.drawImage(rect, self.layer.image)
 
     def prepareStyle(self, painter):
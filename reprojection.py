@@ -0,0 +1,125 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import numpy as np
+from qgis.core import (
+    QgsCoordinateTransform,
+    QgsGeometry,
+    QgsMapLayer,
+    QgsMessageLog,
+    QgsPointXY,
+    QgsProject,
+)
+
+
+def isPluginLayer(layer):
+    # imported here to avoid circular import with the layer module
+    from .freehandrastergeoreferencer_layer import FreehandRasterGeoreferencerLayer
+
+    return (
+        layer is not None
+        and layer.type() == QgsMapLayer.PluginLayer
+        and layer.pluginLayerType() == FreehandRasterGeoreferencerLayer.LAYER_TYPE
+    )
+
+
+def crsKey(crs):
+    return crs.authid() or crs.toWkt()
+
+
+def transformPoints(transform, xs, ys):
+    """
+    Transforms arrays of coordinates in a single call to QGIS (through a
+    multipoint geometry). Returns a tuple of 2 arrays
+    """
+    geometry = QgsGeometry.fromMultiPointXY(
+        [QgsPointXY(float(x), float(y)) for x, y in zip(xs, ys)]
+    )
+    geometry.transform(transform)
+    points = geometry.asMultiPoint()
+    return (
+        np.fromiter((p.x() for p in points), dtype=np.float64, count=len(points)),
+        np.fromiter((p.y() for p in points), dtype=np.float64, count=len(points)),
+    )
+
+
+class CoordinateTransformCache(object):
+    """
+    QgsCoordinateTransform objects by (source, destination) CRS pair
+    """
+
+    def __init__(self):
+        self._transforms = {}
+
+    def transform(self, sourceCrs, destinationCrs):
+        key = (crsKey(sourceCrs), crsKey(destinationCrs))
+        transform = self._transforms.get(key)
+        if transform is None:
+            transform = QgsCoordinateTransform(
+                sourceCrs, destinationCrs, QgsProject.instance()
+            )
+            self._transforms[key] = transform
+        return transform
+
+    def clear(self):
+        self._transforms.clear()
+
+
+class LayersReprojector(object):
+    """
+    Reprojects the transform parameters of plugin layers to a new CRS in one
+    pass
+    """
+
+    def __init__(self, iface):
+        self.iface = iface
+        self.transformCache = CoordinateTransformCache()
+
+    def pluginLayers(self):
+        layers = QgsProject.instance().mapLayers().values()
+        return [layer for layer in layers if isPluginLayer(layer)]
+
+    def reprojectLayers(self, layers, newCrs):
+        layers = [layer for layer in layers if layer.initialized]
+        # group by source CRS: one transform and one batch of points per group
+        groups = {}
+        for layer in layers:
+            if layer.crs() == newCrs:
+                continue
+            groups.setdefault(crsKey(layer.crs()), []).append(layer)
+
+        if not groups:
+            return
+
+        for group in groups.values():
+            oldCrs = group[0].crs()
+            transform = self.transformCache.transform(oldCrs, newCrs)
+
+            footprints = [layer.footprintPoints() for layer in group]
+            counts = [len(xs) for xs, _ in footprints]
+            xs = np.concatenate([xs for xs, _ in footprints])
+            ys = np.concatenate([ys for _, ys in footprints])
+            try:
+                newXs, newYs = transformPoints(transform, xs, ys)
+            except Exception as ex:
+                QgsMessageLog.logMessage(repr(ex))
+                continue
+
+            offsets = np.cumsum([0] + counts)
+            for i, layer in enumerate(group):
+                start, end = offsets[i], offsets[i + 1]
+                layer.applyReprojectedFootprint(
+                    newCrs, newXs[start:end], newYs[start:end]
+                )
+                layer.commitTransformParameters(repaint=False)
+
+        # single repaint for all the layers
+        self.iface.mapCanvas().refresh()
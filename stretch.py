@@ -0,0 +1,167 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Display of high bit depth rasters (16-bit, 32-bit, float): the bands are
+kept as 16-bit codes and converted to 8-bit through a lookup table of 65536
+entries (minimum / maximum, gamma, contrast, brightness), so changing the
+stretch costs one table lookup per pixel instead of reading the file again.
+"""
+
+import json
+
+import numpy as np
+
+LUT_SIZE = 65536
+
+
+class QuantizedBand(object):
+    """
+    Band of a raster as 16-bit codes: the value of code c is
+    low + c * (high - low) / (LUT_SIZE - 1). 8 and 16-bit unsigned bands are
+    kept as they are (the code is the value)
+    """
+
+    def __init__(self, band):
+        band = np.asarray(band)
+        if band.dtype in (np.uint8, np.uint16):
+            self.codes = band.astype(np.uint16, copy=False)
+            self.low, self.high = 0.0, float(LUT_SIZE - 1)
+            self.minimum = float(band.min()) if band.size else 0.0
+            self.maximum = float(band.max()) if band.size else 0.0
+            return
+        finite = np.isfinite(band)
+        if finite.any():
+            self.low = float(band[finite].min())
+            self.high = float(band[finite].max())
+        else:
+            self.low, self.high = 0.0, 0.0
+        self.minimum, self.maximum = self.low, self.high
+        scale = (LUT_SIZE - 1) / (self.high - self.low) if self.high > self.low else 0
+        codes = np.where(finite, band, self.low).astype(np.float64)
+        codes -= self.low
+        codes *= scale
+        self.codes = np.rint(codes).astype(np.uint16)
+
+    def values(self):
+        """
+        Value of each code (LUT_SIZE float64)
+        """
+        step = (self.high - self.low) / (LUT_SIZE - 1)
+        return self.low + np.arange(LUT_SIZE, dtype=np.float64) * step
+
+
+class Stretch(object):
+    """
+    Conversion of the values of the bands to 8-bit: linear between the
+    minimum and the maximum of each band, then gamma, contrast (around the
+    middle gray) and brightness (added, in [-1, 1]). Immutable: the lookup
+    tables are computed once per stretch
+    """
+
+    def __init__(self, minimums, maximums, brightness=0.0, contrast=1.0, gamma=1.0):
+        self.minimums = tuple(float(value) for value in minimums)
+        self.maximums = tuple(float(value) for value in maximums)
+        if len(self.minimums) != len(self.maximums):
+            raise ValueError("One minimum and one maximum per band are needed")
+        if contrast <= 0 or gamma <= 0:
+            raise ValueError("Contrast and gamma must be positive")
+        self.brightness = float(brightness)
+        self.contrast = float(contrast)
+        self.gamma = float(gamma)
+        self._luts = {}
+
+    @classmethod
+    def fromBands(cls, bands):
+        """
+        Stretch from the minimum to the maximum of each QuantizedBand
+        """
+        return cls([band.minimum for band in bands], [band.maximum for band in bands])
+
+    def __eq__(self, other):
+        return isinstance(other, Stretch) and self.toJson() == other.toJson()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def withAdjustments(self, brightness, contrast, gamma):
+        """
+        Same minimums and maximums with other adjustments
+        """
+        return Stretch(self.minimums, self.maximums, brightness, contrast, gamma)
+
+    def transfer(self, values, index):
+        """
+        8-bit values (uint8 array) of values of the band index
+        """
+        minimum, maximum = self.minimums[index], self.maximums[index]
+        t = np.asarray(values, dtype=np.float64) - minimum
+        if maximum > minimum:
+            t /= maximum - minimum
+        else:
+            t = np.where(t > 0, 1.0, 0.0)
+        t = np.clip(t, 0, 1)
+        if self.gamma != 1:
+            t **= 1.0 / self.gamma
+        t = (t - 0.5) * self.contrast + 0.5 + self.brightness
+        return np.rint(np.clip(t, 0, 1) * 255).astype(np.uint8)
+
+    def lookupTable(self, band, index):
+        """
+        uint8 lookup table (LUT_SIZE) of the codes of a QuantizedBand
+        """
+        key = (index, band.low, band.high)
+        if key not in self._luts:
+            self._luts[key] = self.transfer(band.values(), index)
+        return self._luts[key]
+
+    def apply(self, bands, step=1):
+        """
+        8-bit pixels (bands, h, w) of a list of QuantizedBand, decimated by
+        step (1 pixel out of step in each direction): the cost is one table
+        lookup per output pixel
+        """
+        if len(bands) != len(self.minimums):
+            raise ValueError("The stretch has %d bands" % len(self.minimums))
+        height, width = bands[0].codes[::step, ::step].shape
+        pixels = np.empty((len(bands), height, width), dtype=np.uint8)
+        for index, band in enumerate(bands):
+            np.take(
+                self.lookupTable(band, index),
+                band.codes[::step, ::step],
+                out=pixels[index],
+            )
+        return pixels
+
+    def toJson(self):
+        return json.dumps(
+            {
+                "minimums": list(self.minimums),
+                "maximums": list(self.maximums),
+                "brightness": self.brightness,
+                "contrast": self.contrast,
+                "gamma": self.gamma,
+            }
+        )
+
+    @classmethod
+    def fromJson(cls, text):
+        """
+        Stretch stored with toJson, None if text is empty
+        """
+        if not text:
+            return None
+        values = json.loads(text)
+        return cls(
+            values["minimums"],
+            values["maximums"],
+            values.get("brightness", 0.0),
+            values.get("contrast", 1.0),
+            values.get("gamma", 1.0),
+        )
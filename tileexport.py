@@ -0,0 +1,607 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Generation of Web Mercator tiles (XYZ directory or MBTiles file) from a
+georeferenced raster, without QGIS (only GDAL and NumPy are needed). From
+the directory containing the plugin:
+
+    python -m FreehandRasterGeoreferencer.tileexport project.qgz --layer NAME \
+        output.mbtiles --min-zoom 12 --max-zoom 18
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import math
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+import numpy as np
+from osgeo import gdal, osr
+
+from . import batchexport, rasterexport
+
+TILE_SIZE = 256
+# half of the extent of Web Mercator
+ORIGIN = 20037508.342789244
+MAX_ZOOM = 24
+# tiles are mapped to the source through a coarse grid of GRID_SIZE x
+# GRID_SIZE cells (exact transform on the nodes, interpolated inside)
+GRID_SIZE = 16
+# tiles rendered by a task of the pool
+TILES_PER_TASK = 32
+
+
+def tileBounds(z, x, y):
+    """
+    (xMin, yMin, xMax, yMax) of a tile in Web Mercator
+    """
+    size = 2 * ORIGIN / 2**z
+    xMin = -ORIGIN + x * size
+    yMax = ORIGIN - y * size
+    return (xMin, yMax - size, xMin + size, yMax)
+
+
+def _webMercator():
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3857)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def _layerSrs(crsWkt):
+    srs = osr.SpatialReference()
+    if not crsWkt or srs.ImportFromWkt(crsWkt) != 0:
+        raise ValueError("Invalid CRS of the layer")
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def _transformArrays(transformation, xs, ys):
+    """
+    Transforms arrays of coordinates with an osr.CoordinateTransformation.
+    Points that cannot be transformed are NaN
+    """
+    points = np.column_stack([np.ravel(xs), np.ravel(ys)]).astype(np.float64)
+    result = np.array(transformation.TransformPoints(points.tolist()), dtype=float)
+    result[~np.isfinite(result)] = np.nan
+    return result[:, 0].reshape(np.shape(xs)), result[:, 1].reshape(np.shape(ys))
+
+
+def _interpolateNodes(nodes, count):
+    """
+    Bilinear interpolation of the values on the nodes of a regular grid
+    (shape (n + 1, n + 1) over count x count pixels) at the pixel centers
+    """
+    cells = nodes.shape[0] - 1
+    positions = (np.arange(count) + 0.5) * cells / count
+    index = np.minimum(positions.astype(int), cells - 1)
+    t = positions - index
+    rows = nodes[index] * (1 - t)[:, np.newaxis] + nodes[index + 1] * t[:, np.newaxis]
+    return rows[:, index] * (1 - t) + rows[:, index + 1] * t
+
+
+class TileRenderer(object):
+    """
+    Renders the Web Mercator tiles of a source raster georeferenced by an
+    AffineTransform (pixel to layer CRS), clipped by clipRing (pixel
+    coordinates, see collar.py) if not None
+    """
+
+    def __init__(self, source, transform, crsWkt, resampling, clipRing=None):
+        self.source = source
+        self.transform = transform
+        self.inverse = transform.inverted()
+        self.resampling = resampling
+        self.clipRing = clipRing
+        self.crsWkt = crsWkt
+        _layerSrs(crsWkt)
+        # coordinate transformations cannot be shared between threads
+        self._local = threading.local()
+
+    def _transformations(self):
+        local = self._local
+        if not hasattr(local, "toLayer"):
+            layerSrs = _layerSrs(self.crsWkt)
+            mercator = _webMercator()
+            local.toLayer = osr.CoordinateTransformation(mercator, layerSrs)
+            local.toMercator = osr.CoordinateTransformation(layerSrs, mercator)
+        return local
+
+    @property
+    def toLayer(self):
+        return self._transformations().toLayer
+
+    @property
+    def toMercator(self):
+        return self._transformations().toMercator
+
+    def mercatorBounds(self):
+        """
+        Bounds of the raster in Web Mercator, from its densified outline
+        """
+        t = np.linspace(0, 1, 33)
+        w, h = self.source.width, self.source.height
+        us = np.concatenate([t * w, np.full_like(t, w), t * w, np.zeros_like(t)])
+        vs = np.concatenate([np.zeros_like(t), t * h, np.full_like(t, h), t * h])
+        xs, ys = _transformArrays(self.toMercator, *self.transform.mapArrays(us, vs))
+        if np.isnan(xs).all():
+            raise ValueError("The raster cannot be projected to Web Mercator")
+        return (
+            max(np.nanmin(xs), -ORIGIN),
+            max(np.nanmin(ys), -ORIGIN),
+            min(np.nanmax(xs), ORIGIN),
+            min(np.nanmax(ys), ORIGIN),
+        )
+
+    def nativeZoom(self):
+        """
+        Zoom level whose resolution is at least the one of the raster (at its
+        center)
+        """
+        u, v = self.source.width / 2.0, self.source.height / 2.0
+        xs, ys = _transformArrays(
+            self.toMercator,
+            *self.transform.mapArrays(np.array([u, u + 1, u]), np.array([v, v, v + 1]))
+        )
+        area = abs(
+            (xs[1] - xs[0]) * (ys[2] - ys[0]) - (xs[2] - xs[0]) * (ys[1] - ys[0])
+        )
+        if not area > 0:
+            return MAX_ZOOM
+        zoom = math.log2(2 * ORIGIN / (TILE_SIZE * math.sqrt(area)))
+        return min(max(int(math.ceil(zoom - 1e-6)), 0), MAX_ZOOM)
+
+    def tiles(self, minZoom, maxZoom):
+        """
+        (z, x, y) of the tiles intersecting the bounds of the raster
+        """
+        xMin, yMin, xMax, yMax = self.mercatorBounds()
+        for z in range(minZoom, maxZoom + 1):
+            count = 2**z
+            size = 2 * ORIGIN / count
+            x0 = min(max(int((xMin + ORIGIN) // size), 0), count - 1)
+            x1 = min(max(int((xMax + ORIGIN) // size), 0), count - 1)
+            y0 = min(max(int((ORIGIN - yMax) // size), 0), count - 1)
+            y1 = min(max(int((ORIGIN - yMin) // size), 0), count - 1)
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    yield (z, x, y)
+
+    def render(self, z, x, y):
+        """
+        RGBA pixels of a tile, None if it is fully transparent
+        """
+        xMin, yMin, xMax, yMax = tileBounds(z, x, y)
+        t = np.linspace(0, 1, GRID_SIZE + 1)
+        mercatorXs, mercatorYs = np.meshgrid(
+            xMin + t * (xMax - xMin), yMax - t * (yMax - yMin)
+        )
+        nodeUs, nodeVs = self.inverse.mapArrays(
+            *_transformArrays(self.toLayer, mercatorXs, mercatorYs)
+        )
+        if np.isnan(nodeUs).all():
+            return None
+
+        # source pixels per tile pixel: read the overviews of the source when
+        # the tile is at a lower resolution
+        step = TILE_SIZE / GRID_SIZE
+        scale = np.nanmin(
+            np.hypot(np.diff(nodeUs, axis=1), np.diff(nodeVs, axis=1)) / step
+        )
+        source = self.source
+        factor = 1
+        if scale >= 2:
+            factor = 2 ** int(math.log2(scale))
+            source = rasterexport.DecimatedSourceRaster(source, factor)
+
+        us = _interpolateNodes(nodeUs, TILE_SIZE)
+        vs = _interpolateNodes(nodeVs, TILE_SIZE)
+        mask = None
+        if self.clipRing is not None:
+            mask = rasterexport.pointsInPolygon(us, vs, [self.clipRing])
+            if not mask.any():
+                return None
+        pixels = rasterexport.samplePixels(
+            source, us / factor, vs / factor, self.resampling, mask
+        )
+        if not pixels[..., 3].any():
+            return None
+        return pixels
+
+
+def encodePng(pixels):
+    """
+    PNG file content of RGBA pixels
+    """
+    height, width = pixels.shape[:2]
+    dataset = gdal.GetDriverByName("MEM").Create("", width, height, 4, gdal.GDT_Byte)
+    for band in range(4):
+        dataset.GetRasterBand(band + 1).WriteArray(pixels[..., band])
+    path = "/vsimem/%s.png" % uuid.uuid4().hex
+    gdal.GetDriverByName("PNG").CreateCopy(path, dataset, options=["ZLEVEL=6"])
+    dataset = None
+    try:
+        handle = gdal.VSIFOpenL(path, "rb")
+        gdal.VSIFSeekL(handle, 0, 2)
+        size = gdal.VSIFTellL(handle)
+        gdal.VSIFSeekL(handle, 0, 0)
+        data = gdal.VSIFReadL(1, size, handle)
+        gdal.VSIFCloseL(handle)
+    finally:
+        gdal.Unlink(path)
+    return bytes(data)
+
+
+def renderTiles(renderer, tiles):
+    """
+    (z, x, y, digest, data) for each tile: digest is the hash of the pixels
+    and data the PNG content, both None for a transparent tile
+    """
+    results = []
+    for z, x, y in tiles:
+        pixels = renderer.render(z, x, y)
+        if pixels is None:
+            results.append((z, x, y, None, None))
+            continue
+        # same pixels (e.g. uniform areas): same PNG, stored once
+        digest = hashlib.sha1(pixels.tobytes()).hexdigest()
+        results.append((z, x, y, digest, encodePng(pixels)))
+    return results
+
+
+# renderer of a worker process of the pool
+_workerRenderer = None
+
+
+def _initWorker(job, resampling):
+    global _workerRenderer
+    source = job.sourceRaster()
+    _workerRenderer = TileRenderer(
+        source,
+        job.transform(source.width, source.height),
+        job.crsWkt,
+        resampling,
+        job.clipRing(),
+    )
+
+
+def _renderWorkerTiles(tiles):
+    return renderTiles(_workerRenderer, tiles)
+
+
+class XyzWriter(object):
+    """
+    Tiles in a z/x/y.png directory. Duplicate tiles are hard links to the
+    first file with the same content
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.isCreated = False
+
+    def __enter__(self):
+        # only a directory created by the export is removed on failure
+        self.isCreated = not os.path.exists(self.path)
+        os.makedirs(self.path, exist_ok=True)
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        pass
+
+    def write(self, z, x, y, digest, data):
+        """
+        True if the tile was a duplicate
+        """
+        directory = os.path.join(self.path, str(z), str(x))
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "%d.png" % y)
+        if os.path.exists(path):
+            os.remove(path)
+        original = self.files.get(digest)
+        if original is not None:
+            try:
+                os.link(original, path)
+            except OSError:
+                shutil.copyfile(original, path)
+            return True
+        with open(path, "wb") as f:
+            f.write(data)
+        self.files[digest] = path
+        return False
+
+    def discard(self):
+        if self.isCreated:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+class MbtilesWriter(object):
+    """
+    Tiles in an MBTiles file (SQLite), written in bulk transactions. Duplicate
+    tiles share the same image row
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, path, name, bounds, minZoom, maxZoom):
+        self.path = path
+        self.metadata = {
+            "name": name,
+            "format": "png",
+            "type": "overlay",
+            "version": "1.1",
+            "bounds": ",".join("%.6f" % value for value in bounds),
+            "minzoom": str(minZoom),
+            "maxzoom": str(maxZoom),
+        }
+        self.connection = None
+        self.digests = set()
+        self.mapRows = []
+        self.imageRows = []
+
+    def __enter__(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript("""
+            PRAGMA synchronous = OFF;
+            PRAGMA journal_mode = MEMORY;
+            CREATE TABLE metadata (name TEXT, value TEXT);
+            CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER,
+                tile_row INTEGER, tile_id TEXT);
+            CREATE TABLE images (tile_id TEXT, tile_data BLOB);
+            CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level,
+                map.tile_column AS tile_column, map.tile_row AS tile_row,
+                images.tile_data AS tile_data
+                FROM map JOIN images ON images.tile_id = map.tile_id;
+            """)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO metadata (name, value) VALUES (?, ?)",
+                self.metadata.items(),
+            )
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        try:
+            if excType is None:
+                self.flush()
+                self.connection.executescript("""
+                    CREATE UNIQUE INDEX map_index
+                        ON map (zoom_level, tile_column, tile_row);
+                    CREATE UNIQUE INDEX images_id ON images (tile_id);
+                    CREATE UNIQUE INDEX metadata_name ON metadata (name);
+                    """)
+        finally:
+            self.connection.close()
+            self.connection = None
+
+    def write(self, z, x, y, digest, data):
+        # rows of MBTiles are TMS (from the south)
+        self.mapRows.append((z, x, 2**z - 1 - y, digest))
+        isDuplicate = digest in self.digests
+        if not isDuplicate:
+            self.digests.add(digest)
+            self.imageRows.append((digest, sqlite3.Binary(data)))
+        if len(self.mapRows) >= self.BATCH_SIZE:
+            self.flush()
+        return isDuplicate
+
+    def flush(self):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) "
+                "VALUES (?, ?, ?, ?)",
+                self.mapRows,
+            )
+            self.connection.executemany(
+                "INSERT INTO images (tile_id, tile_data) VALUES (?, ?)",
+                self.imageRows,
+            )
+        self.mapRows = []
+        self.imageRows = []
+
+    def discard(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class TileStats(object):
+    def __init__(self):
+        self.written = 0
+        self.empty = 0
+        self.duplicates = 0
+        self.duration = 0
+
+    def __str__(self):
+        return (
+            "%d tiles written (%d duplicates stored once), %d empty tiles "
+            "skipped in %.1f s"
+            % (self.written, self.duplicates, self.empty, self.duration)
+        )
+
+
+def isMbtiles(path):
+    return path.lower().endswith(".mbtiles")
+
+
+def lonLatBounds(renderer):
+    xMin, yMin, xMax, yMax = renderer.mercatorBounds()
+    toLonLat = osr.SpatialReference()
+    toLonLat.ImportFromEPSG(4326)
+    toLonLat.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transformation = osr.CoordinateTransformation(_webMercator(), toLonLat)
+    lons, lats = _transformArrays(
+        transformation, np.array([xMin, xMax]), np.array([yMin, yMax])
+    )
+    return (lons[0], lats[0], lons[1], lats[1])
+
+
+def tileExecutor(renderer, job=None, workerCount=None):
+    """
+    (executor, render): render renders a list of tiles in the executor
+    """
+    if job is not None:
+        executor = ProcessPoolExecutor(
+            max_workers=workerCount,
+            initializer=_initWorker,
+            initargs=(job, renderer.resampling),
+        )
+        return executor, _renderWorkerTiles
+
+    def render(tiles):
+        return renderTiles(renderer, tiles)
+
+    return ThreadPoolExecutor(max_workers=workerCount), render
+
+
+def renderedTasks(executor, render, tasks, workerCount=None, feedback=None):
+    """
+    Results of the tasks rendered by the executor, in order, with a bounded
+    number of tasks in flight
+    """
+    maxPending = 2 * (workerCount or os.cpu_count() or 1)
+    pending = []
+    taskIndex = 0
+    for _ in range(len(tasks)):
+        while taskIndex < len(tasks) and len(pending) < maxPending:
+            pending.append(executor.submit(render, tasks[taskIndex]))
+            taskIndex += 1
+        if feedback is not None and feedback.isCanceled():
+            for future in pending:
+                future.cancel()
+            raise rasterexport.ExportCanceled()
+        yield pending.pop(0).result()
+
+
+def exportTiles(
+    renderer,
+    path,
+    minZoom=None,
+    maxZoom=None,
+    name="",
+    job=None,
+    workerCount=None,
+    feedback=None,
+):
+    """
+    Renders the tiles of the zoom levels to an MBTiles file (.mbtiles) or an
+    XYZ directory. The tiles are rendered in a process pool if job
+    (batchexport.BatchJob) is given, each process reading the raster file of
+    the job, else in a thread pool with the renderer. Transparent tiles are
+    skipped. Returns a TileStats
+    """
+    start = time.monotonic()
+    if maxZoom is None:
+        maxZoom = renderer.nativeZoom()
+    if minZoom is None:
+        minZoom = max(0, maxZoom - 4)
+    if minZoom > maxZoom:
+        raise ValueError("The minimum zoom is greater than the maximum zoom")
+    tiles = list(renderer.tiles(minZoom, maxZoom))
+    tasks = [
+        tiles[i : i + TILES_PER_TASK] for i in range(0, len(tiles), TILES_PER_TASK)
+    ]
+
+    executor, render = tileExecutor(renderer, job, workerCount)
+    if isMbtiles(path):
+        writer = MbtilesWriter(path, name, lonLatBounds(renderer), minZoom, maxZoom)
+    else:
+        writer = XyzWriter(path)
+
+    stats = TileStats()
+    try:
+        with executor, writer:
+            for done, results in enumerate(
+                renderedTasks(executor, render, tasks, workerCount, feedback)
+            ):
+                for z, x, y, digest, data in results:
+                    if digest is None:
+                        stats.empty += 1
+                        continue
+                    stats.written += 1
+                    if writer.write(z, x, y, digest, data):
+                        stats.duplicates += 1
+                if feedback is not None:
+                    feedback.setProgress(100.0 * (done + 1) / len(tasks))
+    except BaseException:
+        writer.discard()
+        raise
+    finally:
+        stats.duration = time.monotonic() - start
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate Web Mercator tiles from a Freehand raster "
+        "georeferencer layer of a QGIS project"
+    )
+    parser.add_argument("project", help=".qgs or .qgz project file")
+    parser.add_argument("output", help=".mbtiles file or XYZ directory")
+    parser.add_argument(
+        "--layer", help="name of the layer (default: the first layer of the plugin)"
+    )
+    parser.add_argument("--min-zoom", type=int, default=None)
+    parser.add_argument(
+        "--max-zoom",
+        type=int,
+        default=None,
+        help="default: zoom of the resolution of the raster",
+    )
+    parser.add_argument(
+        "--resampling",
+        choices=rasterexport.RESAMPLING_METHODS,
+        default=rasterexport.RESAMPLING_BILINEAR,
+    )
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    args = parser.parse_args(argv)
+
+    jobs = batchexport.readProject(args.project)
+    if args.layer is not None:
+        jobs = [job for job in jobs if job.name == args.layer]
+    if not jobs:
+        print("No layer of the plugin found")
+        return 1
+    job = jobs[0]
+    source = job.sourceRaster()
+    if not rasterexport.GdalSourceRaster.isSupported(
+        job.filepath, source.width, source.height
+    ):
+        print("Unsupported raster (only 1 or 3 Byte bands): export it from QGIS")
+        return 1
+    renderer = TileRenderer(
+        source,
+        job.transform(source.width, source.height),
+        job.crsWkt,
+        args.resampling,
+        job.clipRing(),
+    )
+    stats = exportTiles(
+        renderer,
+        args.output,
+        args.min_zoom,
+        args.max_zoom,
+        name=job.name,
+        job=job,
+        workerCount=args.workers,
+    )
+    print(stats)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
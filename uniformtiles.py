@@ -0,0 +1,52 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Fully transparent tiles of an image (the corners of a rotated scan, the
+masked paper) found with vectorized reductions over all the tiles at once,
+and blank blocks of an export, so the rendering and the export can skip
+them.
+"""
+
+import numpy as np
+
+# tiles of the image displayed by the layer
+TILE_SIZE = 256
+
+
+def tileStarts(length, tileSize=TILE_SIZE):
+    """
+    First pixel of each tile along a side of length pixels
+    """
+    return np.arange(0, max(length, 1), tileSize)
+
+
+def transparentTiles(argb, rowStarts, colStarts):
+    """
+    Boolean array (rows, cols): True for the fully transparent tiles of
+    premultiplied ARGB pixels (2D array of uint32, transparent pixels are 0)
+    split at rowStarts and colStarts (increasing, starting at 0)
+    """
+    rowStarts = np.asarray(rowStarts, dtype=np.intp)
+    colStarts = np.asarray(colStarts, dtype=np.intp)
+    maximums = np.maximum.reduceat(
+        np.maximum.reduceat(argb, rowStarts, axis=0), colStarts, axis=1
+    )
+    return maximums == 0
+
+
+def isBlank(pixels, bandCount):
+    """
+    True if a block of RGBA pixels (h, w, 4) written with bandCount bands
+    can be left out of a sparse GeoTIFF (read as zeros): all the written
+    values are 0, or all the pixels are transparent
+    """
+    if bandCount == 4 and not pixels[..., 3].any():
+        return True
+    return not pixels[..., :bandCount].any()
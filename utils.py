@@ -11,13 +11,18 @@
 
 import os.path
 
-from PyQt5.QtCore import qDebug
+from PyQt5.QtCore import qDebug, QSettings
 from qgis.core import QgsProject
 
 # constants for saving data inside QGS
 SETTINGS_KEY = "FreehandRasterGeoreferencer"
 SETTING_BROWSER_RASTER_DIR = "browseRasterDir"
 
+# constants for the QGIS user settings
+SETTING_UNDO_LIMIT = "undoLimit"
+DEFAULT_UNDO_LIMIT = 100
+SETTING_DESKEW_ON_ADD = "deskewOnAdd"
+
 
 def toRelativeToQGS(imagePath):
     qgsPath = QgsProject.instance().fileName()
@@ -37,6 +42,19 @@ def toRelativeToQGS(imagePath):
     return imagePath
 
 
+def readSetting(name, default, type_):
+    return QSettings().value(SETTINGS_KEY + "/" + name, default, type=type_)
+
+
+def writeSetting(name, value):
+    QSettings().setValue(SETTINGS_KEY + "/" + name, value)
+
+
+def undoLimit():
+    # max number of undo steps kept per layer
+    return max(1, readSetting(SETTING_UNDO_LIMIT, DEFAULT_UNDO_LIMIT, int))
+
+
 def tryfloat(strF):
     try:
         f = float(strF)
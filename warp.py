@@ -0,0 +1,324 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Non-affine corrections of the image (polynomial, thin plate spline), in pixel
+coordinates: the layer maps a pixel p to the map with its affine transform
+applied to warp(p), so moving, rotating or scaling the layer keeps the warp.
+"""
+
+import json
+
+import numpy as np
+
+WARP_POLYNOMIAL_2 = "polynomial2"
+WARP_POLYNOMIAL_3 = "polynomial3"
+WARP_THIN_PLATE_SPLINE = "tps"
+WARP_METHODS = (WARP_POLYNOMIAL_2, WARP_POLYNOMIAL_3, WARP_THIN_PLATE_SPLINE)
+
+# cells per side of the displacement grid
+GRID_SIZE = 64
+# fixed point iterations of the inverse of the displacement grid
+INVERSE_ITERATIONS = 12
+# points per chunk when evaluating a thin plate spline
+TPS_CHUNK_SIZE = 65536
+
+
+def minimumPointCount(method):
+    return {WARP_POLYNOMIAL_2: 6, WARP_POLYNOMIAL_3: 10}.get(method, 3)
+
+
+def _monomials(us, vs, order):
+    return np.column_stack(
+        [us**i * vs**j for i in range(order + 1) for j in range(order + 1 - i)]
+    )
+
+
+def _tpsKernel(squaredDistances):
+    # U(r) = r^2 log(r^2) / 2 = r^2 log(r), 0 at r = 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values = squaredDistances * np.log(squaredDistances) / 2
+    return np.nan_to_num(values, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+class Warp(object):
+    """
+    Warp of a width x height image fitted on control points: pixelPoints
+    (N, 2) are moved to warpedPoints (N, 2). Immutable: the displacement
+    grid is computed once per warp
+    """
+
+    def __init__(self, method, width, height, pixelPoints, warpedPoints):
+        if method not in WARP_METHODS:
+            raise ValueError("Unknown warp method: %s" % method)
+        self.method = method
+        self.width = width
+        self.height = height
+        self.pixelPoints = np.asarray(pixelPoints, dtype=np.float64).reshape(-1, 2)
+        self.warpedPoints = np.asarray(warpedPoints, dtype=np.float64).reshape(-1, 2)
+        if len(self.pixelPoints) < minimumPointCount(method):
+            raise ValueError(
+                "At least %d points are needed" % minimumPointCount(method)
+            )
+        # normalized coordinates (image in [0, 1]) for the conditioning
+        self._scale = np.array([max(width, 1), max(height, 1)], dtype=np.float64)
+        self._coefficients = self._fit()
+        self._grid = None
+
+    def _normalized(self, us, vs):
+        return np.asarray(us) / self._scale[0], np.asarray(vs) / self._scale[1]
+
+    def _fit(self):
+        us, vs = self._normalized(*self.pixelPoints.T)
+        targets = self.warpedPoints / self._scale
+        if self.method == WARP_THIN_PLATE_SPLINE:
+            count = len(us)
+            kernel = _tpsKernel(
+                (us[:, np.newaxis] - us) ** 2 + (vs[:, np.newaxis] - vs) ** 2
+            )
+            affine = np.column_stack([np.ones(count), us, vs])
+            system = np.zeros((count + 3, count + 3))
+            system[:count, :count] = kernel
+            system[:count, count:] = affine
+            system[count:, :count] = affine.T
+            rhs = np.zeros((count + 3, 2))
+            rhs[:count] = targets
+            # least squares: duplicate points make the system singular
+            coefficients, _, _, _ = np.linalg.lstsq(system, rhs, rcond=None)
+            return coefficients
+        order = 2 if self.method == WARP_POLYNOMIAL_2 else 3
+        coefficients, _, _, _ = np.linalg.lstsq(
+            _monomials(us, vs, order), targets, rcond=None
+        )
+        return coefficients
+
+    def mapArrays(self, us, vs):
+        """
+        Exact warp of arrays of pixel coordinates (same shape). Returns a
+        tuple of 2 arrays
+        """
+        shape = np.shape(us)
+        us, vs = self._normalized(np.ravel(us), np.ravel(vs))
+        if self.method == WARP_THIN_PLATE_SPLINE:
+            weights = self._coefficients[: len(self.pixelPoints)]
+            affine = self._coefficients[len(self.pixelPoints) :]
+            controlUs, controlVs = self._normalized(*self.pixelPoints.T)
+            result = np.empty((len(us), 2))
+            # chunked: the kernel matrix is (points, control points)
+            for start in range(0, len(us), TPS_CHUNK_SIZE):
+                u = us[start : start + TPS_CHUNK_SIZE]
+                v = vs[start : start + TPS_CHUNK_SIZE]
+                kernel = _tpsKernel(
+                    (u[:, np.newaxis] - controlUs) ** 2
+                    + (v[:, np.newaxis] - controlVs) ** 2
+                )
+                result[start : start + TPS_CHUNK_SIZE] = (
+                    kernel @ weights
+                    + affine[0]
+                    + u[:, np.newaxis] * affine[1]
+                    + v[:, np.newaxis] * affine[2]
+                )
+        else:
+            order = 2 if self.method == WARP_POLYNOMIAL_2 else 3
+            result = _monomials(us, vs, order) @ self._coefficients
+        result *= self._scale
+        return result[:, 0].reshape(shape), result[:, 1].reshape(shape)
+
+    def residuals(self):
+        """
+        Distance (in pixels) between the warped control points and their
+        targets: 0 for a thin plate spline
+        """
+        us, vs = self.mapArrays(*self.pixelPoints.T)
+        return np.hypot(us - self.warpedPoints[:, 0], vs - self.warpedPoints[:, 1])
+
+    def grid(self):
+        """
+        DisplacementGrid of the warp (computed once)
+        """
+        if self._grid is None:
+            us, vs = np.meshgrid(
+                np.linspace(0, self.width, GRID_SIZE + 1),
+                np.linspace(0, self.height, GRID_SIZE + 1),
+            )
+            warpedUs, warpedVs = self.mapArrays(us, vs)
+            self._grid = DisplacementGrid(
+                self.width, self.height, warpedUs - us, warpedVs - vs
+            )
+        return self._grid
+
+    def toJson(self):
+        return json.dumps(
+            {
+                "method": self.method,
+                "width": self.width,
+                "height": self.height,
+                "pixelPoints": self.pixelPoints.tolist(),
+                "warpedPoints": self.warpedPoints.tolist(),
+            }
+        )
+
+    @classmethod
+    def fromJson(cls, text):
+        """
+        Warp stored with toJson, None if text is empty
+        """
+        if not text:
+            return None
+        values = json.loads(text)
+        return cls(
+            values["method"],
+            values["width"],
+            values["height"],
+            values["pixelPoints"],
+            values["warpedPoints"],
+        )
+
+
+class DisplacementGrid(object):
+    """
+    Displacements of a warp on the nodes of a regular grid over the image,
+    bilinearly interpolated in between: fast enough for millions of pixels
+    (export) and invertible by fixed point iterations
+    """
+
+    def __init__(self, width, height, dus, dvs):
+        self.width = width
+        self.height = height
+        self.dus = dus
+        self.dvs = dvs
+
+    def displacements(self, us, vs):
+        rows, cols = self.dus.shape[0] - 1, self.dus.shape[1] - 1
+        # clamped: constant displacement outside of the image
+        x = np.clip(np.asarray(us, dtype=np.float64) * cols / self.width, 0, cols)
+        y = np.clip(np.asarray(vs, dtype=np.float64) * rows / self.height, 0, rows)
+        col = np.minimum(x.astype(np.int64), cols - 1)
+        row = np.minimum(y.astype(np.int64), rows - 1)
+        tx = x - col
+        ty = y - row
+        result = []
+        for nodes in (self.dus, self.dvs):
+            top = nodes[row, col] * (1 - tx) + nodes[row, col + 1] * tx
+            bottom = nodes[row + 1, col] * (1 - tx) + nodes[row + 1, col + 1] * tx
+            result.append(top * (1 - ty) + bottom * ty)
+        return result
+
+    def mapArrays(self, us, vs):
+        dus, dvs = self.displacements(us, vs)
+        return us + dus, vs + dvs
+
+    def inverseArrays(self, us, vs):
+        """
+        Pixel coordinates whose warp is (us, vs): solution of
+        p + d(p) = q by fixed point iterations
+        """
+        us = np.asarray(us, dtype=np.float64)
+        vs = np.asarray(vs, dtype=np.float64)
+        pu, pv = us, vs
+        for _ in range(INVERSE_ITERATIONS):
+            dus, dvs = self.displacements(pu, pv)
+            pu = us - dus
+            pv = vs - dvs
+        return pu, pv
+
+    def boundary(self, count=64):
+        """
+        Warped outline of the image as an (N, 2) array of pixel coordinates
+        """
+        t = np.linspace(0, 1, count + 1)
+        w, h = self.width, self.height
+        us = np.concatenate([t * w, np.full_like(t, w), (1 - t) * w, np.zeros_like(t)])
+        vs = np.concatenate([np.zeros_like(t), t * h, np.full_like(t, h), (1 - t) * h])
+        return np.column_stack(self.mapArrays(us, vs))
+
+
+class WarpedTransform(object):
+    """
+    Pixel to map mapping of a warped layer: the warp then the affine
+    transform of the layer. Used in place of the AffineTransform of the
+    layer by the rendering and the export (same methods as far as they are
+    used there)
+    """
+
+    def __init__(self, transform, grid, pixelTransform=None):
+        self.transform = transform
+        self.grid = grid
+        # transform of the pixels before the warp (decimated sources)
+        self.pixelTransform = pixelTransform
+
+    def __getattr__(self, name):
+        # coefficients of the affine part (resolution of the image)
+        if name in ("a", "b", "c", "d", "e", "f"):
+            return getattr(self.transform, name)
+        raise AttributeError(name)
+
+    def mapArrays(self, us, vs):
+        if self.pixelTransform is not None:
+            us, vs = self.pixelTransform.mapArrays(us, vs)
+        return self.transform.mapArrays(*self.grid.mapArrays(us, vs))
+
+    def mapArray(self, points):
+        points = np.asarray(points, dtype=np.float64)
+        return np.column_stack(self.mapArrays(points[:, 0], points[:, 1]))
+
+    def inverted(self):
+        return InverseWarpedTransform(self)
+
+    def compose(self, other, first=False):
+        if not first:
+            return WarpedTransform(
+                self.transform.compose(other), self.grid, self.pixelTransform
+            )
+        pixelTransform = other
+        if self.pixelTransform is not None:
+            pixelTransform = other.compose(self.pixelTransform)
+        return WarpedTransform(self.transform, self.grid, pixelTransform)
+
+    def boundary(self):
+        """
+        Map coordinates of the warped outline of the image, (N, 2) array
+        """
+        return self.transform.mapArray(self.grid.boundary())
+
+    def bounds(self, width, height):
+        points = self.boundary()
+        xMin, yMin = points.min(axis=0)
+        xMax, yMax = points.max(axis=0)
+        return (xMin, yMin, xMax, yMax)
+
+    def corners(self, width, height):
+        return self.mapArray([(0, 0), (width, 0), (width, height), (0, height)])
+
+
+class InverseWarpedTransform(object):
+    """
+    Map to pixel mapping of a WarpedTransform
+    """
+
+    def __init__(self, warpedTransform):
+        self.warpedTransform = warpedTransform
+        self.inverse = warpedTransform.transform.inverted()
+
+    def mapArrays(self, xs, ys):
+        warped = self.warpedTransform
+        us, vs = warped.grid.inverseArrays(*self.inverse.mapArrays(xs, ys))
+        if warped.pixelTransform is not None:
+            us, vs = warped.pixelTransform.inverted().mapArrays(us, vs)
+        return us, vs
+
+
+def imageTransform(transform, warp):
+    """
+    Pixel to map mapping of a layer: transform (AffineTransform) if warp is
+    None, else a WarpedTransform
+    """
+    if warp is None:
+        return transform
+    return WarpedTransform(transform, warp.grid())
@@ -0,0 +1,208 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import numpy as np
+from PyQt5.QtCore import QPointF, QRectF
+from PyQt5.QtGui import QPolygonF, QTransform
+from qgis.core import QgsPointXY
+
+from .affine import AffineTransform
+from .reprojection import transformPoints
+
+
+def mapToPixelTransform(mapToPixel, x, y, delta):
+    """
+    QgsMapToPixel as an AffineTransform (map to device pixels), computed
+    from 3 points around (x, y)
+    """
+    p0 = mapToPixel.transform(QgsPointXY(x, y))
+    p1 = mapToPixel.transform(QgsPointXY(x + delta, y))
+    p2 = mapToPixel.transform(QgsPointXY(x, y + delta))
+    a = (p1.x() - p0.x()) / delta
+    d = (p1.y() - p0.y()) / delta
+    b = (p2.x() - p0.x()) / delta
+    e = (p2.y() - p0.y()) / delta
+    return AffineTransform(a, b, p0.x() - a * x - b * y, d, e, p0.y() - d * x - e * y)
+
+
+class WarpMesh(object):
+    """
+    Coarse mesh over an image, used to draw it with a non-affine pixel to
+    map mapping (for example when reprojected on the fly): each cell is
+    drawn as an affine patch fitted on the 4 nodes of the cell
+    """
+
+    def __init__(self, width, height, xs, ys):
+        # xs, ys: map coordinates of the nodes, shape (rows + 1, cols + 1)
+        self.width = width
+        self.height = height
+        self.xs = xs
+        self.ys = ys
+        rows, cols = xs.shape[0] - 1, xs.shape[1] - 1
+        self.us = np.linspace(0, width, cols + 1)
+        self.vs = np.linspace(0, height, rows + 1)
+        self.cellTransforms = self._fitCells()
+
+    @classmethod
+    def fromMapping(cls, width, height, size, pixelToMap, coordinateTransform=None):
+        """
+        pixelToMap maps arrays of pixel coordinates to the map coordinates of
+        the layer. If coordinateTransform is not None, the nodes are then
+        transformed with it (in a single batch)
+        """
+        us, vs = np.meshgrid(
+            np.linspace(0, width, size + 1), np.linspace(0, height, size + 1)
+        )
+        xs, ys = pixelToMap(us.ravel(), vs.ravel())
+        if coordinateTransform is not None:
+            xs, ys = transformPoints(coordinateTransform, xs, ys)
+        return cls(width, height, xs.reshape(us.shape), ys.reshape(us.shape))
+
+    def _fitCells(self):
+        # Least squares affine transform on the 4 corners of each cell: for a
+        # rectangle, it is the mean of the opposite sides
+        du = np.diff(self.us)[np.newaxis, :]
+        dv = np.diff(self.vs)[:, np.newaxis]
+        coefficients = []
+        for nodes in (self.xs, self.ys):
+            n00 = nodes[:-1, :-1]
+            n10 = nodes[:-1, 1:]
+            n01 = nodes[1:, :-1]
+            n11 = nodes[1:, 1:]
+            du_ = ((n10 - n00) + (n11 - n01)) / (2 * du)
+            dv_ = ((n01 - n00) + (n11 - n10)) / (2 * dv)
+            center = (n00 + n10 + n01 + n11) / 4
+            uCenter = (self.us[:-1] + self.us[1:])[np.newaxis, :] / 2
+            vCenter = (self.vs[:-1] + self.vs[1:])[:, np.newaxis] / 2
+            coefficients.extend([du_, dv_, center - du_ * uCenter - dv_ * vCenter])
+        # a, b, c, d, e, f arrays of shape (rows, cols)
+        return np.array(coefficients)
+
+    def boundary(self):
+        """
+        Map coordinates of the outline of the image as an (N, 2) array
+        """
+        top = np.column_stack([self.xs[0, :], self.ys[0, :]])
+        right = np.column_stack([self.xs[:, -1], self.ys[:, -1]])
+        bottom = np.column_stack([self.xs[-1, ::-1], self.ys[-1, ::-1]])
+        left = np.column_stack([self.xs[::-1, 0], self.ys[::-1, 0]])
+        return np.concatenate([top, right, bottom, left])
+
+    def mapArrays(self, us, vs):
+        """
+        Map coordinates of pixel coordinates through the affine patches of
+        the cells, as drawn
+        """
+        us = np.asarray(us, dtype=np.float64)
+        vs = np.asarray(vs, dtype=np.float64)
+        cols = np.clip(
+            np.searchsorted(self.us, us, side="right") - 1, 0, len(self.us) - 2
+        )
+        rows = np.clip(
+            np.searchsorted(self.vs, vs, side="right") - 1, 0, len(self.vs) - 2
+        )
+        a, b, c, d, e, f = self.cellTransforms[:, rows, cols]
+        return a * us + b * vs + c, d * us + e * vs + f
+
+    def draw(
+        self,
+        painter,
+        image,
+        mapToDevice,
+        visibleRect,
+        pixelRect=None,
+        hiddenCells=None,
+        imageScale=(1.0, 1.0),
+    ):
+        """
+        Draws the image with the painter: mapToDevice is the AffineTransform
+        from map to device pixels, visibleRect the QRectF to paint (cells
+        outside are skipped). If pixelRect (QRectF) is not None, only the
+        cells intersecting this part of the image are drawn. hiddenCells
+        (boolean array (rows, cols), None for none) are not drawn, for
+        example the fully transparent cells. imageScale is the size of image
+        relative to the image of the mesh (a thumbnail is smaller)
+        """
+        a, b, c, d, e, f = self.cellTransforms
+        m = mapToDevice
+        # compose with map to device (vectorized over the cells)
+        cells = np.array(
+            [
+                m.a * a + m.b * d,
+                m.a * b + m.b * e,
+                m.a * c + m.b * f + m.c,
+                m.d * a + m.e * d,
+                m.d * b + m.e * e,
+                m.d * c + m.e * f + m.f,
+            ]
+        )
+
+        xs, ys = mapToDevice.mapArrays(self.xs, self.ys)
+        xMin = np.minimum.reduce([xs[:-1, :-1], xs[:-1, 1:], xs[1:, :-1], xs[1:, 1:]])
+        xMax = np.maximum.reduce([xs[:-1, :-1], xs[:-1, 1:], xs[1:, :-1], xs[1:, 1:]])
+        yMin = np.minimum.reduce([ys[:-1, :-1], ys[:-1, 1:], ys[1:, :-1], ys[1:, 1:]])
+        yMax = np.maximum.reduce([ys[:-1, :-1], ys[:-1, 1:], ys[1:, :-1], ys[1:, 1:]])
+        visible = (
+            (xMax >= visibleRect.left())
+            & (xMin <= visibleRect.right())
+            & (yMax >= visibleRect.top())
+            & (yMin <= visibleRect.bottom())
+        )
+        if pixelRect is not None:
+            visible &= (
+                (self.us[1:] >= pixelRect.left()) & (self.us[:-1] <= pixelRect.right())
+            )[np.newaxis, :]
+            visible &= (
+                (self.vs[1:] >= pixelRect.top()) & (self.vs[:-1] <= pixelRect.bottom())
+            )[:, np.newaxis]
+        if hiddenCells is not None:
+            visible &= ~hiddenCells
+
+        # overlap of the patches so no gap is visible between them: 1 device
+        # pixel (in source pixels) but at least half a source pixel
+        determinants = np.abs(cells[0] * cells[4] - cells[1] * cells[3])
+        margins = np.maximum(0.5, 1.0 / np.sqrt(np.maximum(determinants, 1e-12)))
+
+        baseTransform = painter.transform()
+        for row, col in zip(*np.nonzero(visible)):
+            ca, cb, cc, cd, ce, cf = cells[:, row, col]
+            margin = margins[row, col]
+            u0 = max(self.us[col] - margin, 0)
+            v0 = max(self.vs[row] - margin, 0)
+            u1 = min(self.us[col + 1] + margin, self.width)
+            v1 = min(self.vs[row + 1] + margin, self.height)
+            rect = QRectF(QPointF(u0, v0), QPointF(u1, v1))
+            sourceRect = QRectF(
+                QPointF(u0 * imageScale[0], v0 * imageScale[1]),
+                QPointF(u1 * imageScale[0], v1 * imageScale[1]),
+            )
+            painter.setTransform(QTransform(ca, cd, cb, ce, cc, cf) * baseTransform)
+            painter.drawImage(rect, image, sourceRect)
+        painter.setTransform(baseTransform)
+
+    def cellStarts(self):
+        """
+        (rowStarts, colStarts): first pixel row and column of each cell, None
+        if several cells start on the same pixel (image smaller than the
+        mesh)
+        """
+        rowStarts = np.floor(self.vs[:-1]).astype(np.intp)
+        colStarts = np.floor(self.us[:-1]).astype(np.intp)
+        if np.any(np.diff(rowStarts) <= 0) or np.any(np.diff(colStarts) <= 0):
+            return None
+        return rowStarts, colStarts
+
+    def outline(self, mapToDevice):
+        """
+        Outline of the image in device pixels, as a QPolygonF
+        """
+        points = mapToDevice.mapArray(self.boundary())
+        return QPolygonF([QPointF(x, y) for x, y in points])